@@ -1,153 +1,143 @@
-from datetime import datetime
-import pandas as pd
-import io
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for, send_file
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_classic.agents import AgentExecutor, create_tool_calling_agent
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, stream_with_context, g
+from langchain_classic.agents import create_tool_calling_agent
+from langchain_classic.agents.agent import RunnableMultiActionAgent
 from langchain_core.messages import AIMessage, ToolMessage, HumanMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from tools.agent_tools import list_tables, execute_sql, create_visualization, generate_plot_image
+from tools.agent_tools import list_tables, execute_sql, create_visualization, generate_plot_image, fetch_rows, bq_client
+from db.replica import start_background_sync
+from db.rollups import start_background_refresh
 from cache.cache_manager import CacheManager
+from cache.user_directory import UserDirectory
+from cache.branch_locations import BranchLocations
 from tools.document_rag import initialize_document_store, search_documents
+from tools.table_rag import search_table_rows, TABLE_INDEX_AVAILABLE
+from tools.chart_tools import render_chart
+from tools.request_context import set_request_user, set_request_branches, resolve_allowed_branches
+from services.intent_router import route_message
+from services.exporter import stream_export, export_filename, register_export, resolve_export, FORMATS as EXPORT_FORMATS, EXPORT_ROW_LIMIT
+from services.output_parser import normalize_output, parse_visualization, parse_kv_visualization
+from monitoring.metrics import (
+    metrics_payload, MetricsCallbackHandler, CHAT_REQUEST_SECONDS, AGENT_ITERATIONS,
+    CHAT_HISTORY_MESSAGES, CHAT_HISTORY_SESSIONS
+)
+from monitoring.tracing import begin_trace, end_trace, get_trace_id, span, TracingCallbackHandler
+from services.backends import create_chat_model, CHAT_MODEL
+from services.model_cascade import (
+    ModelCascade, ModelTier, record_router, CASCADE_ENABLED, LIGHT_MODEL, LIGHT_MAX_ITERATIONS, FULL_MAX_ITERATIONS
+)
+from services.admission import admission, AdmissionRejected, QuotaCallbackHandler, with_quota_retry
+from services.agent_budget import BudgetedAgentExecutor, start_budget, trim_observations, AGENT_MAX_EXECUTION_SECONDS
+from services.chat_jobs import ChatJobQueue, CHAT_JOB_MAX_SECONDS
+from services.prefetch import prefetcher
+from services.prompt_builder import build_agent_prompt, build_session_context, PromptUsageTracker, STATIC_PREFIX_TOKENS
 import os
 import json
+import sqlite3
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def get_bq_client(project):
-    """Returns a BigQuery client, using environment variable JSON if available."""
-    json_creds = os.environ.get('GCP_SERVICE_ACCOUNT_JSON')
-    if json_creds:
-        from google.oauth2 import service_account
-        from google.cloud import bigquery
-        try:
-            info = json.loads(json_creds)
-            credentials = service_account.Credentials.from_service_account_info(info)
-            return bigquery.Client(project=project, credentials=credentials)
-        except Exception as e:
-            print(f"Error loading GCP_SERVICE_ACCOUNT_JSON: {e}")
-    # Fallback to default (works locally if GOOGLE_APPLICATION_CREDENTIALS is set)
-    from google.cloud import bigquery
-    return bigquery.Client(project=project)
-
 # Initialize document vector store
 print("Initializing document vector store...")
 initialize_document_store()
 print("Document store ready")
 
+# Keep the local analytical replica fresh (no-op unless REPLICA_MODE and REPLICA_SYNC_INTERVAL are set)
+start_background_sync(bq_client)
+# Rebuild stale monthly rollups (no-op unless ROLLUP_TARGET is set)
+start_background_refresh(bq_client)
+
+# Bulk-load crm_users in the background so login/profile checks skip BigQuery
+user_directory = UserDirectory()
+user_directory.start_refresh()
+
+# Geocode branches once per refresh interval; /api/branches serves the prebuilt JSON
+branch_locations = BranchLocations()
+branch_locations.start_refresh()
+
 app = Flask(__name__)
 app.secret_key = 'agency_os_super_secret_key' # In production, use environment variable
 
+# Endpoints recorded as one trace per request (see monitoring/tracing.py)
+TRACED_ENDPOINTS = {'chat', 'export_by_ref', 'export_to_excel'}
+
+@app.before_request
+def start_request_trace():
+    g.request_started = time.time()
+    if request.endpoint in TRACED_ENDPOINTS:
+        begin_trace(request.endpoint, path=request.path, user=session.get('user_email'))
+
+@app.before_request
+def admit_chat_request():
+    """Admission control for /chat: per-user and global limits, queue deadline, quota cooldown."""
+    if request.endpoint != 'chat' or g.get('chat_job_id'):
+        # Background jobs are bounded by the job workers instead
+        return None
+    try:
+        with span("admission"):
+            g.admission_ticket = admission.acquire(session.get('user_email') or request.remote_addr)
+    except AdmissionRejected as e:
+        g.chat_outcome = 'rejected'
+        g.retry_after = e.retry_after
+        return jsonify({"response": e.message, "visualization_type": "none", "retry_after": e.retry_after}), e.status
+    return None
+
+@app.after_request
+def add_trace_header(response):
+    trace_id = get_trace_id()
+    if trace_id:
+        response.headers['X-Trace-Id'] = trace_id
+    if g.get('retry_after'):
+        response.headers['Retry-After'] = str(g.retry_after)
+    if request.endpoint == 'chat' and 'request_started' in g:
+        CHAT_REQUEST_SECONDS.labels(g.get('chat_outcome', 'agent')).observe(time.time() - g.request_started)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint (aggregates all workers in multiprocess mode)."""
+    body, content_type = metrics_payload()
+    return Response(body, mimetype=content_type)
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    if 'admission_ticket' in g:
+        admission.release(g.pop('admission_ticket'))
+    end_trace(error)
 
-# --- CONFIGURATION ---
-# LLM Setup
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0, verbose=True)
 
+# --- CONFIGURATION ---
 #tool binding
-tools = [list_tables, execute_sql, create_visualization, search_documents]
-llm_with_tools = llm.bind_tools(tools)
+tools = [list_tables, execute_sql, render_chart, create_visualization, search_documents]
+if TABLE_INDEX_AVAILABLE:
+    tools.append(search_table_rows)
+else:
+    print("Table row index not found, run script_runners/sqlite_to_chroma.py to enable search_table_rows")
 
 chat_histories = {}
 
-#to stop hallucinantion on date part, need to add todays date
-todays_date = datetime.now().strftime("%Y-%m-%d")
-
-system_prompt = (
-     "You are a helpful data assistant connected to a BigQuery database. "
-     "You have full access to the database via your tools. Do not say you don't have access.\n"
-     "RULES:\n"
-     "1. DATASET: Always search answers from the `hackathon_data` dataset.\n"
-     "2. FIRST STEP: You MUST use `list_tables` to see the valid table names. Do NOT guess table names like 'application_sample'.\n"
-     "3. TABLE MAPPINGS: Use these specific tables when the user refers to these terms:\n"
-     "   - `application_table`: applications, application, applicants\n"
-     "   - `base_branch_table`: branch, branches\n"
-     "   - `base_contact_table`: contacts, contact, clients, client, customer\n"
-     "   - `crm_user`: user, users\n"
-     "   - `deals_applications_table`: applications in deal, applications of client, applicants deal\n"
-     "   - `enquiry_deals_applications_table`: applications based on enquiry, applications based on deals, deals based on enquiry, enquiry\n"
-     "   - `enquiry_table`: enquiry\n"
-     "   - `feedback_questions_table`: feedback questions, questions in feedback\n"
-     "   - `feedback_table`: feedbacks from office visit client, feedbacks, feedback\n"
-     "   - `office_visit_table`: office visits, branch visits, query from branches, client queries\n"
-     "4. JOINS: If required, perform cross-table information gathering by joining tables based on their IDs.\n"
-     "5. Use `execute_sql` to get data. Always use the dataset `hackathon_data`.\n"
-     "   - DATE HANDLING: Dates are stored as STRINGS (e.g. '2025-12-01'). You MUST cast them using `CAST(column AS DATE)` or `PARSE_DATE('%Y-%m-%d', column)` before using functions like `EXTRACT`.\n"
-     "6. VISUALIZATIONS: \n"
-     "   - PREFER interactive format over static images.\n"
-     "   - For Comparison/Trends (Bar, Line, Pie, Scatter): Return a JSON object with `visualization_type` (e.g. 'bar', 'line'), `visualization_title` (a clear title), and `data_query` (SQL query). \n"
-     "   - IMPORTANT: SQL query for charts should return the CATEGORY/LABEL as the first column and the VALUE/COUNT as the second column. \n"
-     "   - For Processes/Workflows (Flowchart): Return a JSON object with `visualization_type`: 'flowchart' and `data`: 'MERMAID_SYNTAX'.\n"
-     "7. DO NOT generate ASCII tables or markdown tables for data that should be graphed. Always use the JSON visualization format for chart requests.\n"
-     "8. If asking for a comparison (e.g., 'compare A and B'), query data for both and return the visualization JSON.\n"
-     "9. ALWAYS answer based on the data returned by the tools. Do not make up facts.\n"
-     "10. If a tool returns an error, try to fix the query and try again.\n"
-     "11. Visualizations are rendered directly in the chat window. DO NOT say they will be in a separate window.\n"
-     "12. Based on the previous output and steps, try to continue the conversation with memory saved.\n"
-     "13. DOCUMENT SEARCH: Use `search_documents` when users ask about uploaded documents, workflows, processes, or any information from PDF files.\n"
-     "14. You can combine database queries with document searches to provide comprehensive answers.\n"
-     "15. If asked beyond the hackathon_data and documents, deny saying 'I am not trained to communicate on these topics'.\n"
-     "16. MERMAID/FLOWCHART SYNTAX RULES:\n"
-     "    - Use `graph TD` or `graph LR`.\n"
-     "    - Wrap node labels in double quotes. Example: A[\"Start Process\"]\n"
-     "    - Do NOT use double quotes inside the label. Use single quotes if needed. Example: B[\"Select 'Option 1'\"]\n"
-     "    - Return as unstructured string in the `data` field of the JSON. Ensure newlines are encoded as `\\n`."
-     "17. memorize eveything from the last converstation and try to continue the conversation with memory saved.\n"
-     "18. Always try to continue the conversation with memory saved. Ask each time for further assistance based on last conversation\n"
-     "19. When asked about gramatical noun in the chat always consider canonical status rules , here left side values are database status and right side values are their sysnonyms:\n"
-     "    - Enquiry Status Mapping:\n"
-     "        - new, contacted, evaluating : Open\n"
-     "        - converted : Converted\n"
-     "        - assessing, future lead, engage immediately, accessing : Qualified\n"
-     "        - financial limitations, service unavailable, personal circumstances, not a fit, incorrect information : Disqualified ,ineligible\n"
-     "        - interest withdrawn, changed decision, unresponsive, competitor selected : Lost\n"
-     "        - archived : Archived\n"
-     "    - Application Status Mapping:\n"
-     "        - In Progress: active, ongoing, processing, open application, on track, open\n"
-     "        - Discontinued: convertinactive, in-active, withdrawn, cancelled, closed, terminateded\n"
-     "        - Completed: completed, finished, closed\n"
-     "    - Office Visit Status Mapping:\n"
-     "        - Pending: active, ongoing, processing, open application, on track, open\n"
-     "        - Unattended: convertinactive, in-active, withdrawn, cancelled, closed, terminateded\n"
-     "        - Waiting: completed, finished, closed\n"
-     "        - Completed: completed, finished, closed\n"
-     "        - Attending: attending, in session, ongoing, active, participating\n"
-     "    - Deal Status Mapping:\n"
-     "        - discovery: new deal, converted enquiry, not started\n"
-     "        - in-progress: active\n"
-     "        - lost: inactive, in-active, unsuccessful\n"
-     "        - completed: completed, won, win, success\n"
-     "20. During answering dont reference based on the database column names and document names.\n"
-     "21. when asked about separate tables ,graphs, chats or flowchart render it separately as asked.\n"
-     "22. Do NOT say 'Based on the available document' or similar phrases. Provide the answer directly and concisely.\n"
-     "23. ACCESS CONTROL & SQL TIPS: You are strictly limited to data from specific branches. \n"
-     "24. Your primary branch is: {primary_branch}. \n"
-     "25. Your currently allowed branches (including primary and secondary) are: {allowed_branches}. \n"
-     "26. You MUST filter all SQL queries by these branches. IMPORTANT: Use the following specific columns per table:\n"
-     "   - `application_table`: Branch: `branch`. Date: `Added_Date`. Status: `Status` (Values: 'Completed', 'In Progress', 'Discontinued').\n"
-     "   - `enquiry_table`: Branch: `branch`. Date: `created_at`. Status: `status`.\n"
-     "   - `office_visits_table`: Branch: `visited_branch_name`. Date: `visit_date`.\n"
-     "   - `deals_applications_table`: Branch: `deal_belongs_to_branch` or `processing_branch_name`. Date: `deal_created_at`. Status: `deal_status` or `application_status`.\n"
-     "27. BIGQUERY DATE TIPS: These columns are DATETIME. DO NOT use `PARSE_DATE` on them. Use `EXTRACT(MONTH FROM Added_Date)` or `FORMAT_DATETIME('%B', Added_Date)` for filtering by month name.\n"
-     "28. If you need to join tables to find the branch affiliation, do so.\n"
-     "29. If a user asks for data outside these branches, politely state that you only have access to their assigned branches: {allowed_branches}.\n"
-     "30. When asked about your assigned branches, list both your primary branch and your secondary branches clearly.\n"
-     "31. When user's branch is All branches, it mean he has access to all the available branches\n"
-     "32. When asked about the assignee, always consider the user name and user's primary branch\n"
-     "33. Consider typo to the closest meaning\n"
-     "34. If the output token is maxed out then prompty say, the request is too big for me to continue\n"
-     f"Always consider todays date in your answer, when asked about the date consider {todays_date}\n"
-)
+# Static, cache-friendly prefix + per-request session block (date, branches)
+prompt = build_agent_prompt()
+print(f"System prompt static prefix: ~{STATIC_PREFIX_TOKENS} tokens")
 
-# Create Agent (returns a Graph)
-prompt = ChatPromptTemplate.from_messages([
-    ("system", system_prompt),
-    MessagesPlaceholder(variable_name="chat_history"),
-    ("human", "{input}"),
-    MessagesPlaceholder(variable_name="agent_scratchpad"),
-])
-agent = create_tool_calling_agent(llm, tools, prompt)
-agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True, return_intermediate_steps=True)
+def build_agent_executor(model, max_iterations):
+    """Tool-calling agent on `model` with the shared tools and prompt."""
+    llm = create_chat_model(model, temperature=0, verbose=True)
+    agent = create_tool_calling_agent(llm, tools, prompt)
+    # Each agent step is retried on Gemini rate limits with jittered backoff (retries need invoke, not stream)
+    # Large tool outputs are trimmed before each step; the request's budget (wall time, tokens) can stop the run between steps
+    return BudgetedAgentExecutor(
+        agent=RunnableMultiActionAgent(runnable=with_quota_retry(agent), stream_runnable=False),
+        tools=tools, verbose=True, return_intermediate_steps=True, max_iterations=max_iterations,
+        trim_intermediate_steps=trim_observations
+    )
+
+# LLM Setup: the light model answers first; the full model only when its answer fails validation
+agent_executor = build_agent_executor(CHAT_MODEL, FULL_MAX_ITERATIONS)
+model_tiers = [ModelTier("full", CHAT_MODEL, agent_executor)]
+if CASCADE_ENABLED:
+    model_tiers.insert(0, ModelTier("light", LIGHT_MODEL, build_agent_executor(LIGHT_MODEL, LIGHT_MAX_ITERATIONS)))
+model_cascade = ModelCascade(model_tiers)
 
 @app.route('/')
 def home():
@@ -175,31 +165,15 @@ def login_api():
         if not email:
             return jsonify({'success': False, 'error': 'Email is required'}), 400
             
-        # Verify against BigQuery
-        from google.cloud import bigquery
-        bq_client = get_bq_client(project='expert-hackathon-2026')
-        
-        query = """
-            SELECT user_email, primary_branch_name, branches
-            FROM `hackathon_data.crm_users` 
-            WHERE user_email = @email
-            AND active_status = 'active'
-            LIMIT 1
-        """
+        # Verify against the cached user directory (BigQuery on a miss)
+        user = user_directory.lookup(email, require_active=True)
         
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("email", "STRING", email)
-            ]
-        )
-        
-        query_job = bq_client.query(query, job_config=job_config)
-        results = list(query_job.result())
-        
-        if results:
-            session['user_email'] = results[0].user_email
-            session['primary_branch'] = results[0].primary_branch_name
-            session['allowed_branches_raw'] = results[0].branches
+        if user:
+            session['user_email'] = user['user_email']
+            session['primary_branch'] = user['primary_branch']
+            session['allowed_branches_raw'] = user['branches']
+            # Warm the shared results of this branch set's usual first questions in the background
+            prefetcher.schedule(user['user_email'], resolve_allowed_branches(user['primary_branch'], user['branches']))
             return jsonify({'success': True})
         else:
             return jsonify({'success': False, 'error': 'Account not found or inactive'}), 401
@@ -211,90 +185,18 @@ def login_api():
 @app.route('/api/branches', methods=['GET'])
 def get_branches():
     """
-    Fetch branch locations from BigQuery and return with coordinates.
-    Uses predefined coordinates based on branch names.
+    Return branch locations with coordinates from the precomputed branch index.
+    Clients that send a matching If-None-Match get a 304 without a body.
     """
     try:
-        from google.cloud import bigquery
-        
-        bq_client = get_bq_client(project='expert-hackathon-2026')
-        
-        # Predefined coordinates for known branch locations
-        branch_coordinates = {
-            'johannesburg': {'lat': -26.2041, 'lng': 28.0473},
-            'lagos': {'lat': 6.5244, 'lng': 3.3792},
-            'yaba': {'lat': 6.5244, 'lng': 3.3792},
-            'port harcourt': {'lat': 4.8156, 'lng': 7.0498},
-            'nairobi': {'lat': -1.2921, 'lng': 36.8219},
-            'accra': {'lat': 5.6037, 'lng': -0.1870},
-            'kampala': {'lat': 0.3476, 'lng': 32.5825},
-            'dar es salaam': {'lat': -6.7924, 'lng': 39.2083},
-            'kigali': {'lat': -1.9706, 'lng': 30.1044},
-            'kathmandu': {'lat': 27.7172, 'lng': 85.3240},
-            'putalisadak': {'lat': 27.7172, 'lng': 85.3240},
-            'pokhara': {'lat': 28.2096, 'lng': 83.9856},
-            'chitwan': {'lat': 27.5291, 'lng': 84.3542},
-            'sydney': {'lat': -33.8688, 'lng': 151.2093},
-            'parramatta': {'lat': -33.8151, 'lng': 151.0000},
-            'melbourne': {'lat': -37.8136, 'lng': 144.9631},
-            'brisbane': {'lat': -27.4698, 'lng': 153.0251},
-            'perth': {'lat': -31.9505, 'lng': 115.8605},
-            'adelaide': {'lat': -34.9285, 'lng': 138.6007},
-            'abuja': {'lat': 9.0765, 'lng': 7.3986},
-            'ibadan': {'lat': 7.3775, 'lng': 3.9470},
-            'kano': {'lat': 12.0022, 'lng': 8.5920},
-        }
-        
-        # Query branch data
-        query = """
-            SELECT 
-                branch_id,
-                branch_name,
-                branch_address
-            FROM `hackathon_data.base_branch_table`
-            LIMIT 50
-        """
-        
-        results = bq_client.query(query).result()
-        branches = []
-        
-        for row in results:
-            branch_name_lower = row.branch_name.lower() if row.branch_name else ''
-            
-            # Find matching coordinates
-            coords = None
-            
-            # Helper to check if any key matches
-            def get_coords(text):
-                if not text: return None
-                text = text.lower()
-                for key, value in branch_coordinates.items():
-                    if key in text:
-                        return value
-                return None
-
-            # 1. Try matching by Name
-            coords = get_coords(row.branch_name)
-            
-            # 2. If not found, try matching by Address
-            if not coords:
-                coords = get_coords(row.branch_address)
-            
-            # Only add branches with valid coordinates
-            if coords:
-                branches.append({
-                    'id': row.branch_id,
-                    'name': row.branch_name,
-                    'address': row.branch_address,
-                    'lat': coords['lat'],
-                    'lng': coords['lng']
-                })
-        
-        return jsonify({
-            'success': True,
-            'branches': branches,
-            'count': len(branches)
-        })
+        body, etag = branch_locations.snapshot()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
         
     except Exception as e:
         print(f"Error fetching branches: {e}")
@@ -307,7 +209,7 @@ def get_branches():
 @app.route('/api/profile', methods=['GET'])
 def get_user_profile():
     """
-    Fetch user profile with primary and secondary branches from BigQuery.
+    Fetch user profile with primary and secondary branches from the user directory.
     """
     try:
         if 'user_email' not in session:
@@ -320,30 +222,12 @@ def get_user_profile():
         all_branches_str = session.get('allowed_branches_raw')
         
         if primary_branch is None or all_branches_str is None:
-            # Fallback to BigQuery if session data is missing
-            from google.cloud import bigquery
-            bq_client = get_bq_client(project='expert-hackathon-2026')
+            # Fallback to the user directory if session data is missing
+            user = user_directory.lookup(user_email)
             
-            query = """
-                SELECT primary_branch_name, branches 
-                FROM `hackathon_data.crm_users` 
-                WHERE user_email = @email
-                LIMIT 1
-            """
-            
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("email", "STRING", user_email)
-                ]
-            )
-            
-            query_job = bq_client.query(query, job_config=job_config)
-            results = list(query_job.result())
-            
-            if results:
-                row = results[0]
-                primary_branch = row.primary_branch_name
-                all_branches_str = row.branches or ""
+            if user:
+                primary_branch = user['primary_branch']
+                all_branches_str = user['branches']
                 # Update session
                 session['primary_branch'] = primary_branch
                 session['allowed_branches_raw'] = all_branches_str
@@ -375,6 +259,16 @@ def chat():
     try:
         # Get User ID for history
         user_id = session.get('user_email', 'default_user')
+        set_request_user(user_id)
+
+        # A client request id lets the browser poll for this answer if the platform cuts the request off
+        request_id = request.json.get("request_id")
+        if request_id and 'user_email' in session and not g.get('chat_job_id'):
+            try:
+                if chat_jobs.track_inline(request_id, user_id, user_msg):
+                    g.tracked_request_id = request_id
+            except sqlite3.Error as e:
+                print(f"[CHAT JOB] Could not track request {request_id}: {e}")
         
         # Enforce Branch Access Control
         primary_branch = session.get('primary_branch')
@@ -382,16 +276,15 @@ def chat():
         
         if (primary_branch is None or allowed_branches_raw is None) and 'user_email' in session:
             # Fetch branches if not in session (for existing sessions)
-            from google.cloud import bigquery
-            bq_client = get_bq_client(project='expert-hackathon-2026')
-            query = "SELECT primary_branch_name, branches FROM `hackathon_data.crm_users` WHERE user_email = @email LIMIT 1"
-            job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("email", "STRING", user_id)])
-            results = list(bq_client.query(query, job_config=job_config).result())
-            if results:
-                primary_branch = results[0].primary_branch_name
-                allowed_branches_raw = results[0].branches
+            user = user_directory.lookup(user_id)
+            if user:
+                primary_branch = user['primary_branch']
+                allowed_branches_raw = user['branches']
                 session['primary_branch'] = primary_branch
                 session['allowed_branches_raw'] = allowed_branches_raw
+
+        allowed_branch_list = resolve_allowed_branches(primary_branch, allowed_branches_raw)
+        set_request_branches(allowed_branch_list)
         
         # Format allowed branches for the prompt
         if allowed_branches_raw:
@@ -404,15 +297,35 @@ def chat():
         if user_id not in chat_histories:
             chat_histories[user_id] = []
 
+        # Deterministic fast path for predictable questions (no LLM round trips)
+        router_started = time.time()
+        with span("intent_router"):
+            routed = route_message(user_msg, primary_branch, allowed_branch_list)
+        record_router(bool(routed), time.time() - router_started)
+        if routed:
+            chat_histories[user_id].extend([
+                HumanMessage(content=user_msg),
+                AIMessage(content=routed["response"])
+            ])
+            g.chat_outcome = 'routed'
+            return jsonify(routed)
+
         # Check Cache for full agent response
         # We use a composite key of user_msg and history
         cache_manager = CacheManager()
-        cache_data = {"input": user_msg, "allowed_branches": allowed_branches_str, "primary_branch": primary_branch or ""}
+        # Branches are sorted so users with the same branch set in a different order share entries
+        cache_data = {
+            "input": user_msg,
+            "allowed_branches": "all" if allowed_branch_list is None else sorted(allowed_branch_list),
+            "primary_branch": primary_branch or "",
+        }
         cached_response = cache_manager.get("agent_invoke", cache_data)
         
         if cached_response:
              print("[CACHE HIT] Agent Response")
+             g.chat_outcome = 'cache_hit'
              result = cached_response
+             charts = result.get("charts", [])
              # Update history even on cache hit so context builds up
              chat_histories[user_id].extend([
                  HumanMessage(content=user_msg),
@@ -423,28 +336,44 @@ def chat():
              # Use the history in the invoke
              current_history = chat_histories[user_id]
              
+             usage_tracker = PromptUsageTracker()
+             # Iterations, wall time and prompt tokens for every tier of this request
+             budget = start_budget(CHAT_JOB_MAX_SECONDS if g.get('chat_job_id') else AGENT_MAX_EXECUTION_SECONDS)
+             # render_chart fetches chart data in the background while the agent keeps answering
+             charts = []
              try:
-                 result = agent_executor.invoke({
+                 result, charts, model_tier = model_cascade.invoke({
                     "input": user_msg,
                     "chat_history": current_history,
-                    "allowed_branches": allowed_branches_str,
-                    "primary_branch": primary_branch or "None"
-                 })
+                    "session_context": build_session_context(primary_branch, allowed_branches_str)
+                 }, callbacks=[usage_tracker, budget, TracingCallbackHandler(), MetricsCallbackHandler(), QuotaCallbackHandler()])
+                 print(f"[CASCADE] Answered by the {model_tier} tier")
+                 if result.get("budget_stop"):
+                     # Partial answers are not cached, so asking again gets a fresh run
+                     g.chat_outcome = 'budget'
+                 AGENT_ITERATIONS.observe(len(result.get("intermediate_steps", [])))
              except Exception as e:
                  error_str = str(e).lower()
                  if "max_output_tokens" in error_str or "max tokens" in error_str or "finish_reason: 1" in error_str:
+                     g.chat_outcome = 'too_big'
                      result = {"output": "The request is too big for me to continue. Please try asking a more specific question."}
                  elif "quota" in error_str or "429" in error_str:
+                     g.chat_outcome = 'quota'
+                     g.retry_after = getattr(e, 'retry_after', None) or max(1, round(admission.retry_after()))
                      result = {"output": "I am currently receiving too many requests. Please wait a moment and try again."}
                  else:
                      print(f"Agent execution error: {e}")
+                     g.chat_outcome = 'error'
                      result = {"output": "I encountered an error while processing your request. Please try again or rephrase your question."}
+             usage_tracker.report()
              
              # Append to history
              chat_histories[user_id].extend([
                  HumanMessage(content=user_msg),
                  AIMessage(content=result.get("output", ""))
              ])
+             CHAT_HISTORY_MESSAGES.observe(len(chat_histories[user_id]))
+             CHAT_HISTORY_SESSIONS.set(len(chat_histories))
                           
              # Let's clean intermediate steps for caching
              clean_steps = []
@@ -459,45 +388,26 @@ def chat():
                  
              clean_result = {
                  "output": result.get("output"),
-                 "intermediate_steps": clean_steps
+                 "intermediate_steps": clean_steps,
+                 "charts": charts
              }
              
-             # We store THIS clean result
-             cache_manager.set("agent_invoke", cache_data, clean_result)
+             # We store THIS clean result (unless the run or a chart failed, so the next ask retries it)
+             if 'chat_outcome' not in g and not any("error" in chart for chart in charts):
+                 cache_manager.set("agent_invoke", cache_data, clean_result)
              
              # We use the original result for this turn
                 
-        final_answer = result.get("output", "")
+        # Newer LangChain / Google GenAI versions can return a list of content parts
+        final_answer = normalize_output(result.get("output", ""))
         intermediate_steps = result.get("intermediate_steps", [])
         
-        # Handle cases where final_answer is a list (newer LangChain versions / Google GenAI)
-        if isinstance(final_answer, list):
-            cleaned_parts = []
-            for item in final_answer:
-                # If item is a dict (e.g. Generation object), try to extract 'text'
-                if isinstance(item, dict):
-                    if "text" in item:
-                        cleaned_parts.append(item["text"])
-                    # Ignore other keys like 'extras', 'index', 'safety_ratings'
-                # If item is an object with 'text' attribute (Pydantic model)
-                elif hasattr(item, "text"):
-                     cleaned_parts.append(item.text)
-                # If string, use directly
-                elif isinstance(item, str):
-                    cleaned_parts.append(item)
-                # Fallback: convert to string only if it's a primitive type that makes sense
-                elif isinstance(item, (int, float)):
-                    cleaned_parts.append(str(item))
-            
-            final_answer = "".join(cleaned_parts)
-        elif not isinstance(final_answer, str):
-            # Convert any other type to string
-            final_answer = str(final_answer)
-        
         # Default response values
         vis_type = "none"
         vis_title = ""
         vis_data = []
+        # SQL behind the answer, offered for a full server-side export
+        export_query = None
         
         # Scan intermediate steps to see if visualization was requested (Fallback for legacy tool usage)
         for action, observation in intermediate_steps:
@@ -505,7 +415,11 @@ def chat():
             tool_name = action.tool if hasattr(action, 'tool') else action.get('tool')
             tool_input = action.tool_input if hasattr(action, 'tool_input') else action.get('tool_input')
             
+            if tool_name == "execute_sql":
+                export_query = tool_input.get("query") if isinstance(tool_input, dict) else tool_input
+            
             if tool_name == "create_visualization":
+                export_query = tool_input.get("data_query") or export_query
                 vis_type = tool_input.get("chart_type", "none")
                 vis_title = tool_input.get("title", "")
                 
@@ -528,162 +442,263 @@ def chat():
                     vis_data = []
                 break
         
-        # Priority: Check if the LLM outputted a JSON block for visualization
+        # Priority: Charts requested through render_chart (data already fetched in parallel)
+        if charts:
+            chart = charts[0]
+            vis_type = chart["visualization_type"]
+            vis_title = chart["visualization_title"]
+            vis_data = chart["data"] or []
+            export_query = chart.get("data_query") or export_query
+            if "error" in chart:
+                print(f"Chart data fetch failed: {chart['error']}")
+                final_answer += f"\n\n[System Error: {chart['error']}]"
+
+        # Fallback: the LLM wrote visualization JSON into its answer instead of calling render_chart
         # This overrides tool usage if present, as it allows for interactive charts
-        if "{" in final_answer or "```json" in final_answer:
-             try:
-                 import re
-                 # 1. Try to extract from markdown json block first
-                 json_block_match = re.search(r'```json\s*(\{.*?\})\s*```', final_answer, re.DOTALL)
-                 potential_json = None
-                 match_span = None
-                 
-                 if json_block_match:
-                     potential_json = json_block_match.group(1)
-                     match_span = json_block_match.span()
-                 else:
-                     # 2. Try to find any JSON-like block
-                     # We assume the JSON is the *last* structured block or the most prominent one
-                     # Regex: Match { ... "visualization_type" ... }
-                     # We use a non-greedy dot match inside the braces, but ensure it captures the keys
-                     json_match = re.search(r'(\{[\s\S]*?"visualization_type"[\s\S]*?\})', final_answer)
-                     
-                     if json_match:
-                         potential_json = json_match.group(1)
-                         match_span = json_match.span()
-
-                 if potential_json:
-                     # Attempt to parse
-                     try:
-                         parsed = json.loads(potential_json)
-                     except json.JSONDecodeError:
-                         # Retry with loose parsing (sometimes newlines in strings break strict JSON)
-                         # Simple cleanup: remove newlines from values if they are not escaped?
-                         # Actually usually it's better to just try cleaning the string
-                         is_flowchart = "flowchart" in potential_json.lower() or "mermaid" in potential_json.lower()
-                         
-                         if is_flowchart:
-                             # For Flowcharts: Try to extract data field via regex if JSON load failed
-                             # patterns to try: "data": "..." or "data": '...'
-                             # We use . to match everything including newlines
-                             print("Attempting Mermaid Regex Recovery...")
-                             import re
-                             data_match = re.search(r'"data"\s*:\s*"(.*?)"\s*\}', potential_json, re.DOTALL)
-                             if data_match:
-                                 # We found the data field at the end
-                                 raw_data = data_match.group(1)
-                                 # Re-construct a valid object
-                                 parsed = {
-                                     "visualization_type": "flowchart",
-                                     "data": raw_data
-                                 }
-                             else:
-                                 # Fallback to cleaning but warn
-                                 cleaned_json = potential_json.replace('\n', ' ').replace('\r', '')
-                                 parsed = json.loads(cleaned_json)
-                         else:
-                             # For Regular Charts: Safe to replace newlines with spaces (usually SQL or metadata)
-                             cleaned_json = potential_json.replace('\n', ' ').replace('\r', '')
-                             parsed = json.loads(cleaned_json)
-                     
-                     if "visualization_type" in parsed or "chart_type" in parsed:
-                         print("Recovered visualization from text response")
-                         vis_type = (parsed.get("visualization_type") or parsed.get("chart_type") or "none").lower()
-                         vis_title = parsed.get("visualization_title") or parsed.get("title")
-                         vis_data = parsed.get("data")
-                         
-                         # Execute query if needed (For Interactive Charts)
-                         if not vis_data and "data_query" in parsed:
-                             print(f"Executing fallback query: {parsed['data_query']}")
-                             vis_data_str = execute_sql.invoke(parsed['data_query'])
-                             
-                             if vis_data_str and not vis_data_str.startswith("Error"):
-                                 try:
-                                     vis_data = json.loads(vis_data_str)
-                                 except Exception as e:
-                                     print(f"Failed to load SQL result JSON: {e}")
-                                     vis_data = []
-                             else:
-                                 print(f"SQL Execution failed or returned error: {vis_data_str}")
-                                 final_answer += f"\n\n[System Error: {vis_data_str}]"
-                                 vis_data = []
-                         
-                         # Clean the response - remove the entire matched part
-                         if match_span:
-                            start, end = match_span
-                            final_answer = (final_answer[:start] + final_answer[end:]).strip()
-             except Exception as e:
-                 print(f"Fallback parsing failed: {e}")
+        visualization = None
+        if not charts:
+            try:
+                with span("parse.visualization", answer_chars=len(final_answer)):
+                    visualization = parse_visualization(final_answer)
+            except Exception as e:
+                print(f"Fallback parsing failed: {e}")
+
+        if visualization:
+            print("Recovered visualization from text response")
+            vis_type = visualization.type
+            vis_title = visualization.title
+            vis_data = visualization.data
+            # Clean the response - remove the entire matched part
+            final_answer = visualization.remove_from(final_answer)
+
+            # Execute query if needed (For Interactive Charts)
+            if not vis_data and visualization.data_query:
+                print(f"Executing fallback query: {visualization.data_query}")
+                export_query = visualization.data_query
+                vis_data_str = execute_sql.invoke(visualization.data_query)
+
+                if vis_data_str and not vis_data_str.startswith("Error"):
+                    try:
+                        vis_data = json.loads(vis_data_str)
+                    except Exception as e:
+                        print(f"Failed to load SQL result JSON: {e}")
+                        vis_data = []
+                else:
+                    print(f"SQL Execution failed or returned error: {vis_data_str}")
+                    final_answer += f"\n\n[System Error: {vis_data_str}]"
+                    vis_data = []
                
         # Fallback 2: Check for key-value style (create_visualization query="..." ...)
         if vis_type == "none":
-            import re
-            # Regex to capture: create_visualization then query="..." chart_type="..." title="..."
-            # We use non-greedy matches and allow for newlines
-            pattern = r'create_visualization\s+query="(?P<query>.*?)"\s+chart_type="(?P<type>.*?)"\s+title="(?P<title>.*?)"'
-            match = re.search(pattern, final_answer, re.DOTALL)
+            kv_visualization = parse_kv_visualization(final_answer)
             
-            if match:
+            if kv_visualization:
                 print("Recovered visualization from KV-text response")
-                q = match.group("query")
-                c = match.group("type")
-                t = match.group("title")
+                q = kv_visualization.data_query
+                t = kv_visualization.title
                 
                 print(f"Executing fallback visualization (KV): {q}")
-                vis_data = generate_plot_image(q, c, t)
+                vis_data = generate_plot_image(q, kv_visualization.type, t)
                 
                 if "image" in vis_data:
                     vis_type = "image"
                     vis_title = t
-                    final_answer = final_answer.replace(match.group(0), "").strip()
+                    export_query = q
+                    final_answer = kv_visualization.remove_from(final_answer)
                 elif "error" in vis_data:
                     # Provide feedback about the error in the chat
                     final_answer += f"\n\n[System: Visualization failed. Error: {vis_data['error']}]"
 
+        export_ref = None
+        if export_query and 'user_email' in session:
+            try:
+                export_ref = register_export(user_id, export_query, vis_title)
+            except Exception as e:
+                print(f"Failed to register export: {e}")
+
         return jsonify({
             "response": final_answer,
             "visualization_type": vis_type,
             "visualization_title": vis_title,
-            "data": vis_data
+            "data": vis_data,
+            "export_ref": export_ref
         })
 
     except Exception as e:
         print(f"Error processing request: {e}")
+        g.chat_outcome = 'error'
         return jsonify({"response": "Sorry, I encountered an error while processing your request.", "visualization_type": "none"})
 
 
+@app.after_request
+def finish_tracked_chat(response):
+    """Store the answer of a /chat request tracked by its client request id."""
+    request_id = g.pop('tracked_request_id', None)
+    if request_id:
+        try:
+            chat_jobs.finish_inline(request_id, response.get_json(silent=True), response.status_code)
+        except sqlite3.Error as e:
+            print(f"[CHAT JOB] Could not store request {request_id}: {e}")
+    return response
+
+
+def run_chat_job(job: dict):
+    """Answer a queued job through /chat with the submitter's session; returns (response JSON, status)."""
+    with app.test_request_context('/chat', method='POST', json={"message": job["message"]}):
+        session.update(job["session"])
+        g.chat_job_id = job["job_id"]
+        response = app.full_dispatch_request()
+        return response.get_json(), response.status_code
+
+
+# Long questions run in the background; jobs queued by any worker process are picked up here
+chat_jobs = ChatJobQueue()
+chat_jobs.start(run_chat_job)
+
+
+def _job_session() -> dict:
+    return {key: session.get(key) for key in ('user_email', 'primary_branch', 'allowed_branches_raw')}
+
+
+@app.route('/chat/jobs', methods=['POST'])
+def submit_chat_job():
+    """
+    Queue a question that may take longer than an HTTP request is allowed to.
+    Returns 202 with the job id; poll GET /chat/jobs/<job_id> for the answer.
+    """
+    if 'user_email' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    user_msg = (request.json or {}).get("message")
+    if not user_msg:
+        return jsonify({"success": False, "error": "Please enter a message."}), 400
+    try:
+        job = chat_jobs.submit(session['user_email'], user_msg, _job_session())
+    except AdmissionRejected as e:
+        response = jsonify({"success": False, "error": e.message, "retry_after": e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, e.status
+    job["status_url"] = url_for('get_chat_job', job_id=job["job_id"])
+    return jsonify(job), 202
+
+
+@app.route('/chat/jobs', methods=['GET'])
+def list_chat_jobs():
+    """The signed-in user's recent jobs, without their answers."""
+    if 'user_email' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    return jsonify({"jobs": chat_jobs.list(session['user_email'])})
+
+
+@app.route('/chat/jobs/<job_id>', methods=['GET'])
+def get_chat_job(job_id):
+    """
+    Job status, with the /chat response under `result` once it is done.
+    `?wait=N` holds the request up to N seconds (at most 25) for the job to finish.
+    """
+    if 'user_email' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    job = chat_jobs.get(job_id, session['user_email'], wait=request.args.get('wait', 0, type=float))
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@app.route('/chat/jobs/<job_id>/events', methods=['GET'])
+def chat_job_events(job_id):
+    """Server-sent events: one `status` event per change, then the finished job."""
+    if 'user_email' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    user_email = session['user_email']
+
+    def events():
+        last_status = None
+        while True:
+            job = chat_jobs.get(job_id, user_email, wait=15)
+            if job is None:
+                yield "event: error\ndata: {\"error\": \"Job not found\"}\n\n"
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield f"event: status\ndata: {json.dumps(job)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            if job["status"] in ('done', 'failed', 'cancelled'):
+                return
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/chat/jobs/<job_id>', methods=['DELETE'])
+def cancel_chat_job(job_id):
+    """Cancel a job that has not started yet."""
+    if 'user_email' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    if not chat_jobs.cancel(job_id, session['user_email']):
+        return jsonify({"success": False, "error": "Only queued jobs can be cancelled"}), 409
+    return jsonify({"success": True})
+
+
+def _export_response(chunks, fmt, filename):
+    """Stream export chunks to the client as a file download."""
+    response = Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+    # Temp files are removed when the response closes, even if it was never iterated
+    response.call_on_close(chunks.close)
+    return response
+
+
 @app.route('/export_to_excel', methods=['POST'])
 def export_to_excel():
+    """Export table rows posted by the browser (header first) as xlsx, csv or parquet."""
     try:
         data = request.json
         rows = data.get('rows', [])
+        fmt = data.get('format', 'xlsx')
         
         if not rows:
             return jsonify({"success": False, "error": "No data to export"})
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({"success": False, "error": f"Unsupported format: {fmt}"}), 400
 
-        # The first row is usually the header
-        if len(rows) < 1:
-             return jsonify({"success": False, "error": "No data to export"})
-             
-        # Create DataFrame
-        df = pd.DataFrame(rows[1:], columns=rows[0])
-        
-        # Save to buffer
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Export')
-        
-        output.seek(0)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"export_{timestamp}.xlsx"
-        
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+        chunks = stream_export(rows, fmt)
+        return _export_response(chunks, fmt, export_filename(fmt))
+
+    except Exception as e:
+        print(f"Export Error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/export/<ref>', methods=['GET'])
+def export_by_ref(ref):
+    """
+    Re-run the query behind a chat answer and stream the full result.
+    The reference comes from the `export_ref` field of a /chat response.
+    """
+    if 'user_email' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"success": False, "error": f"Unsupported format: {fmt}"}), 400
+
+    try:
+        user_id = session['user_email']
+        set_request_user(user_id)
+        set_request_branches(resolve_allowed_branches(session.get('primary_branch'), session.get('allowed_branches_raw')))
+
+        export = resolve_export(ref, user_id)
+        if not export:
+            return jsonify({"success": False, "error": "Export expired or not found"}), 404
+        query, title = export
+
+        # BigQuery rows are paged lazily while the file is being written
+        rows = fetch_rows(query, purpose="export", row_limit=EXPORT_ROW_LIMIT, stream=True)
+        chunks = stream_export(rows, fmt)
+        return _export_response(chunks, fmt, export_filename(fmt, title))
 
     except Exception as e:
         print(f"Export Error: {e}")
@@ -0,0 +1,431 @@
+# fakes.py
+"""
+Deterministic offline stand-ins for Gemini, BigQuery and the embedding models.
+
+services/backends.py returns these when FAKE_BACKENDS=1, so the unchanged app and
+tools run with no network:
+  - FakeBigQueryClient: an in-memory DuckDB copy of `hackathon_data` filled with
+    seeded synthetic rows. Agent SQL is translated with db.replica.translate_sql and
+    query parameters are bound as DuckDB `$name` parameters.
+  - FakeAgentChatModel: a tool-calling chat model that follows a fixed plan chosen
+    from keywords in the question (execute_sql, render_chart or search_documents),
+    then answers from the last tool result.
+  - fake_embeddings(): hash-seeded vectors (same text, same vector).
+
+Latency can be simulated with FAKE_LLM_LATENCY and FAKE_BQ_LATENCY (seconds per call).
+"""
+import concurrent.futures
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Optional
+
+import duckdb
+import pandas as pd
+import sqlglot
+from google.cloud.bigquery import DatasetReference, SchemaField
+from google.cloud.bigquery.table import Row
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from db.replica import translate_sql, UnsupportedQuery, PROJECT_ID, DATASET_ID
+
+FAKE_SEED = int(os.environ.get("FAKE_SEED", 42))
+FAKE_BQ_ROWS = int(os.environ.get("FAKE_BQ_ROWS", 5000))  # Rows per fact table
+FAKE_BQ_LATENCY = float(os.environ.get("FAKE_BQ_LATENCY", 0))
+FAKE_LLM_LATENCY = float(os.environ.get("FAKE_LLM_LATENCY", 0))
+EMBEDDING_SIZE = 256
+BYTES_PER_CELL = 8  # Rough dry-run estimate per scanned cell
+
+BRANCHES = ["Kathmandu", "Pokhara", "Chitwan", "Sydney", "Melbourne", "Brisbane", "Lagos", "Nairobi"]
+APPLICATION_STATUSES = ["Completed", "In Progress", "Discontinued"]
+ENQUIRY_STATUSES = ["New", "Contacted", "Evaluating", "Converted", "Future Lead", "Not a Fit", "Unresponsive", "Archived"]
+DEAL_STATUSES = ["Open", "Won", "Lost"]
+COURSES = ["Bachelor of IT", "Master of Business", "Diploma of Nursing", "Master of Data Science"]
+COUNTRIES = ["Australia", "Canada", "United Kingdom", "United States"]
+
+# DuckDB type -> BigQuery field type, for schemas shown to the agent
+_BQ_TYPES = {
+    "VARCHAR": "STRING", "BIGINT": "INTEGER", "INTEGER": "INTEGER", "DOUBLE": "FLOAT",
+    "TIMESTAMP": "DATETIME", "DATE": "DATE", "BOOLEAN": "BOOLEAN", "DECIMAL": "NUMERIC",
+}
+
+TABLES = {
+    "application_table": [
+        ("application_id", "BIGINT"), ("client_name", "VARCHAR"), ("branch", "VARCHAR"),
+        ("Added_Date", "TIMESTAMP"), ("Status", "VARCHAR"), ("course", "VARCHAR"), ("country", "VARCHAR"),
+    ],
+    "enquiry_table": [
+        ("enquiry_id", "BIGINT"), ("client_name", "VARCHAR"), ("branch", "VARCHAR"),
+        ("created_at", "TIMESTAMP"), ("status", "VARCHAR"), ("source", "VARCHAR"),
+    ],
+    "office_visits_table": [
+        ("visit_id", "BIGINT"), ("client_name", "VARCHAR"), ("visited_branch_name", "VARCHAR"),
+        ("visit_date", "TIMESTAMP"), ("purpose", "VARCHAR"),
+    ],
+    "deals_applications_table": [
+        ("deal_id", "BIGINT"), ("client_name", "VARCHAR"), ("deal_belongs_to_branch", "VARCHAR"),
+        ("processing_branch_name", "VARCHAR"), ("deal_created_at", "TIMESTAMP"), ("deal_status", "VARCHAR"),
+        ("application_status", "VARCHAR"), ("deal_value", "DOUBLE"),
+    ],
+    "base_contact_table": [
+        ("contact_id", "BIGINT"), ("first_name", "VARCHAR"), ("last_name", "VARCHAR"),
+        ("email", "VARCHAR"), ("branch", "VARCHAR"),
+    ],
+    "base_branch_table": [("branch_id", "BIGINT"), ("branch_name", "VARCHAR"), ("branch_address", "VARCHAR")],
+    "crm_users": [
+        ("user_email", "VARCHAR"), ("primary_branch_name", "VARCHAR"),
+        ("branches", "VARCHAR"), ("active_status", "VARCHAR"),
+    ],
+}
+
+FIRST_NAMES = ["Aarav", "Sita", "Ram", "Priya", "John", "Grace", "Tunde", "Amina", "Wei", "Olivia"]
+LAST_NAMES = ["Shrestha", "Gurung", "Okafor", "Smith", "Mwangi", "Chen", "Adhikari", "Brown"]
+
+
+def fake_user_emails() -> list:
+    """Emails of the active synthetic users, in a fixed order (for the load generator)."""
+    return [f"user{i:02d}@agency.test" for i in range(len(BRANCHES) * 3)]
+
+
+def _seed_rows(rng: random.Random, rows: int) -> dict:
+    now = datetime.now().replace(microsecond=0)
+
+    def when():
+        return now - timedelta(minutes=rng.randrange(0, 2 * 365 * 24 * 60))
+
+    def name():
+        return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+    data = {
+        "application_table": [
+            (i, name(), rng.choice(BRANCHES), when(), rng.choice(APPLICATION_STATUSES),
+             rng.choice(COURSES), rng.choice(COUNTRIES))
+            for i in range(1, rows + 1)
+        ],
+        "enquiry_table": [
+            (i, name(), rng.choice(BRANCHES), when(), rng.choice(ENQUIRY_STATUSES),
+             rng.choice(["Walk-in", "Website", "Facebook", "Referral"]))
+            for i in range(1, rows + 1)
+        ],
+        "office_visits_table": [
+            (i, name(), rng.choice(BRANCHES), when(), rng.choice(["Counselling", "Documents", "Visa Query"]))
+            for i in range(1, rows + 1)
+        ],
+        "deals_applications_table": [
+            (i, name(), branch, branch, when(), rng.choice(DEAL_STATUSES),
+             rng.choice(APPLICATION_STATUSES), round(rng.uniform(500, 20000), 2))
+            for i, branch in ((i, rng.choice(BRANCHES)) for i in range(1, rows + 1))
+        ],
+        "base_contact_table": [
+            (i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), f"contact{i}@example.test", rng.choice(BRANCHES))
+            for i in range(1, rows // 5 + 1)
+        ],
+        "base_branch_table": [
+            (i, f"{branch} Branch", f"{rng.randrange(1, 200)} Main Road, {branch}")
+            for i, branch in enumerate(BRANCHES, start=1)
+        ],
+    }
+
+    users = []
+    for i, email in enumerate(fake_user_emails()):
+        primary = BRANCHES[i % len(BRANCHES)]
+        if i % 3 == 0:
+            branches = primary
+        elif i % 3 == 1:
+            branches = ", ".join([primary] + rng.sample([b for b in BRANCHES if b != primary], 2))
+        else:
+            branches = "All Branches"
+        users.append((email, primary, branches, "active"))
+    users.append(("inactive@agency.test", BRANCHES[0], BRANCHES[0], "inactive"))
+    data["crm_users"] = users
+    return data
+
+
+def _create_database(seed: int, rows: int):
+    conn = duckdb.connect(":memory:")
+    conn.execute(f"CREATE SCHEMA {DATASET_ID}")
+    for table, values in _seed_rows(random.Random(seed), rows).items():
+        columns = TABLES[table]
+        column_sql = ", ".join(f'"{name}" {col_type}' for name, col_type in columns)
+        conn.execute(f'CREATE TABLE {DATASET_ID}."{table}" ({column_sql})')
+        # Bulk insert through a DataFrame; executemany is row-at-a-time in DuckDB
+        frame = pd.DataFrame(values, columns=[name for name, _ in columns])
+        conn.register("seed_rows", frame)
+        conn.execute(f'INSERT INTO {DATASET_ID}."{table}" SELECT * FROM seed_rows')
+        conn.unregister("seed_rows")
+    return conn
+
+
+def _bq_type(duck_type: str) -> str:
+    return _BQ_TYPES.get(str(duck_type).split("(")[0].upper(), "STRING")
+
+
+class FakeRowIterator:
+    """The parts of a BigQuery RowIterator the app uses: iteration, `schema`, `total_rows`, `to_dataframe`."""
+
+    def __init__(self, schema: list, rows: list):
+        self.schema = schema
+        self._rows = rows
+        self.total_rows = len(rows)
+        self.job_id = None
+        self.query_id = None
+        self.total_bytes_processed = None
+        self.slot_millis = None
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def to_dataframe(self):
+        return pd.DataFrame([dict(row.items()) for row in self._rows], columns=[f.name for f in self.schema])
+
+
+class FakeQueryJob:
+    """A query job (or dry run) that finishes FAKE_BQ_LATENCY seconds after it is created."""
+
+    def __init__(self, client, sql: str, params: dict, dry_run: bool, max_bytes: Optional[int]):
+        self._client = client
+        self._sql = sql
+        self._params = params
+        self._created = time.time()
+        self.job_id = f"fake_job_{uuid.uuid4().hex[:12]}"
+        self.query_id = None
+        self.statement_type, self.referenced_tables = client._inspect(sql)
+        self.total_bytes_processed = client._estimate_bytes(self.referenced_tables)
+        self.total_bytes_billed = None if dry_run else self.total_bytes_processed
+        self.slot_millis = None if dry_run else int(FAKE_BQ_LATENCY * 1000)
+        self.cache_hit = False
+        self._max_bytes = max_bytes
+
+    def done(self) -> bool:
+        return time.time() - self._created >= FAKE_BQ_LATENCY
+
+    def result(self, timeout: float = None):
+        remaining = FAKE_BQ_LATENCY - (time.time() - self._created)
+        if remaining > 0:
+            if timeout is not None and remaining > timeout:
+                time.sleep(timeout)
+                raise concurrent.futures.TimeoutError()
+            time.sleep(remaining)
+        if self._max_bytes and self.total_bytes_processed > self._max_bytes:
+            raise Exception(f"Query exceeded limit for bytes billed: {self._max_bytes}")
+        return self._client._run(self._sql, self._params)
+
+    def to_arrow(self):
+        return self._client._arrow(self._sql, self._params)
+
+    def cancel(self):
+        return True
+
+
+class FakeBigQueryClient:
+    """DuckDB-backed replacement for `bigquery.Client` over a synthetic `hackathon_data`."""
+
+    def __init__(self, project: str = PROJECT_ID, seed: int = FAKE_SEED, rows: int = FAKE_BQ_ROWS):
+        self.project = project
+        self._conn = _create_database(seed, rows)
+        self._lock = threading.Lock()
+        self._row_counts = {
+            table: self._conn.execute(f'SELECT COUNT(*) FROM {DATASET_ID}."{table}"').fetchone()[0]
+            for table in TABLES
+        }
+        print(f"[FAKE BQ] Seeded {len(TABLES)} tables ({rows} rows per fact table, seed {seed})")
+
+    def _cursor(self):
+        # DuckDB cursors are independent connections to the same database, one per query
+        with self._lock:
+            return self._conn.cursor()
+
+    def _inspect(self, sql: str):
+        sql = sql.replace(f"`{PROJECT_ID}`.", "").replace(f"{PROJECT_ID}.", "")
+        try:
+            expression = sqlglot.parse_one(sql, read="bigquery")
+        except sqlglot.errors.SqlglotError as e:
+            raise Exception(f"Syntax error: {e}")
+        statement_type = "SELECT" if isinstance(expression, sqlglot.exp.Query) else expression.key.upper()
+        dataset = DatasetReference(self.project, DATASET_ID)
+        tables = {t.name for t in expression.find_all(sqlglot.exp.Table) if t.name in TABLES}
+        return statement_type, [dataset.table(name) for name in sorted(tables)]
+
+    def _estimate_bytes(self, references) -> int:
+        return sum(self._row_counts[r.table_id] * len(TABLES[r.table_id]) * BYTES_PER_CELL for r in references)
+
+    def _execute(self, sql: str, params: dict):
+        try:
+            duck_sql = translate_sql(sql)
+        except UnsupportedQuery as e:
+            raise Exception(f"Syntax error: {e}")
+        cursor = self._cursor()
+        try:
+            # Only bind the parameters the query uses; DuckDB rejects unused names
+            used = {name: value for name, value in params.items() if f"${name}" in duck_sql}
+            return cursor, cursor.execute(duck_sql, used) if used else cursor.execute(duck_sql)
+        except duckdb.Error as e:
+            cursor.close()
+            raise Exception(f"Invalid query: {e}")
+
+    def _run(self, sql: str, params: dict) -> FakeRowIterator:
+        cursor, result = self._execute(sql, params)
+        try:
+            description = result.description or []
+            schema = [SchemaField(column[0], _bq_type(column[1])) for column in description]
+            field_to_index = {field.name: i for i, field in enumerate(schema)}
+            rows = [Row(values, field_to_index) for values in result.fetchall()]
+        finally:
+            cursor.close()
+        return FakeRowIterator(schema, rows)
+
+    def _arrow(self, sql: str, params: dict):
+        cursor, result = self._execute(sql, params)
+        try:
+            return result.arrow()
+        finally:
+            cursor.close()
+
+    def query(self, query: str, job_config=None) -> FakeQueryJob:
+        params = {}
+        for param in getattr(job_config, "query_parameters", None) or []:
+            params[param.name] = param.values if hasattr(param, "values") else param.value
+        dry_run = bool(getattr(job_config, "dry_run", False))
+        max_bytes = getattr(job_config, "maximum_bytes_billed", None)
+        return FakeQueryJob(self, query, params, dry_run, max_bytes)
+
+    def query_and_wait(self, query: str, *, job_config=None, wait_timeout: float = None,
+                       api_timeout: float = None, max_results: int = None) -> FakeRowIterator:
+        """Short-query path: answered without a job, like BigQuery's optional job creation mode."""
+        job = self.query(query, job_config=job_config)
+        rows = job.result(timeout=wait_timeout)
+        rows.query_id = f"fake_query_{uuid.uuid4().hex[:12]}"
+        rows.total_bytes_processed = job.total_bytes_processed
+        rows.slot_millis = job.slot_millis
+        return rows
+
+    def list_tables(self, dataset: str):
+        dataset_ref = DatasetReference(self.project, str(dataset).split(".")[-1])
+        return [dataset_ref.table(name) for name in TABLES]
+
+    def get_table(self, table):
+        table_id = getattr(table, "table_id", None) or str(table).split(".")[-1]
+        if table_id not in TABLES:
+            raise Exception(f"Not found: Table {self.project}:{DATASET_ID}.{table_id}")
+        return SimpleNamespace(
+            table_id=table_id,
+            schema=[SchemaField(name, _bq_type(col_type)) for name, col_type in TABLES[table_id]],
+            num_rows=self._row_counts[table_id],
+            time_partitioning=None,
+            clustering_fields=None,
+        )
+
+
+# Keywords that pick the fake agent's plan and the table it queries
+_DOCUMENT_WORDS = ("document", "policy", "procedure", "process", "workflow", "guideline")
+_CHART_WORDS = ("chart", "graph", "plot", "trend", "visuali", "compare")
+_HARD_WORDS = ("which", "who", "why", "most", "versus", "ratio")
+_SESSION_BRANCHES = re.compile(r"allowed branches \(including primary and secondary\) are: (.*)\.")
+_TABLE_WORDS = [
+    ("enquir", "enquiry_table", "branch", "status"),
+    ("inquir", "enquiry_table", "branch", "status"),
+    ("visit", "office_visits_table", "visited_branch_name", "purpose"),
+    ("deal", "deals_applications_table", "deal_belongs_to_branch", "deal_status"),
+    ("", "application_table", "branch", "Status"),
+]
+
+
+def _session_branches(messages) -> Optional[list]:
+    """The allowed branches from the prompt's SESSION CONTEXT, or None for all branches."""
+    for message in messages:
+        match = _SESSION_BRANCHES.search(str(message.content))
+        if match:
+            branches = [b.strip().strip("'") for b in match.group(1).split(",") if b.strip()]
+            return None if any(b.lower() == "all branches" for b in branches) else branches
+    return None
+
+
+def _agent_plan(question: str, light: bool = False, branches: list = None) -> list:
+    """
+    Tool calls the fake model makes for a question, as (tool name, arguments).
+    Queries are filtered to the user's branches, as the prompt asks.
+    A light model writes an invalid query for "hard" questions, so the cascade escalates.
+    """
+    text = question.lower()
+    if any(word in text for word in _DOCUMENT_WORDS):
+        return [("search_documents", {"query": question})]
+
+    table, branch_col, group_col = next((t, b, g) for word, t, b, g in _TABLE_WORDS if word in text)
+    source = f"`{PROJECT_ID}.{DATASET_ID}.{table}`"
+    if branches:
+        source += f" WHERE {branch_col} IN ({', '.join(repr(b) for b in branches)})"
+    if any(word in text for word in _CHART_WORDS):
+        return [("render_chart", {
+            "chart_type": "bar",
+            "title": f"{table.replace('_table', '').replace('_', ' ').title()} by Branch",
+            "data_query": f"SELECT {branch_col}, COUNT(*) AS total FROM {source} GROUP BY 1 ORDER BY 2 DESC",
+        })]
+    if light and any(word in text for word in _HARD_WORDS):
+        return [("execute_sql", {"query": f"SELECT {group_col}_name, COUNT(*) AS total FROM {source} GROUP BY 1"})]
+    return [("execute_sql", {
+        "query": f"SELECT {group_col}, COUNT(*) AS total FROM {source} GROUP BY 1 ORDER BY 2 DESC"
+    })]
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeAgentChatModel(BaseChatModel):
+    """
+    Scripted stand-in for Gemini in the tool-calling agent. Each call looks at the
+    messages since the latest human message: while planned tool calls are missing
+    it requests the next one, then it writes a short answer from the last tool result.
+    A "lite" model fails harder questions, to exercise the model cascade.
+    """
+    model: str = "gemini-2.5-flash"
+    latency: float = FAKE_LLM_LATENCY
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-agent-chat-model"
+
+    def bind_tools(self, tools, **kwargs):
+        # The plan names tools directly, so binding only has to keep the runnable interface
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+
+        last_human = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=-1)
+        question = str(messages[last_human].content) if last_human >= 0 else ""
+        tool_results = [m for m in messages[last_human + 1:] if isinstance(m, ToolMessage)]
+        plan = _agent_plan(question, light="lite" in self.model, branches=_session_branches(messages))
+
+        if len(tool_results) < len(plan):
+            name, args = plan[len(tool_results)]
+            message = AIMessage(content="", tool_calls=[
+                {"name": name, "args": args, "id": f"call_{len(messages)}_{len(tool_results)}", "type": "tool_call"}
+            ])
+        else:
+            observation = str(tool_results[-1].content) if tool_results else ""
+            message = AIMessage(content=f"Here is what I found for \"{question}\":\n\n{observation[:600]}")
+
+        prompt_text = "".join(str(m.content) for m in messages)
+        input_tokens = _estimate_tokens(prompt_text)
+        output_tokens = _estimate_tokens(str(message.content) or str(message.tool_calls))
+        message.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def fake_embeddings():
+    """Hash-seeded embeddings: deterministic per text, no semantic meaning."""
+    return DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
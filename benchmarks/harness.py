@@ -0,0 +1,82 @@
+# harness.py
+"""
+Shared setup for the offline benchmarks. Import and call `use_fake_backends()` before
+importing the app or anything under tools/, because they read their configuration
+(FAKE_BACKENDS, CACHE_DB_PATH, ...) at import time.
+"""
+import json
+import math
+import os
+import tempfile
+
+
+def use_fake_backends(workdir: str = None) -> str:
+    """
+    Point the app at the offline fakes and a scratch directory for cache.db, the FAISS
+    index and traces, so a benchmark never touches the real files. Variables that are
+    already set are left alone. Returns the scratch directory.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="agency-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    defaults = {
+        "FAKE_BACKENDS": "1",
+        "CACHE_DB_PATH": os.path.join(workdir, "cache.db"),
+        "DOCUMENT_VECTORS_PATH": os.path.join(workdir, "document_vectors"),
+        "TRACE_EXPORT": "off",
+        "REPLICA_MODE": "off",
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    return workdir
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile (pct in 0-100) of an unsorted list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples_ms: list) -> dict:
+    return {
+        "runs": len(samples_ms),
+        "mean_ms": sum(samples_ms) / len(samples_ms) if samples_ms else 0.0,
+        "p50_ms": percentile(samples_ms, 50),
+        "p95_ms": percentile(samples_ms, 95),
+        "p99_ms": percentile(samples_ms, 99),
+    }
+
+
+def save_results(path: str, results: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"Saved results to {path}")
+
+
+def compare_results(path: str, results: dict, metric: str, tolerance: float, min_delta_ms: float = 0.1) -> list:
+    """
+    Compare `metric` of each case against a saved baseline.
+
+    Returns:
+        Names of the cases that got slower by more than `tolerance` (0.2 = 20%) and
+        by at least `min_delta_ms`, so jitter on sub-millisecond cases is not flagged.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = []
+    print(f"\n{'case':<36} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, current in results.items():
+        before = baseline.get(name, {}).get(metric)
+        if not before:
+            print(f"{name:<36} {'-':>10} {current[metric]:>10.3f} {'new':>8}")
+            continue
+        change = (current[metric] - before) / before
+        slower = change > tolerance and current[metric] - before >= min_delta_ms
+        marker = "  <- regression" if slower else ""
+        if marker:
+            regressions.append(name)
+        print(f"{name:<36} {before:>10.3f} {current[metric]:>10.3f} {change:>+7.0%}{marker}")
+    return regressions
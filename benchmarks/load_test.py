@@ -0,0 +1,187 @@
+# load_test.py
+"""
+Concurrent /chat load generator. Reports p50/p95/p99 latency, throughput and, in
+process, the outcome breakdown (routed / cache_hit / agent / error ...).
+
+By default the app is imported in this process with the offline fakes (FAKE_BACKENDS=1)
+and driven through Flask test clients, so it needs no network or credentials:
+    python -m benchmarks.load_test --requests 200 --concurrency 8
+    FAKE_LLM_LATENCY=0.8 FAKE_BQ_LATENCY=0.3 python -m benchmarks.load_test   # realistic waits
+
+With --url it drives a running server instead (log in with --email, repeatable):
+    python -m benchmarks.load_test --url http://localhost:5000 --email someone@agency.com
+"""
+import argparse
+import contextlib
+import http.cookiejar
+import json
+import os
+import random
+import threading
+import time
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.harness import use_fake_backends, summarize
+
+# Mix of questions: routed fast paths, agent SQL, charts and document search
+QUESTIONS = [
+    ("routed", "how many applications by status"),
+    ("routed", "enquiries by branch this year"),
+    ("routed", "what are my branches"),
+    ("agent", "which deals are open and what is their status"),
+    ("agent", "who made the most office visits recently"),
+    ("agent", "compare applications with discontinued ones"),
+    ("chart", "show a chart of enquiries by branch"),
+    ("chart", "plot deals by branch"),
+    ("docs", "what is the process to create a new enquiry in the CRM"),
+    ("docs", "explain the refund policy document"),
+]
+OUTCOMES = ("routed", "cache_hit", "agent", "budget", "rejected", "too_big", "quota", "error")
+CASCADE_TIERS = ("router", "light", "full")
+
+
+class InProcessTarget:
+    """Calls the app through Flask test clients, one signed-in client per request."""
+
+    def __init__(self):
+        import app as chat_app
+        from benchmarks.fakes import fake_user_emails
+        self._app = chat_app.app
+        directory = chat_app.user_directory
+        self._users = [u for u in (directory.lookup(e, require_active=True) for e in fake_user_emails()) if u]
+
+    def user_count(self) -> int:
+        return len(self._users)
+
+    def chat(self, user_index: int, message: str):
+        user = self._users[user_index % len(self._users)]
+        client = self._app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_email"] = user["user_email"]
+            sess["primary_branch"] = user["primary_branch"]
+            sess["allowed_branches_raw"] = user["branches"]
+        response = client.post("/chat", json={"message": message})
+        return response.status_code
+
+    @staticmethod
+    def outcome_counts() -> dict:
+        from prometheus_client import REGISTRY
+        counts = {o: REGISTRY.get_sample_value("chat_request_seconds_count", {"outcome": o}) or 0 for o in OUTCOMES}
+        for tier in CASCADE_TIERS:
+            for result in ("accepted", "escalated"):
+                counts[f"{tier} {result}"] = REGISTRY.get_sample_value(
+                    "model_cascade_results_total", {"tier": tier, "result": result}) or 0
+        return counts
+
+
+class HttpTarget:
+    """Calls a running server over HTTP with one cookie session per email."""
+
+    def __init__(self, url: str, emails: list):
+        self._url = url.rstrip("/")
+        self._openers = []
+        for email in emails:
+            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+            status, body = self._post(opener, "/api/login", {"email": email})
+            if status != 200 or not body.get("success"):
+                raise SystemExit(f"Login failed for {email}: {body}")
+            self._openers.append(opener)
+
+    def _post(self, opener, path: str, payload: dict):
+        request = urllib.request.Request(
+            self._url + path, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}
+        )
+        try:
+            with opener.open(request, timeout=300) as response:
+                return response.status, json.loads(response.read() or b"{}")
+        except urllib.error.HTTPError as e:
+            return e.code, {}
+
+    def user_count(self) -> int:
+        return len(self._openers)
+
+    def chat(self, user_index: int, message: str):
+        status, _ = self._post(self._openers[user_index % len(self._openers)], "/chat", {"message": message})
+        return status
+
+    @staticmethod
+    def outcome_counts() -> dict:
+        return {}
+
+
+def run_load(target, total: int, concurrency: int, unique: bool, seed: int) -> dict:
+    rng = random.Random(seed)
+    plan = [(i, rng.randrange(target.user_count()), rng.choice(QUESTIONS)) for i in range(total)]
+    latencies, kinds, statuses = [], {}, Counter()
+    lock = threading.Lock()
+
+    def one(item):
+        index, user_index, (kind, question) = item
+        # A unique suffix defeats the response cache so every agent question runs the agent
+        message = f"{question} (request {index})" if unique and kind != "routed" else question
+        started = time.perf_counter()
+        try:
+            status = target.chat(user_index, message)
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            kinds.setdefault(kind, []).append(elapsed)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, plan))
+    wall = time.perf_counter() - started
+    return {"wall_seconds": wall, "latencies": latencies, "kinds": kinds, "statuses": statuses}
+
+
+def report(result: dict, outcomes_before: dict, outcomes_after: dict, concurrency: int):
+    overall = summarize(result["latencies"])
+    print(f"\n{overall['runs']} requests, concurrency {concurrency}, {result['wall_seconds']:.2f}s wall")
+    print(f"Throughput: {overall['runs'] / result['wall_seconds']:.1f} req/s")
+    print(f"\n{'questions':<12} {'count':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    rows = [("all", overall)] + [(kind, summarize(values)) for kind, values in sorted(result["kinds"].items())]
+    for name, stats in rows:
+        print(f"{name:<12} {stats['runs']:>6} {stats['p50_ms']:>10.1f} {stats['p95_ms']:>10.1f} {stats['p99_ms']:>10.1f}")
+    print(f"\nHTTP status: {dict(result['statuses'])}")
+    if outcomes_after:
+        delta = {name: int(outcomes_after[name] - outcomes_before.get(name, 0)) for name in outcomes_after}
+        print(f"Outcomes: {', '.join(f'{o}={delta[o]}' for o in OUTCOMES if delta[o])}")
+        print(f"Cascade: {', '.join(f'{name}={n}' for name, n in delta.items() if n and name not in OUTCOMES)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent /chat load generator")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--unique", action="store_true", help="Make agent questions unique to bypass the response cache")
+    parser.add_argument("--seed", type=int, default=7, help="Seed for the question/user mix")
+    parser.add_argument("--url", help="Drive a running server instead of the in-process app with fakes")
+    parser.add_argument("--email", action="append", default=[], help="Login email for --url (repeatable)")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's console output")
+    args = parser.parse_args()
+
+    if args.url:
+        if not args.email:
+            parser.error("--url needs at least one --email to log in with")
+        target = HttpTarget(args.url, args.email)
+    else:
+        use_fake_backends()
+        print("Starting the app with offline backends...")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            target = InProcessTarget()
+
+    outcomes_before = target.outcome_counts()
+    with open(os.devnull, "w") as devnull, contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        result = run_load(target, args.requests, args.concurrency, args.unique, args.seed)
+    report(result, outcomes_before, target.outcome_counts(), args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
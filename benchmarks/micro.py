@@ -0,0 +1,126 @@
+# micro.py
+"""
+Micro-benchmarks for the hot paths behind /chat, run offline against the fakes:
+CacheManager get/set, search_documents_rag (FAISS), generate_plot_image and the
+visualization output parser.
+
+Run from the project root:
+    python -m benchmarks.micro
+    python -m benchmarks.micro --save baseline.json
+    python -m benchmarks.micro --compare baseline.json   # exit code 1 on a regression
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+from benchmarks.harness import use_fake_backends, summarize, save_results, compare_results
+
+use_fake_backends()
+
+# Imported after the environment is set (these modules read it at import time)
+from langchain_community.vectorstores import FAISS  # noqa: E402
+from benchmarks.fakes import fake_embeddings, COURSES, COUNTRIES, BRANCHES  # noqa: E402
+from cache.cache_manager import CacheManager  # noqa: E402
+from tools import document_rag  # noqa: E402
+from tools.agent_tools import generate_plot_image  # noqa: E402
+from tools.request_context import set_request_branches  # noqa: E402
+from services.output_parser import parse_visualization  # noqa: E402
+from script_runners.benchmark_output_parser import SAMPLES, long_answer  # noqa: E402
+
+DOCUMENT_CHUNKS = 2000
+CHART_QUERY = (
+    "SELECT branch, COUNT(*) AS total FROM `expert-hackathon-2026.hackathon_data.application_table` "
+    "GROUP BY 1 ORDER BY 2 DESC"
+)
+SEARCH_QUERIES = [
+    "How do I create a new enquiry?", "visa application checklist", "refund policy for deposits",
+    "steps to convert an enquiry into a deal", "office visit feedback process",
+]
+
+
+def measure(func, runs: int, warmup: int = 2) -> dict:
+    """Call `func(i)` `runs` times after a warmup and summarize the wall times."""
+    samples = []
+    # The app logs every query and cache miss; keep it out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(warmup):
+            func(i)
+        for i in range(runs):
+            started = time.perf_counter()
+            func(i)
+            samples.append((time.perf_counter() - started) * 1000)
+    return summarize(samples)
+
+
+def build_document_index():
+    """A synthetic FAISS index (the real one needs the PDFs and Gemini embeddings)."""
+    texts = [
+        f"Section {i}: students applying for {COURSES[i % len(COURSES)]} in {COUNTRIES[i % len(COUNTRIES)]} "
+        f"should visit the {BRANCHES[i % len(BRANCHES)]} branch with their documents. " * 4
+        for i in range(DOCUMENT_CHUNKS)
+    ]
+    metadatas = [{"source_file": f"manual_{i % 7}.pdf", "page": i % 40} for i in range(DOCUMENT_CHUNKS)]
+    document_rag.vector_store = FAISS.from_texts(texts, fake_embeddings(), metadatas=metadatas)
+
+
+def run_benchmarks(scale: float) -> dict:
+    runs = lambda n: max(3, int(n * scale))
+    cache = CacheManager()
+    payload = {"output": "x" * 2000, "intermediate_steps": [], "charts": []}
+    cache.set("bench", {"key": "hit"}, payload)
+
+    build_document_index()
+    # The RAG function is @cached; __wrapped__ measures the FAISS search itself
+    uncached_search = document_rag.search_documents_rag.__wrapped__
+
+    parser_corpus = list(SAMPLES.values())
+    long_text = long_answer(2000)
+
+    cases = {
+        "cache.get (hit)": (lambda i: cache.get("bench", {"key": "hit"}), runs(500)),
+        "cache.get (miss)": (lambda i: cache.get("bench", {"key": f"miss-{i}"}), runs(500)),
+        "cache.set": (lambda i: cache.set("bench", {"key": f"set-{i}"}, payload), runs(300)),
+        "search_documents_rag (faiss)": (
+            lambda i: uncached_search(SEARCH_QUERIES[i % len(SEARCH_QUERIES)] + f" #{i}"), runs(200)),
+        "search_documents_rag (cached)": (
+            lambda i: document_rag.search_documents_rag(SEARCH_QUERIES[i % len(SEARCH_QUERIES)]), runs(500)),
+        "generate_plot_image (bar)": (lambda i: generate_plot_image(CHART_QUERY, "bar", "Bench"), runs(15)),
+        "generate_plot_image (pie)": (lambda i: generate_plot_image(CHART_QUERY, "pie", "Bench"), runs(15)),
+        "parse_visualization (samples)": (
+            lambda i: [parse_visualization(text) for text in parser_corpus], runs(500)),
+        "parse_visualization (long answer)": (lambda i: parse_visualization(long_text), runs(50)),
+    }
+
+    results = {}
+    print(f"{'case':<36} {'runs':>6} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for name, (func, count) in cases.items():
+        stats = measure(func, count)
+        results[name] = stats
+        print(f"{name:<36} {stats['runs']:>6} {stats['mean_ms']:>10.3f} {stats['p50_ms']:>10.3f} {stats['p95_ms']:>10.3f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks for the /chat hot paths")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the number of runs per case")
+    parser.add_argument("--save", help="Write the results to this JSON file (a baseline)")
+    parser.add_argument("--compare", help="Compare p50 against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before flagging (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    # Agent SQL is scoped to the request's branches; benchmark as an all-branches user
+    set_request_branches(None)
+    results = run_benchmarks(args.scale)
+    if args.save:
+        save_results(args.save, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, "p50_ms", args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
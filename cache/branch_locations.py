@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+REFRESH_SECONDS = int(os.environ.get("BRANCH_LOCATIONS_REFRESH_SECONDS", 3600))
+# Optional JSON file of extra places: {"city or suburb": {"lat": .., "lng": ..}, ...}
+GAZETTEER_FILE = os.environ.get("BRANCH_GAZETTEER_PATH", "branch_gazetteer.json")
+
+BRANCHES_QUERY = """
+    SELECT
+        branch_id,
+        branch_name,
+        branch_address
+    FROM `hackathon_data.base_branch_table`
+    LIMIT 50
+"""
+
+# Known branch locations. Order matters: when several places appear in the same
+# text, the one listed first wins.
+BASE_GAZETTEER = {
+    'johannesburg': {'lat': -26.2041, 'lng': 28.0473},
+    'lagos': {'lat': 6.5244, 'lng': 3.3792},
+    'yaba': {'lat': 6.5244, 'lng': 3.3792},
+    'port harcourt': {'lat': 4.8156, 'lng': 7.0498},
+    'nairobi': {'lat': -1.2921, 'lng': 36.8219},
+    'accra': {'lat': 5.6037, 'lng': -0.1870},
+    'kampala': {'lat': 0.3476, 'lng': 32.5825},
+    'dar es salaam': {'lat': -6.7924, 'lng': 39.2083},
+    'kigali': {'lat': -1.9706, 'lng': 30.1044},
+    'kathmandu': {'lat': 27.7172, 'lng': 85.3240},
+    'putalisadak': {'lat': 27.7172, 'lng': 85.3240},
+    'pokhara': {'lat': 28.2096, 'lng': 83.9856},
+    'chitwan': {'lat': 27.5291, 'lng': 84.3542},
+    'sydney': {'lat': -33.8688, 'lng': 151.2093},
+    'parramatta': {'lat': -33.8151, 'lng': 151.0000},
+    'melbourne': {'lat': -37.8136, 'lng': 144.9631},
+    'brisbane': {'lat': -27.4698, 'lng': 153.0251},
+    'perth': {'lat': -31.9505, 'lng': 115.8605},
+    'adelaide': {'lat': -34.9285, 'lng': 138.6007},
+    'abuja': {'lat': 9.0765, 'lng': 7.3986},
+    'ibadan': {'lat': 7.3775, 'lng': 3.9470},
+    'kano': {'lat': 12.0022, 'lng': 8.5920},
+}
+
+
+def load_gazetteer(path: str = GAZETTEER_FILE) -> dict:
+    """Built-in places followed by any extra entries from the local gazetteer file."""
+    gazetteer = dict(BASE_GAZETTEER)
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                extra = json.load(f)
+            for name, coords in extra.items():
+                gazetteer.setdefault(name.lower().strip(), {"lat": float(coords["lat"]), "lng": float(coords["lng"])})
+            print(f"[BRANCH LOCATIONS] Loaded {len(extra)} gazetteer entries from {path}")
+        except Exception as e:
+            print(f"[BRANCH LOCATIONS] Ignoring gazetteer file {path}: {e}")
+    return gazetteer
+
+
+class PlaceMatcher:
+    """
+    Aho-Corasick automaton over gazetteer names. One pass over the text finds every
+    place name it contains; the earliest gazetteer entry among them is returned.
+    """
+
+    def __init__(self, gazetteer: dict):
+        self._places = list(gazetteer.items())
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]  # Gazetteer indexes ending at each state
+
+        for index, (name, _) in enumerate(self._places):
+            state = 0
+            for ch in name:
+                if ch not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][ch] = len(self._goto) - 1
+                state = self._goto[state][ch]
+            self._out[state].append(index)
+
+        # Breadth-first pass to build failure links
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[nxt] = self._goto[fallback].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def match(self, text: str):
+        """Return the coordinates of the first-listed place found in `text`, or None."""
+        if not text:
+            return None
+        best = None
+        state = 0
+        for ch in text.lower():
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            for index in self._out[state]:
+                if best is None or index < best:
+                    best = index
+                    if best == 0:
+                        return self._places[0][1]
+        return None if best is None else self._places[best][1]
+
+
+class BranchLocations:
+    """
+    Precomputed `/api/branches` response. Branches are geocoded once per refresh
+    interval and served as ready-made JSON with an ETag.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(BranchLocations, cls).__new__(cls)
+            cls._instance._matcher = PlaceMatcher(load_gazetteer())
+            cls._instance._snapshot = None  # (body bytes, etag)
+            cls._instance._lock = threading.Lock()
+            cls._instance._refresh_thread = None
+        return cls._instance
+
+    def _client(self):
+        # Resolved at call time so a replaced client (e.g. in benchmarks) is picked up
+        from tools import agent_tools
+        return agent_tools.bq_client
+
+    def build(self):
+        """Query branches, geocode them and store the serialized response."""
+        started = time.time()
+        branches = []
+        for row in self._client().query(BRANCHES_QUERY).result():
+            # Try the name first, then the address
+            coords = self._matcher.match(row.branch_name) or self._matcher.match(row.branch_address)
+            # Only add branches with valid coordinates
+            if coords:
+                branches.append({
+                    'id': row.branch_id,
+                    'name': row.branch_name,
+                    'address': row.branch_address,
+                    'lat': coords['lat'],
+                    'lng': coords['lng']
+                })
+
+        body = json.dumps({'success': True, 'branches': branches, 'count': len(branches)}).encode("utf-8")
+        etag = hashlib.sha1(body).hexdigest()
+        self._snapshot = (body, etag)
+        print(f"[BRANCH LOCATIONS] Indexed {len(branches)} branches in {time.time() - started:.2f}s")
+        return self._snapshot
+
+    def snapshot(self):
+        """Return (body, etag), building it on first use if the background load has not finished."""
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self.build()
+        return self._snapshot
+
+    def start_refresh(self, interval: int = REFRESH_SECONDS):
+        """Build now and then every `interval` seconds in a daemon thread (idempotent)."""
+        if self._refresh_thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    with self._lock:
+                        self.build()
+                except Exception as e:
+                    print(f"[BRANCH LOCATIONS] Refresh failed: {e}")
+                time.sleep(interval)
+
+        self._refresh_thread = threading.Thread(target=loop, name="branch-locations-refresh", daemon=True)
+        self._refresh_thread.start()
@@ -4,8 +4,10 @@ import hashlib
 import os
 from functools import wraps
 from typing import Any, Optional
+from monitoring.tracing import span, annotate
+from monitoring.metrics import CACHE_LOOKUPS
 
-DB_PATH = "cache.db"
+DB_PATH = os.environ.get("CACHE_DB_PATH", "cache.db")
 
 class CacheManager:
     _instance = None
@@ -36,37 +38,47 @@ class CacheManager:
         combined = f"{func_name}:{serialized_args}"
         return hashlib.sha256(combined.encode()).hexdigest()
     
-    def get(self, func_name: str, args_dict: dict) -> Optional[Any]:
-        """Retrieve a value from the cache."""
+    def get(self, func_name: str, args_dict: dict, max_age_seconds: int = None) -> Optional[Any]:
+        """Retrieve a value from the cache, ignoring entries older than `max_age_seconds` if given."""
         key = self._generate_key(func_name, args_dict)
         data = None
         
-        try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT value FROM cache WHERE key = ?", (key,))
-                row = cursor.fetchone()
-                if row:
-                    data = json.loads(row[0])
-        except Exception as e:
-            print(f"Cache get error: {e}")
+        with span("cache.get", func=func_name):
+            try:
+                with sqlite3.connect(DB_PATH) as conn:
+                    cursor = conn.cursor()
+                    if max_age_seconds is None:
+                        cursor.execute("SELECT value FROM cache WHERE key = ?", (key,))
+                    else:
+                        cursor.execute(
+                            "SELECT value FROM cache WHERE key = ? AND created_at >= datetime('now', ?)",
+                            (key, f"-{int(max_age_seconds)} seconds")
+                        )
+                    row = cursor.fetchone()
+                    if row:
+                        data = json.loads(row[0])
+            except Exception as e:
+                print(f"Cache get error: {e}")
+            annotate(hit=data is not None)
+            CACHE_LOOKUPS.labels(func_name, "hit" if data is not None else "miss").inc()
             
         return data
 
     def set(self, func_name: str, args_dict: dict, value: Any):
         """Save a value to the cache."""
         key = self._generate_key(func_name, args_dict)
-        try:
-            serialized_value = json.dumps(value)
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", 
-                    (key, serialized_value)
-                )
-                conn.commit()
-        except Exception as e:
-            print(f"Cache set error: {e}")
+        with span("cache.set", func=func_name):
+            try:
+                serialized_value = json.dumps(value)
+                with sqlite3.connect(DB_PATH) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", 
+                        (key, serialized_value)
+                    )
+                    conn.commit()
+            except Exception as e:
+                print(f"Cache set error: {e}")
 
 # Decorator for easy usage
 def cached(func):
@@ -0,0 +1,298 @@
+# shared_results.py
+"""
+Branch-agnostic aggregate results shared across users.
+
+Users with different branch sets asking the same aggregate question used to run the
+same scan once each. Here the query runs once for every branch, grouped by branch,
+and the rows are cached for SHARED_RESULT_TTL_SECONDS. Each user's answer is derived
+in process by keeping their branches and re-aggregating, so access control still
+holds and the warehouse sees one query per question instead of one per user.
+
+Queries are shared when they are a plain single-table aggregate:
+  - one `<branch column> IN ('...')` (or `= '...'`, or `LOWER(<branch column>) IN (...)` as
+    the SQL rewriter writes it) filter joined to the rest of the WHERE by AND
+  - only COUNT, SUM, MIN and MAX aggregates, every other selected column in the GROUP BY
+  - no joins, subqueries, DISTINCT, HAVING, window functions or OFFSET
+Anything else (and everything when sqlglot is missing) runs as before.
+"""
+import datetime
+import decimal
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from cache.cache_manager import CacheManager
+from db.catalog import branch_column
+from db.rollups import ROLLUP_DATASET
+from monitoring.tracing import span, annotate
+
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:  # Optional dependency; agent SQL is not shared without it
+    sqlglot = None
+
+SHARED_RESULTS_ENABLED = os.environ.get("SHARED_RESULTS_ENABLED", "1") == "1"
+SHARED_RESULT_TTL_SECONDS = int(os.environ.get("SHARED_RESULT_TTL_SECONDS", 600))
+SHARED_RESULT_MAX_ROWS = int(os.environ.get("SHARED_RESULT_MAX_ROWS", 5000))  # Larger results are not shared
+
+BRANCH_KEY = "_branch"
+
+_inflight = {}  # Query key -> [lock, number of callers holding or waiting for it]
+_inflight_lock = threading.Lock()
+
+
+class SharedQuery:
+    """
+    A branch-agnostic query plus what is needed to slice its rows for one user.
+
+    Attributes:
+        sql: The query without the branch filter, with the branch selected as `_branch`.
+        params: BigQuery query parameters of `sql`.
+        branches: Branch names to keep, or None for all branches (matched case-insensitively).
+        columns: Output column names, in order.
+        keys: Output columns the rows are grouped by.
+        measures: Output column -> how to combine it across branches ("count", "sum", "min", "max").
+        order: (column, descending) pairs to sort the sliced rows by.
+        limit: Row limit of the original query, if any.
+    """
+
+    def __init__(self, sql: str, branches, columns: list, keys: list, measures: dict,
+                 order: list = None, limit: int = None, params: list = None):
+        self.sql = sql
+        self.params = params or []
+        self.branches = None if branches is None else {b.lower() for b in branches}
+        self.columns = columns
+        self.keys = keys
+        self.measures = measures
+        self.order = order or []
+        self.limit = limit
+
+
+def _conjuncts(condition) -> list:
+    if isinstance(condition, exp.And):
+        return _conjuncts(condition.left) + _conjuncts(condition.right)
+    return [condition]
+
+
+def _branch_values(condition, column: str):
+    """The literal branch names of a `[LOWER(]column[)] IN (...)` / `column = '...'` filter, else None."""
+    if isinstance(condition, exp.In) and not condition.args.get("query") and not condition.args.get("unnest"):
+        target, values = condition.this, condition.expressions
+    elif isinstance(condition, exp.EQ):
+        target, values = condition.this, [condition.expression]
+    else:
+        return None
+    if isinstance(target, (exp.Lower, exp.Upper)):
+        target = target.this
+    if not isinstance(target, exp.Column) or target.name.lower() != column.lower():
+        return None
+    if not values or not all(isinstance(v, exp.Literal) and v.is_string for v in values):
+        return None
+    return [v.this for v in values]
+
+
+_COMBINE = {exp.Count: "count", exp.Sum: "sum", exp.Min: "min", exp.Max: "max"}
+
+
+def plan_shared_query(query: str) -> Optional[SharedQuery]:
+    """
+    Rewrite a branch-filtered aggregate query into its branch-agnostic form.
+
+    Returns:
+        A SharedQuery, or None if the query cannot be shared.
+    """
+    if sqlglot is None or not SHARED_RESULTS_ENABLED:
+        return None
+    try:
+        tree = sqlglot.parse_one(query.strip().rstrip(";"), read="bigquery")
+    except sqlglot.errors.SqlglotError:
+        return None
+    if not isinstance(tree, exp.Select) or tree.args.get("with") or tree.args.get("joins"):
+        return None
+    if any(tree.args.get(arg) for arg in ("distinct", "having", "qualify", "offset")):
+        return None
+    if tree.find(exp.Window) or tree.find(exp.Subquery) or any(item.is_star for item in tree.expressions):
+        return None
+    source = (tree.args.get("from_") or tree.args.get("from") or exp.From()).this
+    if not isinstance(source, exp.Table):
+        return None
+    column = "branch" if source.db == ROLLUP_DATASET else branch_column(source.name)
+    where = tree.args.get("where")
+    if not column or where is None:
+        return None
+
+    conditions = _conjuncts(where.this)
+    filters = [(c, _branch_values(c, column)) for c in conditions]
+    branch_filters = [(c, values) for c, values in filters if values is not None]
+    if len(branch_filters) != 1:
+        return None
+    branch_filter, branches = branch_filters[0]
+
+    # Output columns: aggregates become measures, everything else must be grouped by
+    columns, selected, measures, anonymous = [], [], {}, 0
+    for item in tree.expressions:
+        inner = item.this if isinstance(item, exp.Alias) else item
+        if isinstance(item, exp.Alias):
+            name = item.alias
+        elif isinstance(inner, exp.Column):
+            name = inner.name
+        else:
+            name, anonymous = f"f{anonymous}_", anonymous + 1  # BigQuery's name for unaliased columns
+        combine = _COMBINE.get(type(inner))
+        if combine:
+            if isinstance(inner.this, exp.Distinct) or inner.this.find(exp.AggFunc):
+                return None  # COUNT(DISTINCT) cannot be added up across branches
+            measures[name] = combine
+        elif inner.find(exp.AggFunc):
+            return None  # e.g. AVG or ROUND(SUM(x)) cannot be re-aggregated
+        columns.append(name)
+        selected.append(inner)
+
+    def resolve(expression):
+        """Map a GROUP BY / ORDER BY item (ordinal, alias or expression) to an output column."""
+        if isinstance(expression, exp.Literal) and not expression.is_string:
+            index = int(expression.this) - 1
+            return columns[index] if 0 <= index < len(columns) else None
+        if isinstance(expression, exp.Column) and not expression.table and expression.name in columns:
+            return expression.name
+        return next((name for name, inner in zip(columns, selected) if inner == expression), None)
+
+    group = tree.args.get("group")
+    keys = [resolve(e) for e in (group.expressions if group else [])]
+    if None in keys or set(keys) != {name for name in columns if name not in measures}:
+        return None
+
+    order = []
+    for item in (tree.args["order"].expressions if tree.args.get("order") else []):
+        name = resolve(item.this)
+        if name is None:
+            return None
+        order.append((name, bool(item.args.get("desc"))))
+
+    limit = None
+    if tree.args.get("limit"):
+        limit_value = tree.args["limit"].expression
+        if not isinstance(limit_value, exp.Literal) or limit_value.is_string:
+            return None
+        limit = int(limit_value.this)
+
+    shared = tree.copy()
+    remaining = [c.copy() for c in conditions if c is not branch_filter]
+    shared.set("where", exp.Where(this=exp.and_(*remaining)) if remaining else None)
+    branch_expr = exp.column(column)
+    shared.set("expressions", [exp.alias_(branch_expr, BRANCH_KEY)] + [
+        exp.alias_(inner.copy(), name) for name, inner in zip(columns, selected)
+    ])
+    group_by = [branch_expr]
+    for name, inner in zip(columns, selected):
+        if name not in measures and inner not in group_by:
+            group_by.append(inner)
+    shared.set("group", exp.Group(expressions=[e.copy() for e in group_by]))
+    shared.set("order", None)
+    shared.set("limit", None)
+    return SharedQuery(shared.sql(dialect="bigquery"), branches, columns, keys, measures, order, limit)
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _combine(kind: str, current, value):
+    if value is None:
+        return current
+    if current is None:
+        return value
+    if kind in ("count", "sum"):
+        return current + value
+    return min(current, value) if kind == "min" else max(current, value)
+
+
+def slice_rows(plan: SharedQuery, rows: list) -> list:
+    """Keep the plan's branches, re-aggregate across them, then apply its ORDER BY and LIMIT."""
+    groups = {}
+    for row in rows:
+        if plan.branches is not None and str(row[BRANCH_KEY] or "").lower() not in plan.branches:
+            continue
+        key = tuple(row[name] for name in plan.keys)
+        merged = groups.get(key)
+        if merged is None:
+            groups[key] = {name: row[name] for name in plan.columns}
+            continue
+        for name, kind in plan.measures.items():
+            merged[name] = _combine(kind, merged[name], row[name])
+
+    result = list(groups.values())
+    if not result and not plan.keys:
+        # An ungrouped aggregate always returns one row
+        result = [{name: 0 if plan.measures.get(name) == "count" else None for name in plan.columns}]
+    # BigQuery sorts NULLs first ascending and last descending
+    for name, descending in reversed(plan.order):
+        result.sort(key=lambda r: (r[name] is not None, r[name] if r[name] is not None else 0), reverse=descending)
+    return result[:plan.limit] if plan.limit is not None else result
+
+
+@contextmanager
+def _single_flight(key: str):
+    """Hold the per-query lock; the entry is dropped once no caller holds or waits for it."""
+    with _inflight_lock:
+        entry = _inflight.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _inflight_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _inflight[key]
+
+
+def _cache_key(plan: SharedQuery) -> dict:
+    return {"sql": plan.sql, "params": [p.to_api_repr() for p in plan.params]}
+
+
+def shared_result_cached(plan: SharedQuery) -> bool:
+    """True if the plan's shared result is cached and still fresh."""
+    cached = CacheManager().get("shared_result", _cache_key(plan), max_age_seconds=SHARED_RESULT_TTL_SECONDS)
+    return cached is not None
+
+
+def fetch_shared(plan: SharedQuery, run) -> Optional[list]:
+    """
+    Rows of the plan's shared query for the plan's branches, from the cache or one run.
+
+    Args:
+        plan: The shared query and how to slice it.
+        run: `run(sql, params, row_limit)` returning mapping-like rows.
+
+    Returns:
+        The user's rows as dicts, or None if the shared result is too large to share.
+    """
+    cache = CacheManager()
+    cache_key = _cache_key(plan)
+    with span("shared_result", branches=None if plan.branches is None else len(plan.branches)):
+        cached = cache.get("shared_result", cache_key, max_age_seconds=SHARED_RESULT_TTL_SECONDS)
+        if cached is None:
+            # Concurrent users asking the same question wait for one query instead of each running it
+            with _single_flight(plan.sql + json.dumps(cache_key["params"], sort_keys=True)):
+                cached = cache.get("shared_result", cache_key, max_age_seconds=SHARED_RESULT_TTL_SECONDS)
+                if cached is None:
+                    rows = [
+                        {name: _json_value(value) for name, value in row.items()}
+                        for row in run(plan.sql, plan.params, SHARED_RESULT_MAX_ROWS + 1)
+                    ]
+                    cached = {"rows": rows if len(rows) <= SHARED_RESULT_MAX_ROWS else None}
+                    cache.set("shared_result", cache_key, cached)
+        annotate(shared_rows=None if cached["rows"] is None else len(cached["rows"]))
+        if cached["rows"] is None:
+            return None
+        return slice_rows(plan, cached["rows"])
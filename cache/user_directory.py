@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from typing import Optional
+from google.cloud import bigquery
+
+REFRESH_SECONDS = int(os.environ.get("USER_DIRECTORY_REFRESH_SECONDS", 300))
+NEGATIVE_TTL_SECONDS = 60  # How long an unknown email is remembered before asking BigQuery again
+
+ALL_USERS_QUERY = """
+    SELECT user_email, primary_branch_name, branches, active_status
+    FROM `hackathon_data.crm_users`
+"""
+
+ONE_USER_QUERY = """
+    SELECT user_email, primary_branch_name, branches, active_status
+    FROM `hackathon_data.crm_users`
+    WHERE user_email = @email
+    ORDER BY IF(active_status = 'active', 0, 1)
+    LIMIT 1
+"""
+
+
+class UserDirectory:
+    """
+    In-memory index of `crm_users` for login and profile checks.
+    Bulk-loaded in the background and refreshed periodically; BigQuery is only hit on a miss.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(UserDirectory, cls).__new__(cls)
+            cls._instance._users = {}
+            cls._instance._misses = {}
+            cls._instance._loaded_at = None
+            cls._instance._refresh_thread = None
+        return cls._instance
+
+    def _client(self):
+        # Resolved at call time so a replaced client (e.g. in benchmarks) is picked up
+        from tools import agent_tools
+        return agent_tools.bq_client
+
+    @staticmethod
+    def _record(row) -> dict:
+        return {
+            "user_email": row.user_email,
+            "primary_branch": row.primary_branch_name,
+            "branches": row.branches or "",
+            "active": row.active_status == "active",
+        }
+
+    def load_all(self):
+        """Bulk-load every user. The new index replaces the old one in a single assignment."""
+        started = time.time()
+        users = {}
+        for row in self._client().query(ALL_USERS_QUERY).result():
+            record = self._record(row)
+            existing = users.get(record["user_email"])
+            # Keep the active row when an email appears more than once
+            if existing is None or (record["active"] and not existing["active"]):
+                users[record["user_email"]] = record
+        self._users = users
+        self._misses = {}
+        self._loaded_at = time.time()
+        print(f"[USER DIRECTORY] Loaded {len(users)} users in {time.time() - started:.2f}s")
+
+    def lookup(self, email: str, require_active: bool = False) -> Optional[dict]:
+        """
+        Return the user record for an email, or None.
+
+        Args:
+            email: The user's email (exact match, as in crm_users).
+            require_active: Only return users whose active_status is 'active'.
+        """
+        if not email:
+            return None
+
+        record = self._users.get(email)
+        if record is None:
+            missed_at = self._misses.get(email)
+            if missed_at and time.time() - missed_at < NEGATIVE_TTL_SECONDS:
+                return None
+            record = self._fetch_one(email)
+
+        if record is None or (require_active and not record["active"]):
+            return None
+        return record
+
+    def _fetch_one(self, email: str) -> Optional[dict]:
+        print(f"[USER DIRECTORY] Miss for {email}, querying BigQuery")
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("email", "STRING", email)]
+        )
+        results = list(self._client().query(ONE_USER_QUERY, job_config=job_config).result())
+        if not results:
+            self._misses[email] = time.time()
+            return None
+        record = self._record(results[0])
+        self._users = {**self._users, email: record}
+        return record
+
+    def start_refresh(self, interval: int = REFRESH_SECONDS):
+        """Load now and then every `interval` seconds in a daemon thread (idempotent)."""
+        if self._refresh_thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.load_all()
+                except Exception as e:
+                    print(f"[USER DIRECTORY] Refresh failed: {e}")
+                time.sleep(interval)
+
+        self._refresh_thread = threading.Thread(target=loop, name="user-directory-refresh", daemon=True)
+        self._refresh_thread.start()
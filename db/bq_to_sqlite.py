@@ -1,24 +1,352 @@
 # bq_to_sqlite.py
+"""
+Bulk export of `hackathon_data` into a local SQLite file.
+
+Tables are read concurrently as Arrow record batches (through the BigQuery Storage
+Read API when `google-cloud-bigquery-storage` is installed) and streamed into SQLite
+by a single writer with `executemany`, one transaction per batch.
+
+Tables with a creation timestamp are copied incrementally from their last watermark.
+Rows edited in place (application and deal statuses) keep their creation time, so a
+table whose last full copy is older than FULL_REFRESH_HOURS is copied whole again.
+
+Run from the project root:
+    python -m db.bq_to_sqlite                 # incremental where possible, full once a day
+    python -m db.bq_to_sqlite --full          # re-copy every table
+    python -m db.bq_to_sqlite --resume        # continue an interrupted run
+    python -m db.bq_to_sqlite --tables application_table enquiry_table
+"""
+import argparse
+import json
+import queue
 import sqlite3
-import pandas as pd
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+
+import pyarrow as pa
 from google.cloud import bigquery
 
+from db.replica import WATERMARK_COLUMNS
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:  # Falls back to the REST tabledata API
+    bigquery_storage = None
+
 PROJECT_ID = "expert-hackathon-2026"
 DATASET_ID = "hackathon_data"  # your dataset
 SQLITE_FILE = "local_hackathon.db"
+MAX_QUEUED_BATCHES = 8  # Bounds memory while readers outpace the writer
+FULL_REFRESH_HOURS = 24  # Incremental copies miss in-place edits, so re-copy whole tables this often
+PUT_TIMEOUT_SECONDS = 0.5
+
+
+def _sqlite_type(arrow_type) -> str:
+    if pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type):
+        return "INTEGER"
+    if pa.types.is_floating(arrow_type):
+        return "REAL"
+    return "TEXT"
+
+
+def _sqlite_value(value):
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    if isinstance(value, (datetime, date, dt_time, Decimal)):
+        return str(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
 
-client = bigquery.Client(project=PROJECT_ID)
-conn = sqlite3.connect(SQLITE_FILE)
 
-tables = client.list_tables(DATASET_ID)
-print(f"Found {len(tables)} tables in {DATASET_ID}")
+def _batch_rows(batch: pa.RecordBatch):
+    columns = [batch.column(i).to_pylist() for i in range(batch.num_columns)]
+    return [tuple(_sqlite_value(v) for v in row) for row in zip(*columns)]
 
-for table in tables:
+
+def _init_state(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS _export_state (
+            table_name TEXT PRIMARY KEY,
+            run_id TEXT,
+            status TEXT,
+            watermark TEXT,
+            row_count INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Rowids deleted by incremental copies, so sqlite_to_chroma.py can drop their vectors
+    conn.execute("CREATE TABLE IF NOT EXISTS _export_removed (table_name TEXT, row_id INTEGER)")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(_export_state)")]
+    if "full_at" not in columns:
+        # When the table was last copied whole (files written before this column existed get NULL)
+        conn.execute("ALTER TABLE _export_state ADD COLUMN full_at TEXT")
+    conn.commit()
+
+
+def _put(out: queue.Queue, message, cancelled: threading.Event) -> bool:
+    """Queue a message for the writer, giving up once the export is cancelled."""
+    while not cancelled.is_set():
+        try:
+            out.put(message, timeout=PUT_TIMEOUT_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_table(client, bqstorage_client, table, watermark, out: queue.Queue, cancelled: threading.Event):
+    """Reader thread: push ('schema'|'batch'|'done'|'error', ...) messages for one table until cancelled."""
     table_id = table.table_id
-    print(f"Fetching table: {table_id}")
-    query = f"SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{table_id}` LIMIT 1000"
-    df = client.query(query).to_dataframe()
-    df.to_sql(table_id, conn, if_exists="replace", index=False)
+    watermark_col = WATERMARK_COLUMNS.get(table_id)
+    try:
+        if watermark is not None and watermark_col:
+            field_type = next((f.field_type for f in table.schema if f.name == watermark_col), "STRING")
+            # ORDER BY keeps batches in watermark order so progress can be committed per batch
+            query = (
+                f"SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{table_id}` "
+                f"WHERE {watermark_col} >= CAST(@watermark AS {field_type}) "
+                f"ORDER BY {watermark_col}"
+            )
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ScalarQueryParameter("watermark", "STRING", watermark)]
+            )
+            rows = client.query(query, job_config=job_config).result()
+            mode = "incremental"
+        else:
+            rows = client.list_rows(table)
+            mode = "full"
+
+        schema_sent = False
+        for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+            if not schema_sent:
+                if not _put(out, ("schema", table_id, (batch.schema, mode)), cancelled):
+                    return
+                schema_sent = True
+            if not _put(out, ("batch", table_id, batch), cancelled):
+                return
+        if not schema_sent and not _put(out, ("schema", table_id, (None, mode)), cancelled):
+            return
+        _put(out, ("done", table_id, None), cancelled)
+    except Exception as e:
+        _put(out, ("error", table_id, e), cancelled)
+
+
+class _TableWriter:
+    """Per-table write state kept by the single SQLite writer."""
+
+    def __init__(self, conn, table_id, run_id, full_at=None):
+        self.conn = conn
+        self.table_id = table_id
+        self.run_id = run_id
+        self.full_at = full_at
+        self.watermark_col = WATERMARK_COLUMNS.get(table_id)
+        self.mode = None
+        self.target = None
+        self.insert_sql = None
+        self.watermark_index = None
+        self.stale = {}  # Incremental: local rows at the watermark not yet seen again -> their rowids
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.time()
+
+    def start(self, schema, mode, watermark):
+        self.mode = mode
+        if schema is None:
+            return
+        # Full copies go to a staging table and are swapped in atomically at the end
+        self.target = f'"{self.table_id}"' if mode == "incremental" else f'"{self.table_id}__staging"'
+        columns = ", ".join(f'"{f.name}" {_sqlite_type(f.type)}' for f in schema)
+        placeholders = ", ".join("?" for _ in schema)
+        self.insert_sql = f"INSERT INTO {self.target} VALUES ({placeholders})"
+        if self.watermark_col in schema.names:
+            self.watermark_index = schema.names.index(self.watermark_col)
+
+        with self.conn:
+            if mode == "incremental":
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS {self.target} ({columns})')
+                # Rows at the watermark are fetched again. Unchanged ones keep their local copy (and rowid,
+                # so sqlite_to_chroma.py does not embed them again); the rest are deleted in finish()
+                for rowid, *values in self.conn.execute(
+                    f'SELECT rowid, * FROM {self.target} WHERE "{self.watermark_col}" >= ?', (watermark,)
+                ):
+                    self.stale.setdefault(tuple(values), []).append(rowid)
+            else:
+                self.conn.execute(f"DROP TABLE IF EXISTS {self.target}")
+                self.conn.execute(f"CREATE TABLE {self.target} ({columns})")
+            self._save_state("running", watermark)
+
+    def write(self, batch):
+        rows = _batch_rows(batch)
+        new_rows = [row for row in rows if not self._seen_again(row)] if self.stale else rows
+        with self.conn:
+            self.conn.executemany(self.insert_sql, new_rows)
+            if self.mode == "incremental" and self.watermark_index is not None and rows:
+                # Batches arrive in watermark order, so the last row carries the new watermark
+                self._save_state("running", rows[-1][self.watermark_index])
+        self.rows += len(rows)
+        self.bytes += batch.nbytes
+
+    def _seen_again(self, row) -> bool:
+        """True (and the local copy is kept) if the row is already stored unchanged."""
+        rowids = self.stale.get(row)
+        if not rowids:
+            return False
+        rowids.pop()
+        if not rowids:
+            del self.stale[row]
+        return True
+
+    def finish(self):
+        with self.conn:
+            if self.mode == "incremental" and self.stale:
+                # Local rows at the old watermark that changed or disappeared upstream
+                gone = [rowid for rowids in self.stale.values() for rowid in rowids]
+                for start in range(0, len(gone), 500):
+                    chunk = gone[start:start + 500]
+                    self.conn.execute(
+                        f'DELETE FROM "{self.table_id}" WHERE rowid IN ({", ".join("?" for _ in chunk)})', chunk
+                    )
+                self.conn.executemany("INSERT INTO _export_removed VALUES (?, ?)",
+                                      [(self.table_id, rowid) for rowid in gone])
+            if self.mode == "full" and self.target:
+                self.conn.execute(f'DROP TABLE IF EXISTS "{self.table_id}"')
+                self.conn.execute(f'ALTER TABLE {self.target} RENAME TO "{self.table_id}"')
+            if self.mode == "full":
+                self.full_at = datetime.now().isoformat(timespec="seconds")
+                # A rebuild resets the table's vectors anyway
+                self.conn.execute("DELETE FROM _export_removed WHERE table_name = ?", (self.table_id,))
+            watermark = None
+            if self.watermark_col:
+                try:
+                    watermark = self.conn.execute(
+                        f'SELECT MAX("{self.watermark_col}") FROM "{self.table_id}"'
+                    ).fetchone()[0]
+                except sqlite3.OperationalError:
+                    pass  # Empty table that was never created locally
+            self._save_state("complete", watermark)
+
+        elapsed = max(time.time() - self.started, 1e-6)
+        mb = self.bytes / (1024 * 1024)
+        print(f"✅ {self.table_id} ({self.mode}): {self.rows} rows, {mb:.1f} MB in {elapsed:.1f}s "
+              f"({self.rows / elapsed:,.0f} rows/s, {mb / elapsed:.1f} MB/s)")
+
+    def _save_state(self, status, watermark):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO _export_state "
+            "(table_name, run_id, status, watermark, row_count, updated_at, full_at) "
+            "VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?)",
+            (self.table_id, self.run_id, status, watermark, self.rows, self.full_at)
+        )
+
+
+def _full_copy_due(full_at) -> bool:
+    if not full_at:
+        return True
+    return (datetime.now() - datetime.fromisoformat(full_at)).total_seconds() >= FULL_REFRESH_HOURS * 3600
+
+
+def export_tables(client, sqlite_file=SQLITE_FILE, table_names=None, workers=4, full=False, resume=False):
+    """Export tables concurrently into SQLite. Returns {table_id: row_count} for finished tables."""
+    conn = sqlite3.connect(sqlite_file)
+    _init_state(conn)
+    state = {
+        row[0]: {"run_id": row[1], "status": row[2], "watermark": row[3], "full_at": row[4]}
+        for row in conn.execute("SELECT table_name, run_id, status, watermark, full_at FROM _export_state")
+    }
+
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    if resume and state:
+        run_id = max(s["run_id"] for s in state.values())
+
+    tables = list(client.list_tables(DATASET_ID))
+    print(f"Found {len(tables)} tables in {DATASET_ID}")
+    if table_names:
+        tables = [t for t in tables if t.table_id in table_names]
+    if resume:
+        tables = [t for t in tables
+                  if not (state.get(t.table_id, {}).get("run_id") == run_id
+                          and state[t.table_id]["status"] == "complete")]
+        print(f"Resuming run {run_id}: {len(tables)} tables left")
+
+    bqstorage_client = bigquery_storage.BigQueryReadClient() if bigquery_storage else None
+    if bqstorage_client is None:
+        print("google-cloud-bigquery-storage not installed; reading through the REST API")
+
+    out = queue.Queue(maxsize=MAX_QUEUED_BATCHES)
+    cancelled = threading.Event()
+    writers = {}
+    watermarks = {}
+    finished = {}
+    failed = set()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                for table_ref in tables:
+                    table = client.get_table(table_ref)
+                    previous = state.get(table.table_id, {})
+                    has_local_copy = conn.execute(
+                        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table.table_id,)
+                    ).fetchone()
+                    watermark = None
+                    if (not full and has_local_copy and WATERMARK_COLUMNS.get(table.table_id)
+                            and not _full_copy_due(previous.get("full_at"))):
+                        watermark = previous.get("watermark")
+                    watermarks[table.table_id] = watermark
+                    writers[table.table_id] = _TableWriter(conn, table.table_id, run_id, previous.get("full_at"))
+                    pool.submit(_read_table, client, bqstorage_client, table, watermark, out, cancelled)
+
+                pending = len(writers)
+                while pending:
+                    kind, table_id, payload = out.get()
+                    writer = writers[table_id]
+                    if kind in ("done", "error"):
+                        pending -= 1
+                    if table_id in failed:
+                        continue  # Drain the reader's remaining messages
+                    try:
+                        if kind == "schema":
+                            schema, mode = payload
+                            writer.start(schema, mode, watermarks[table_id])
+                        elif kind == "batch":
+                            writer.write(payload)
+                        elif kind == "done":
+                            writer.finish()
+                            finished[table_id] = writer.rows
+                        elif kind == "error":
+                            print(f"❌ {table_id}: {payload}")
+                    except Exception as e:
+                        print(f"❌ {table_id}: failed to write: {e}")
+                        failed.add(table_id)
+            finally:
+                # If the main thread bails out (e.g. get_table failed), readers blocked on the
+                # full queue stop instead of keeping the pool from shutting down
+                cancelled.set()
+    finally:
+        conn.close()
+    return finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export hackathon_data tables into SQLite")
+    parser.add_argument("--sqlite-file", default=SQLITE_FILE)
+    parser.add_argument("--tables", nargs="*", help="Only export these tables")
+    parser.add_argument("--workers", type=int, default=4, help="Tables read concurrently")
+    parser.add_argument("--full", action="store_true", help="Ignore watermarks and re-copy every table")
+    parser.add_argument("--resume", action="store_true", help="Skip tables already finished in the last run")
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=PROJECT_ID)
+    started = time.time()
+    finished = export_tables(client, args.sqlite_file, args.tables, args.workers, args.full, args.resume)
+    total_rows = sum(finished.values())
+    print(f"✅ Exported {len(finished)} tables, {total_rows} rows into {args.sqlite_file} "
+          f"in {time.time() - started:.1f}s")
+
 
-conn.close()
-print("✅ All tables from hackathon_data are now in local SQLite!")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+# catalog.py
+# Per-table column roles in `hackathon_data`, mirroring the SQL tips given to the agent.
+# `branch` is the column used for branch access control, `date` the creation timestamp
+# and `status` the status column the canonical status mappings apply to.
+TABLE_COLUMNS = {
+    "application_table": {"branch": "branch", "date": "Added_Date", "status": "Status"},
+    "enquiry_table": {"branch": "branch", "date": "created_at", "status": "status"},
+    "office_visits_table": {"branch": "visited_branch_name", "date": "visit_date", "status": None},
+    "deals_applications_table": {"branch": "deal_belongs_to_branch", "date": "deal_created_at", "status": "deal_status"},
+    "base_branch_table": {"branch": "branch_name", "date": None, "status": None},
+}
+
+# Reference tables with no per-branch rows, readable by users of any branch
+SHARED_TABLES = {"base_branch_table", "feedback_questions_table"}
+
+
+def branch_column(table: str):
+    return TABLE_COLUMNS.get(table, {}).get("branch")
+
+
+def date_column(table: str):
+    return TABLE_COLUMNS.get(table, {}).get("date")
+
+
+def status_column(table: str):
+    return TABLE_COLUMNS.get(table, {}).get("status")
@@ -0,0 +1,233 @@
+# job_engine.py
+"""
+Non-blocking BigQuery job execution shared by every request in the process.
+
+`client.query(...).result()` holds a server thread for the whole life of the job. The
+engine instead runs an asyncio loop in a daemon thread: jobs are submitted and then
+polled with `job.done()` between `asyncio.sleep` back-offs, so a slow job costs one
+short HTTP call per poll instead of a parked thread. Callers get a
+`concurrent.futures.Future` (`submit`), block on it (`run`, what the Flask routes do),
+or await it from a coroutine (`run_async`).
+
+Identical queries already in flight (same project, SQL, parameters and byte limit) are
+run once; later callers wait on the first job and share its rows.
+
+Queries the dry run estimates at or below BQ_SHORT_QUERY_BYTES use `query_and_wait`,
+BigQuery's short-query path: with the client's job creation mode set to optional
+(services/backends.py) BigQuery may answer without creating a job at all. Larger
+queries, queries with a timeout (only a polled job can be cancelled when it passes)
+and exports that page their rows lazily always run as polled jobs.
+
+Per-job stats (mode, job id, bytes, slot time, cache hit, wait, sharing) are attached
+to each result, exported as Prometheus metrics and kept for the last BQ_RECENT_JOBS
+jobs (`JobEngine().recent_jobs()`).
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import partial
+
+from monitoring.metrics import BQ_JOB_SECONDS, BQ_JOBS_DEDUPLICATED, BQ_JOBS_IN_FLIGHT, BQ_SLOT_MILLIS
+
+BQ_SHORT_QUERY_BYTES = int(os.environ.get("BQ_SHORT_QUERY_BYTES", 256 * 1024 ** 2))  # 0 always creates a job
+BQ_DEDUPE_ENABLED = os.environ.get("BQ_DEDUPE_ENABLED", "1") == "1"
+BQ_ENGINE_THREADS = int(os.environ.get("BQ_ENGINE_THREADS", 8))  # Threads for the blocking API calls
+BQ_POLL_INITIAL_SECONDS = float(os.environ.get("BQ_POLL_INITIAL_SECONDS", 0.05))
+BQ_POLL_MAX_SECONDS = float(os.environ.get("BQ_POLL_MAX_SECONDS", 1.0))
+BQ_RECENT_JOBS = int(os.environ.get("BQ_RECENT_JOBS", 200))
+
+
+class JobResult:
+    """
+    Rows of a finished query plus its stats.
+
+    Attributes:
+        rows: A list of rows, or the lazily paged RowIterator for streamed queries.
+        stats: Per-job stats (see `JobEngine.recent_jobs`).
+        shared: True if this caller joined a job another request had already started.
+    """
+
+    def __init__(self, rows, stats: dict, shared: bool = False):
+        self.rows = rows
+        self.stats = stats
+        self.shared = shared
+
+
+def _job_key(client, sql: str, job_config) -> str:
+    """Identity of a query for de-duplication: project, SQL, parameters and limits."""
+    params = [p.to_api_repr() for p in (getattr(job_config, "query_parameters", None) or [])]
+    identity = {
+        "project": getattr(client, "project", None),
+        "sql": sql,
+        "params": params,
+        "max_bytes": getattr(job_config, "maximum_bytes_billed", None),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return round((end - start).total_seconds(), 3)
+
+
+class JobEngine:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        # First used from many request threads at once, so only publish a started engine
+        with cls._instance_lock:
+            if cls._instance is None:
+                engine = super(JobEngine, cls).__new__(cls)
+                engine._start()
+                cls._instance = engine
+        return cls._instance
+
+    def _start(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._recent = deque(maxlen=BQ_RECENT_JOBS)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=BQ_ENGINE_THREADS, thread_name_prefix="bq-engine"
+        )
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="bq-engine-loop", daemon=True).start()
+
+    def submit(self, client, sql: str, job_config=None, timeout: float = None,
+               estimated_bytes: int = None, stream: bool = False) -> concurrent.futures.Future:
+        """
+        Start a query (or join the identical one already running) without waiting for it.
+
+        Args:
+            client: BigQuery client to run the query with.
+            sql: The query.
+            job_config: QueryJobConfig with parameters and the byte limit.
+            timeout: Seconds before the job is cancelled and the future raises TimeoutError.
+            estimated_bytes: Dry-run estimate; small queries use the short-query path.
+            stream: Return the RowIterator unread (for exports) instead of a list of rows.
+                Streamed queries are never shared.
+
+        Returns:
+            A Future resolving to a JobResult.
+        """
+        key = None if stream or not BQ_DEDUPE_ENABLED else _job_key(client, sql, job_config)
+        with self._lock:
+            running = self._inflight.get(key) if key else None
+            if running is None:
+                stats = {"submitted_at": time.time(), "waiters": 0}
+                # query_and_wait cannot be cancelled once its wait times out (a jobs.query call
+                # cut off by the HTTP timeout returns no job id), so timed queries are polled
+                short = (not stream and timeout is None and BQ_SHORT_QUERY_BYTES > 0 and estimated_bytes is not None
+                         and estimated_bytes <= BQ_SHORT_QUERY_BYTES and hasattr(client, "query_and_wait"))
+                future = asyncio.run_coroutine_threadsafe(
+                    self._execute(client, sql, job_config, timeout, stream, short, stats), self._loop
+                )
+                if key:
+                    self._inflight[key] = (future, stats)
+                    future.add_done_callback(lambda _: self._forget(key))
+                return future
+            running, stats = running
+            stats["waiters"] += 1
+
+        BQ_JOBS_DEDUPLICATED.inc()
+        # The joiner gets a future of its own, so cancelling it never cancels the shared job
+        joined = concurrent.futures.Future()
+
+        def relay(done):
+            if done.cancelled():
+                joined.cancel()
+            elif done.exception() is not None:
+                joined.set_exception(done.exception())
+            else:
+                result = done.result()
+                joined.set_result(JobResult(result.rows, result.stats, shared=True))
+
+        running.add_done_callback(relay)
+        return joined
+
+    def run(self, client, sql: str, job_config=None, timeout: float = None,
+            estimated_bytes: int = None, stream: bool = False) -> JobResult:
+        """Blocking `submit` for synchronous callers; raises whatever the job raised."""
+        return self.submit(client, sql, job_config, timeout, estimated_bytes, stream).result()
+
+    async def run_async(self, client, sql: str, job_config=None, timeout: float = None,
+                        estimated_bytes: int = None, stream: bool = False) -> JobResult:
+        """`submit` for coroutines: awaits the job without blocking the caller's event loop."""
+        return await asyncio.wrap_future(self.submit(client, sql, job_config, timeout, estimated_bytes, stream))
+
+    def recent_jobs(self, limit: int = 50) -> list:
+        """Stats of the most recent jobs, newest first."""
+        with self._lock:
+            return list(self._recent)[-limit:][::-1]
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    async def _call(self, func, *args, **kwargs):
+        """Run a blocking client call on the engine's threads."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def _execute(self, client, sql, job_config, timeout, stream, short, stats):
+        mode = "stream" if stream else ("short" if short else "job")
+        stats["mode"] = mode
+        started = time.time()
+        BQ_JOBS_IN_FLIGHT.inc()
+        try:
+            if short:
+                rows = await self._call(client.query_and_wait, sql, job_config=job_config)
+                source = rows
+            else:
+                source = await self._call(client.query, sql, job_config=job_config)
+                await self._wait(source, timeout)
+                rows = await self._call(source.result)
+            stats["status"] = "ok"
+            if not stream:
+                rows = await self._call(list, rows)
+                stats["rows"] = len(rows)
+            return JobResult(rows, self._finish(stats, source, started))
+        except BaseException as e:
+            stats["status"] = "timeout" if isinstance(e, concurrent.futures.TimeoutError) else "error"
+            self._finish(stats, None, started)
+            raise
+        finally:
+            BQ_JOBS_IN_FLIGHT.dec()
+
+    async def _wait(self, job, timeout):
+        """Poll `job.done()` with exponential back-off; cancel the job once `timeout` passes."""
+        deadline = None if timeout is None else time.time() + timeout
+        delay = BQ_POLL_INITIAL_SECONDS
+        while not await self._call(job.done):
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                await self._call(job.cancel)
+                raise concurrent.futures.TimeoutError()
+            await asyncio.sleep(delay if remaining is None else min(delay, remaining))
+            delay = min(delay * 2, BQ_POLL_MAX_SECONDS)
+
+    def _finish(self, stats: dict, source, started: float) -> dict:
+        """Fill in the job's stats from the job / RowIterator, record metrics and keep it in `recent_jobs`."""
+        stats["seconds"] = round(time.time() - started, 3)
+        if source is not None:
+            stats["job_id"] = getattr(source, "job_id", None)
+            stats["query_id"] = getattr(source, "query_id", None)
+            stats["bytes_processed"] = getattr(source, "total_bytes_processed", None)
+            stats["bytes_billed"] = getattr(source, "total_bytes_billed", None)
+            stats["slot_millis"] = getattr(source, "slot_millis", None)
+            stats["cache_hit"] = getattr(source, "cache_hit", None)
+            stats["queued_seconds"] = _seconds_between(getattr(source, "created", None), getattr(source, "started", None))
+            # A short query BigQuery answered without creating a job has a query id but no job id
+            if stats["mode"] == "short" and stats["job_id"] is None:
+                stats["mode"] = "jobless"
+        BQ_JOB_SECONDS.labels(stats["mode"], stats["status"]).observe(stats["seconds"])
+        if stats.get("slot_millis"):
+            BQ_SLOT_MILLIS.labels(stats["mode"]).inc(stats["slot_millis"])
+        with self._lock:
+            self._recent.append(stats)
+        return stats
@@ -0,0 +1,372 @@
+# replica.py
+"""
+Local analytical replica of `hackathon_data` in DuckDB.
+
+Agent SQL (BigQuery dialect) is translated and served locally when the replica
+is enabled; anything DuckDB cannot parse or bind falls back to BigQuery.
+
+Modes (REPLICA_MODE):
+    off    - never use the replica (default)
+    prefer - serve from the replica, fall back to BigQuery on unsupported syntax
+    only   - serve from the replica only (offline testing)
+
+Run `python -m db.replica` to build or refresh the replica from BigQuery.
+
+DuckDB lets one process open a file read-write, or several open it read-only, never
+both. So requests read a published snapshot through read-only connections, and only
+the process holding the writer lock (`<REPLICA_DB_PATH>.lock`) syncs the replica and
+refreshes local rollups. It writes a copy (`<REPLICA_DB_PATH>.<generation>`), then
+repoints the `REPLICA_DB_PATH` symlink at it. Readers reopen on the next query after
+a publish, and the previous snapshot is kept until the one after, for queries still
+reading it.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from db.catalog import TABLE_COLUMNS
+
+try:
+    import duckdb
+except ImportError:  # Optional dependency
+    duckdb = None
+
+try:
+    import sqlglot
+except ImportError:  # Optional dependency, used for dialect translation
+    sqlglot = None
+
+PROJECT_ID = "expert-hackathon-2026"
+DATASET_ID = "hackathon_data"
+REPLICA_FILE = os.environ.get("REPLICA_DB_PATH", "local_replica.duckdb")
+REPLICA_MODE = os.environ.get("REPLICA_MODE", "off").lower()
+REPLICA_SYNC_INTERVAL = int(os.environ.get("REPLICA_SYNC_INTERVAL", 0))  # seconds, 0 disables
+REPLICA_FULL_REFRESH_SECONDS = int(os.environ.get("REPLICA_FULL_REFRESH_SECONDS", 3600))
+
+# Tables with a creation timestamp are synced incrementally: rows created at or after the
+# last watermark are re-fetched. Rows edited in place (application `Status`, deal
+# `deal_status`) keep their creation time, so the background sync also copies every table
+# whole once per REPLICA_FULL_REFRESH_SECONDS. Tables without a timestamp are always copied whole.
+WATERMARK_COLUMNS = {
+    table: columns["date"] for table, columns in TABLE_COLUMNS.items() if columns["date"]
+}
+
+KEEP_GENERATIONS = 2  # The published snapshot and the one before it
+
+_conn = None
+_conn_path = None
+_conn_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_sync_thread = None
+_writer_lock_file = None
+
+# `hackathon_data.table` or `hackathon_data`.`table`
+_BACKTICK_IDENT = re.compile(r"`([^`]+)`")
+_READ_QUERY = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+
+
+class UnsupportedQuery(Exception):
+    """The replica cannot answer this query; the caller should use BigQuery."""
+
+
+def replica_enabled() -> bool:
+    return REPLICA_MODE in ("prefer", "only") and duckdb is not None and os.path.exists(REPLICA_FILE)
+
+
+def replica_only() -> bool:
+    return REPLICA_MODE == "only"
+
+
+def get_connection():
+    """
+    Read-only connection to the published replica snapshot (use `.cursor()` per thread).
+
+    Raises:
+        UnsupportedQuery: If duckdb is missing or no snapshot has been published yet.
+    """
+    global _conn, _conn_path
+    if duckdb is None:
+        raise UnsupportedQuery("duckdb is not installed")
+    path = os.path.realpath(REPLICA_FILE)
+    with _conn_lock:
+        if _conn is None or path != _conn_path:
+            if not os.path.exists(path):
+                raise UnsupportedQuery("The replica has not been built yet")
+            # The old snapshot's connection is dropped, not closed: cursors still reading it keep it open
+            _conn = duckdb.connect(path, read_only=True)
+            _conn_path = path
+        return _conn
+
+
+def claim_replica_writer() -> bool:
+    """
+    Try to become the one process that syncs the replica and refreshes local rollups.
+    The lock is held until the process exits.
+
+    Returns:
+        True if this process is (or just became) the writer.
+    """
+    global _writer_lock_file
+    if _writer_lock_file is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:  # No flock (Windows): run a single app process
+        return True
+    handle = open(f"{REPLICA_FILE}.lock", "w")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _writer_lock_file = handle
+    return True
+
+
+def _generations() -> list:
+    """Snapshot files next to REPLICA_FILE, oldest first."""
+    directory = os.path.dirname(os.path.abspath(REPLICA_FILE))
+    prefix = os.path.basename(REPLICA_FILE) + "."
+    names = [n for n in os.listdir(directory) if n.startswith(prefix) and n[len(prefix):].isdigit()]
+    return [os.path.join(directory, n) for n in sorted(names, key=lambda n: int(n[len(prefix):]))]
+
+
+def _publish(path: str):
+    """Atomically point REPLICA_FILE at a finished snapshot and drop older ones."""
+    link = f"{REPLICA_FILE}.link"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(path), link)
+    os.replace(link, REPLICA_FILE)
+    # Unlinking a snapshot an older connection still has open is safe; the data stays until it closes
+    for old in _generations()[:-KEEP_GENERATIONS]:
+        os.remove(old)
+
+
+@contextmanager
+def replica_writer():
+    """
+    Read-write connection to a new snapshot, a copy of the published one. The snapshot
+    is published when the block exits, or discarded if it raises.
+
+    Raises:
+        UnsupportedQuery: If duckdb is not installed.
+        RuntimeError: If another process holds the writer lock.
+    """
+    if duckdb is None:
+        raise UnsupportedQuery("duckdb is not installed")
+    if not claim_replica_writer():
+        raise RuntimeError(f"Another process is writing {REPLICA_FILE}")
+    with _sync_lock:
+        path = f"{REPLICA_FILE}.{time.time_ns()}"
+        if os.path.exists(REPLICA_FILE):
+            shutil.copyfile(os.path.realpath(REPLICA_FILE), path)
+        conn = duckdb.connect(path)
+        try:
+            conn.execute(f"CREATE SCHEMA IF NOT EXISTS {DATASET_ID}")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS main._replica_state (
+                    table_name VARCHAR PRIMARY KEY,
+                    watermark VARCHAR,
+                    row_count BIGINT,
+                    bq_schema VARCHAR,
+                    synced_at TIMESTAMP
+                )
+            """)
+            yield conn
+            conn.execute("CHECKPOINT")
+        except BaseException:
+            conn.close()
+            for leftover in (path, f"{path}.wal"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+        conn.close()
+        _publish(path)
+
+
+def translate_sql(query: str) -> str:
+    """Translate a read-only BigQuery query to DuckDB, dropping the project qualifier."""
+    query = query.strip().rstrip(";")
+    query = query.replace(f"`{PROJECT_ID}`.", "").replace(f"{PROJECT_ID}.", "")
+
+    if sqlglot is None:
+        # Without a parser only plain single SELECTs are attempted
+        if ";" in query or not _READ_QUERY.match(query):
+            raise UnsupportedQuery("Only single SELECT queries are served by the replica")
+        return _BACKTICK_IDENT.sub(lambda m: ".".join(f'"{p}"' for p in m.group(1).split(".")), query)
+
+    try:
+        expression = sqlglot.parse_one(query, read="bigquery")
+    except sqlglot.errors.SqlglotError as e:
+        raise UnsupportedQuery(f"Cannot translate query: {e}")
+    if not isinstance(expression, sqlglot.exp.Query):
+        raise UnsupportedQuery("Only single SELECT queries are served by the replica")
+    return expression.sql(dialect="duckdb")
+
+
+def query_replica(query: str, row_limit: int = None) -> list:
+    """
+    Run a BigQuery-dialect query against the replica.
+
+    Returns:
+        List of row dicts (NULLs as None).
+
+    Raises:
+        UnsupportedQuery: If translation or execution fails locally.
+    """
+    sql = translate_sql(query)
+    cursor = get_connection().cursor()
+    try:
+        relation = cursor.sql(sql)
+        if row_limit:
+            relation = relation.limit(row_limit)
+        df = relation.df()
+    except duckdb.Error as e:
+        raise UnsupportedQuery(f"Replica could not run query: {e}")
+    finally:
+        cursor.close()
+
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict(orient="records")
+
+
+def describe_replica() -> str:
+    """Schema text in the same format as `list_tables`, from the BigQuery schema captured at sync time."""
+    cursor = get_connection().cursor()
+    try:
+        rows = cursor.execute(
+            "SELECT table_name, bq_schema FROM main._replica_state ORDER BY table_name"
+        ).fetchall()
+    finally:
+        cursor.close()
+
+    schema_text = []
+    for table_name, bq_schema in rows:
+        schema_text.append(f"Table: {DATASET_ID}.{table_name}")
+        schema_text.extend(f" - {name} ({field_type})" for name, field_type in json.loads(bq_schema))
+        schema_text.append("")
+    return "\n".join(schema_text)
+
+
+def _sync_table(client, conn, table_ref, full: bool):
+    table = client.get_table(table_ref)
+    table_id = table.table_id
+    target = f'{DATASET_ID}."{table_id}"'
+    bq_schema = json.dumps([(f.name, f.field_type) for f in table.schema])
+    watermark_col = WATERMARK_COLUMNS.get(table_id)
+
+    state = conn.execute(
+        "SELECT watermark FROM main._replica_state WHERE table_name = ?", [table_id]
+    ).fetchone()
+    started = time.time()
+
+    if not full and state and state[0] and watermark_col:
+        from google.cloud import bigquery
+        field_type = next((f.field_type for f in table.schema if f.name == watermark_col), "STRING")
+        # Re-fetch rows at the watermark itself so late rows with the same timestamp are not lost
+        query = (
+            f"SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{table_id}` "
+            f"WHERE {watermark_col} >= CAST(@watermark AS {field_type})"
+        )
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("watermark", "STRING", state[0])]
+        )
+        incoming = client.query(query, job_config=job_config).to_arrow()
+        conn.execute("BEGIN TRANSACTION")
+        conn.execute(f'DELETE FROM {target} WHERE "{watermark_col}" >= CAST(? AS {_duck_type(field_type)})', [state[0]])
+        conn.register("incoming", incoming)
+        conn.execute(f"INSERT INTO {target} SELECT * FROM incoming")
+        mode = "incremental"
+    else:
+        # tabledata.list is free, unlike a SELECT * query job
+        incoming = client.list_rows(table).to_arrow()
+        conn.execute("BEGIN TRANSACTION")
+        conn.register("incoming", incoming)
+        conn.execute(f"CREATE OR REPLACE TABLE {target} AS SELECT * FROM incoming")
+        mode = "full"
+    conn.unregister("incoming")
+
+    watermark = None
+    if watermark_col:
+        watermark = conn.execute(f'SELECT CAST(MAX("{watermark_col}") AS VARCHAR) FROM {target}').fetchone()[0]
+    row_count = conn.execute(f"SELECT COUNT(*) FROM {target}").fetchone()[0]
+    conn.execute(
+        "INSERT OR REPLACE INTO main._replica_state VALUES (?, ?, ?, ?, ?)",
+        [table_id, watermark, row_count, bq_schema, datetime.now()]
+    )
+    conn.execute("COMMIT")
+    print(f"[REPLICA] {table_id}: {mode} sync, {incoming.num_rows} rows fetched, "
+          f"{row_count} total in {time.time() - started:.1f}s")
+
+
+def _duck_type(bq_type: str) -> str:
+    return {"DATETIME": "TIMESTAMP", "TIMESTAMP": "TIMESTAMPTZ", "DATE": "DATE"}.get(bq_type, "VARCHAR")
+
+
+def sync_replica(client, full: bool = False):
+    """
+    Copy every `hackathon_data` table into a new replica snapshot, incrementally where
+    possible, and publish it. Must run in the writer process (see claim_replica_writer).
+    """
+    with replica_writer() as conn:
+        for table_ref in client.list_tables(DATASET_ID):
+            try:
+                _sync_table(client, conn, table_ref, full)
+            except Exception as e:
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+                print(f"[REPLICA] Failed to sync {table_ref.table_id}: {e}")
+
+
+def start_background_sync(client):
+    """
+    Refresh the replica every REPLICA_SYNC_INTERVAL seconds in a daemon thread.
+    The first refresh, and one every REPLICA_FULL_REFRESH_SECONDS after it, copies
+    every table whole so in-place status edits reach the replica.
+    Only the process that holds the writer lock syncs; other workers just read.
+    """
+    global _sync_thread
+    if _sync_thread is not None or REPLICA_SYNC_INTERVAL <= 0 or duckdb is None or REPLICA_MODE == "off":
+        return
+    if not claim_replica_writer():
+        print("[REPLICA] Another process syncs the replica, this one only reads it")
+        return
+
+    def loop():
+        last_full = 0.0
+        while True:
+            time.sleep(REPLICA_SYNC_INTERVAL)
+            full = time.time() - last_full >= REPLICA_FULL_REFRESH_SECONDS
+            try:
+                sync_replica(client, full=full)
+            except Exception as e:
+                print(f"[REPLICA] Sync failed: {e}")
+                continue
+            if full:
+                last_full = time.time()
+
+    _sync_thread = threading.Thread(target=loop, name="replica-sync", daemon=True)
+    _sync_thread.start()
+
+
+if __name__ == "__main__":
+    import sys
+    from google.cloud import bigquery
+
+    if duckdb is None:
+        print("duckdb is not installed. Run: pip install duckdb sqlglot")
+        sys.exit(1)
+
+    if not claim_replica_writer():
+        print(f"Another process (the running app?) is syncing {REPLICA_FILE}")
+        sys.exit(1)
+    sync_replica(bigquery.Client(project=PROJECT_ID), full="--full" in sys.argv)
+    print(f"Replica ready at {REPLICA_FILE}")
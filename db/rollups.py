@@ -0,0 +1,282 @@
+# rollups.py
+"""
+Materialized monthly rollups of the high-traffic aggregates.
+
+Most agent SQL is a count by status, branch and month over the four fact tables. Each
+of those tables gets a `<name>_monthly` rollup in the `ROLLUP_DATASET` dataset with one
+row per (branch, month, status) and a `record_count`, so such questions scan kilobytes
+instead of the raw table. `list_tables` advertises the rollups with their refresh time.
+
+Targets (ROLLUP_TARGET):
+    off      - no rollups (default)
+    bigquery - `CREATE OR REPLACE TABLE` jobs in `PROJECT_ID.ROLLUP_DATASET`
+    local    - tables in the DuckDB replica file, computed from the replica when it is
+               enabled, otherwise from one aggregate BigQuery query per rollup.
+               Queries that only read rollups are served locally.
+
+Rollups are refreshed every ROLLUP_REFRESH_INTERVAL seconds by a daemon thread; a rollup
+refreshed more recently than that (e.g. by another worker) is skipped. Local rollups are
+written into a new replica snapshot, so only the replica writer process refreshes them.
+Run `python -m db.rollups [--force]` to refresh them once.
+"""
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from db.catalog import TABLE_COLUMNS
+from db.replica import (duckdb, get_connection, replica_enabled, replica_writer, claim_replica_writer,
+                        UnsupportedQuery, PROJECT_ID, DATASET_ID)
+from monitoring.metrics import ROLLUP_REFRESHES, ROLLUP_LAST_REFRESH
+
+ROLLUP_TARGET = os.environ.get("ROLLUP_TARGET", "off").lower()
+ROLLUP_DATASET = os.environ.get("ROLLUP_DATASET", "hackathon_rollups")
+ROLLUP_REFRESH_INTERVAL = int(os.environ.get("ROLLUP_REFRESH_INTERVAL", 3600))  # seconds, 0 disables the thread
+
+# Fact tables with a branch and a date column; base_branch_table has no date to roll up by
+ROLLUPS = {
+    table.replace("_table", "") + "_monthly": table
+    for table, columns in TABLE_COLUMNS.items()
+    if columns["branch"] and columns["date"]
+}
+
+_refresh_lock = threading.Lock()
+_refresh_thread = None
+_bq_state = {}  # rollup -> (refreshed_at, rows) for the BigQuery target
+_bq_state_loaded = 0.0
+
+_ROLLUP_REFERENCE = re.compile(rf"\b{re.escape(ROLLUP_DATASET)}\s*`?\s*\.", re.IGNORECASE)
+_SOURCE_REFERENCE = re.compile(rf"\b{re.escape(DATASET_ID)}\s*`?\s*\.", re.IGNORECASE)
+
+
+def rollups_enabled() -> bool:
+    if ROLLUP_TARGET == "local":
+        return duckdb is not None
+    return ROLLUP_TARGET == "bigquery"
+
+
+def rollup_sql(name: str, dialect: str = "bigquery") -> str:
+    """The aggregate behind a rollup, reading the raw table in BigQuery or in the replica ("duckdb")."""
+    table = ROLLUPS[name]
+    columns = TABLE_COLUMNS[table]
+    if dialect == "bigquery":
+        source = f"`{PROJECT_ID}.{DATASET_ID}.{table}`"
+        branch, date, status = columns["branch"], columns["date"], columns["status"]
+        month = f"DATE_TRUNC(CAST({date} AS DATE), MONTH)"
+    else:
+        source = f'{DATASET_ID}."{table}"'
+        branch, date, status = (f'"{c}"' if c else None for c in (columns["branch"], columns["date"], columns["status"]))
+        month = f"CAST(date_trunc('month', CAST({date} AS DATE)) AS DATE)"
+    if not status:
+        return (f"SELECT {branch} AS branch, {month} AS month, COUNT(*) AS record_count "
+                f"FROM {source} GROUP BY 1, 2")
+    return (f"SELECT {branch} AS branch, {month} AS month, {status} AS status, COUNT(*) AS record_count "
+            f"FROM {source} GROUP BY 1, 2, 3")
+
+
+def _local_state(conn) -> dict:
+    try:
+        rows = conn.execute("SELECT rollup, refreshed_at, row_count FROM main._rollup_state").fetchall()
+    except duckdb.CatalogException:  # No local rollup has been built yet
+        return {}
+    return {rollup: (refreshed_at, row_count) for rollup, refreshed_at, row_count in rows}
+
+
+def _bigquery_state(client) -> dict:
+    """Refresh time and size of the BigQuery rollups, from table metadata (cached for one interval)."""
+    global _bq_state_loaded
+    if time.time() - _bq_state_loaded < max(ROLLUP_REFRESH_INTERVAL, 60):
+        return _bq_state
+    state = {}
+    for name in ROLLUPS:
+        try:
+            table = client.get_table(f"{PROJECT_ID}.{ROLLUP_DATASET}.{name}")
+        except Exception:
+            continue
+        state[name] = (table.modified.astimezone().replace(tzinfo=None), table.num_rows)
+    _bq_state.clear()
+    _bq_state.update(state)
+    _bq_state_loaded = time.time()
+    return _bq_state
+
+
+def rollup_state(client) -> dict:
+    """
+    Rollups that exist in the current target.
+
+    Returns:
+        Mapping of rollup name to (refreshed_at as a naive local datetime, row count).
+    """
+    if not rollups_enabled():
+        return {}
+    if ROLLUP_TARGET == "local":
+        try:
+            cursor = get_connection().cursor()
+        except UnsupportedQuery:  # No replica snapshot yet
+            return {}
+        try:
+            return _local_state(cursor)
+        finally:
+            cursor.close()
+    return _bigquery_state(client)
+
+
+def _refresh_local(client, conn, name: str) -> int:
+    conn.execute(f"CREATE SCHEMA IF NOT EXISTS {ROLLUP_DATASET}")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS main._rollup_state (
+            rollup VARCHAR PRIMARY KEY,
+            row_count BIGINT,
+            refreshed_at TIMESTAMP
+        )
+    """)
+    target = f'{ROLLUP_DATASET}."{name}"'
+    if replica_enabled():
+        # The raw rows are already local, so the aggregate costs nothing
+        conn.execute("BEGIN TRANSACTION")
+        conn.execute(f"CREATE OR REPLACE TABLE {target} AS {rollup_sql(name, 'duckdb')}")
+    else:
+        incoming = client.query(rollup_sql(name)).to_arrow()
+        conn.execute("BEGIN TRANSACTION")
+        conn.register("incoming", incoming)
+        conn.execute(f"CREATE OR REPLACE TABLE {target} AS SELECT * FROM incoming")
+        conn.unregister("incoming")
+    row_count = conn.execute(f"SELECT COUNT(*) FROM {target}").fetchone()[0]
+    conn.execute("INSERT OR REPLACE INTO main._rollup_state VALUES (?, ?, ?)", [name, row_count, datetime.now()])
+    conn.execute("COMMIT")
+    return row_count
+
+
+def _refresh_bigquery(client, name: str) -> int:
+    client.create_dataset(f"{PROJECT_ID}.{ROLLUP_DATASET}", exists_ok=True)
+    target = f"`{PROJECT_ID}.{ROLLUP_DATASET}.{name}`"
+    client.query(f"CREATE OR REPLACE TABLE {target} CLUSTER BY branch AS {rollup_sql(name)}").result()
+    table = client.get_table(f"{PROJECT_ID}.{ROLLUP_DATASET}.{name}")
+    _bq_state[name] = (datetime.now(), table.num_rows)
+    return table.num_rows
+
+
+def refresh_rollups(client, force: bool = False):
+    """
+    Rebuild every rollup that is older than ROLLUP_REFRESH_INTERVAL (or all of them with `force`).
+
+    Args:
+        client: BigQuery client used for BigQuery rollups and for local rollups without a replica.
+        force: Rebuild rollups even if they are fresh.
+    """
+    if not rollups_enabled():
+        return
+    with _refresh_lock:
+        state = rollup_state(client)
+        stale = [
+            name for name in ROLLUPS
+            if force or not state.get(name, (None, 0))[0]
+            or (datetime.now() - state[name][0]).total_seconds() >= ROLLUP_REFRESH_INTERVAL
+        ]
+        if not stale:
+            return
+        if ROLLUP_TARGET == "local":
+            # Written into a new replica snapshot, published once every stale rollup is rebuilt
+            with replica_writer() as conn:
+                _refresh_each(client, conn, stale)
+        else:
+            _refresh_each(client, None, stale)
+
+
+def _refresh_each(client, conn, names: list):
+    for name in names:
+        started = time.time()
+        try:
+            if conn is not None:
+                row_count = _refresh_local(client, conn, name)
+            else:
+                row_count = _refresh_bigquery(client, name)
+        except Exception as e:
+            if conn is not None:
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+            ROLLUP_REFRESHES.labels(name, "error").inc()
+            print(f"[ROLLUP] Failed to refresh {name}: {e}")
+            continue
+        ROLLUP_REFRESHES.labels(name, "ok").inc()
+        ROLLUP_LAST_REFRESH.labels(name).set(time.time())
+        print(f"[ROLLUP] {name}: {row_count} rows ({ROLLUP_TARGET}) in {time.time() - started:.1f}s")
+
+
+def describe_rollups(client) -> str:
+    """Schema text for the rollups that exist, appended to the `list_tables` output."""
+    try:
+        state = rollup_state(client)
+    except Exception as e:
+        print(f"[ROLLUP] Could not read rollup state: {e}")
+        return ""
+    if not state:
+        return ""
+
+    lines = [
+        "ROLLUPS: pre-aggregated monthly counts. Prefer them over the raw tables for counts by status, "
+        "branch or month: SUM(record_count) instead of COUNT(*). Filter on `branch` for access control. "
+        "Rows added after the refresh time are not included.",
+        "",
+    ]
+    for name, source in ROLLUPS.items():
+        if name not in state:
+            continue
+        refreshed_at, row_count = state[name]
+        columns = TABLE_COLUMNS[source]
+        lines.append(f"Rollup: {ROLLUP_DATASET}.{name} (of {DATASET_ID}.{source}, {row_count} rows, "
+                     f"refreshed {refreshed_at:%Y-%m-%d %H:%M})")
+        lines.append(f" - branch (STRING): {columns['branch']}")
+        lines.append(f" - month (DATE): first day of the month of {columns['date']}")
+        if columns["status"]:
+            lines.append(f" - status (STRING): {columns['status']}")
+        lines.append(" - record_count (INTEGER): number of rows")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def serves_locally(query: str) -> bool:
+    """True if the query only reads local rollups, so the replica file can answer it."""
+    return (
+        ROLLUP_TARGET == "local" and duckdb is not None
+        and bool(_ROLLUP_REFERENCE.search(query)) and not _SOURCE_REFERENCE.search(query)
+    )
+
+
+def start_background_refresh(client):
+    """Refresh stale rollups now and then every ROLLUP_REFRESH_INTERVAL seconds in a daemon thread."""
+    global _refresh_thread
+    if _refresh_thread is not None or ROLLUP_REFRESH_INTERVAL <= 0 or not rollups_enabled():
+        return
+    if ROLLUP_TARGET == "local" and not claim_replica_writer():
+        print("[ROLLUP] Another process refreshes the local rollups, this one only reads them")
+        return
+
+    def loop():
+        while True:
+            try:
+                refresh_rollups(client)
+            except Exception as e:
+                print(f"[ROLLUP] Refresh failed: {e}")
+            time.sleep(ROLLUP_REFRESH_INTERVAL)
+
+    _refresh_thread = threading.Thread(target=loop, name="rollup-refresh", daemon=True)
+    _refresh_thread.start()
+
+
+if __name__ == "__main__":
+    import sys
+    from services.backends import create_bq_client
+
+    if not rollups_enabled():
+        print("Set ROLLUP_TARGET=bigquery or ROLLUP_TARGET=local (local needs: pip install duckdb)")
+        sys.exit(1)
+
+    if ROLLUP_TARGET == "local" and not claim_replica_writer():
+        print("Another process (the running app?) is writing the replica file")
+        sys.exit(1)
+    refresh_rollups(create_bq_client(PROJECT_ID), force="--force" in sys.argv)
+    print(f"Rollups ready in {ROLLUP_DATASET} ({ROLLUP_TARGET})")
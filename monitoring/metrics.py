@@ -0,0 +1,166 @@
+# metrics.py
+"""
+Prometheus metrics for the chat hot paths, served at /metrics.
+
+When PROMETHEUS_MULTIPROC_DIR is set (it must be set before the app starts, and
+emptied between runs), prometheus_client writes samples to per-process files and
+/metrics aggregates every worker with a MultiProcessCollector. Without it the
+default in-process registry is used, which is fine for `python app.py`.
+"""
+import os
+import time
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+from langchain_core.callbacks import BaseCallbackHandler
+
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+BYTES_BUCKETS = (1e6, 1e7, 1e8, 1e9, 1e10, 1e11)
+
+CHAT_REQUEST_SECONDS = Histogram(
+    "chat_request_seconds", "End-to-end /chat latency by outcome",
+    ["outcome"], buckets=LATENCY_BUCKETS
+)
+AGENT_ITERATIONS = Histogram(
+    "agent_iterations", "Tool-calling iterations per agent run",
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15)
+)
+AGENT_BUDGET_STOPS = Counter("agent_budget_stops_total", "Agent runs answered partially after a budget ran out", ["reason"])
+TOOL_OUTPUT_TRIMMED_CHARS = Counter(
+    "agent_tool_output_trimmed_chars_total", "Characters of tool output kept out of the agent scratchpad", ["tool"]
+)
+TOOL_CALLS = Counter("agent_tool_calls_total", "Tool calls made by the agent", ["tool", "status"])
+TOOL_CALL_SECONDS = Histogram(
+    "agent_tool_call_seconds", "Duration of agent tool calls", ["tool"], buckets=LATENCY_BUCKETS
+)
+BQ_QUERIES = Counter("bigquery_queries_total", "Guarded BigQuery queries", ["purpose", "status"])
+BQ_BYTES = Counter(
+    "bigquery_bytes_processed_total", "BigQuery bytes (dry-run estimate and billed)", ["purpose", "kind"]
+)
+BQ_QUERY_BYTES = Histogram(
+    "bigquery_query_estimated_bytes", "Estimated bytes per BigQuery query", ["purpose"], buckets=BYTES_BUCKETS
+)
+CACHE_LOOKUPS = Counter("cache_lookups_total", "CacheManager lookups", ["func", "result"])
+FAISS_SEARCH_SECONDS = Histogram(
+    "faiss_search_seconds", "Document similarity search latency", buckets=FAST_BUCKETS
+)
+DOC_SEARCH_BATCH_SIZE = Histogram(
+    "document_search_batch_size", "Document searches answered per embedding request",
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+EMBEDDING_REQUESTS = Counter(
+    "document_embedding_requests_total", "Query embedding requests made by document search", ["mode"]
+)
+CHAT_HISTORY_MESSAGES = Histogram(
+    "chat_history_messages", "Messages in a user's chat history after a turn",
+    buckets=(2, 4, 8, 16, 32, 64, 128, 256)
+)
+CHAT_HISTORY_SESSIONS = Gauge(
+    "chat_history_sessions", "Users with an in-memory chat history", multiprocess_mode="livesum"
+)
+CHART_RENDER_SECONDS = Histogram(
+    "chart_render_seconds", "Chart data fetch / render time", ["kind"], buckets=LATENCY_BUCKETS
+)
+ADMISSION_REJECTIONS = Counter("chat_admission_rejections_total", "Chat requests rejected before running", ["reason"])
+ADMISSION_WAIT_SECONDS = Histogram(
+    "chat_admission_wait_seconds", "Time a chat request waited for a free slot", buckets=LATENCY_BUCKETS
+)
+CHAT_IN_FLIGHT = Gauge("chat_in_flight", "Chat requests currently running", multiprocess_mode="livesum")
+CHAT_JOBS = Counter("chat_jobs_total", "Background chat jobs by status change", ["status"])
+CHAT_JOB_SECONDS = Histogram(
+    "chat_job_seconds", "Time background chat jobs spend queued and running", ["phase"],
+    buckets=(0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200)
+)
+PREFETCH_INTENTS = Counter("prefetch_intents_total", "Login prefetch outcomes per intent", ["result"])
+QUOTA_WAIT_SECONDS = Histogram(
+    "quota_wait_seconds", "Time spent waiting for a Gemini/BigQuery rate token", ["service"], buckets=LATENCY_BUCKETS
+)
+QUOTA_RETRIES = Counter("quota_retries_total", "Calls retried after a rate-limit error", ["service"])
+MODEL_TIER_SECONDS = Histogram(
+    "model_tier_seconds", "Time spent in each model cascade tier", ["tier"], buckets=LATENCY_BUCKETS
+)
+MODEL_TIER_TOKENS = Counter("model_tier_tokens_total", "LLM tokens used per cascade tier", ["tier", "kind"])
+MODEL_TIER_COST = Counter("model_tier_cost_usd_total", "Estimated LLM cost per cascade tier (USD)", ["tier"])
+CASCADE_RESULTS = Counter("model_cascade_results_total", "Cascade tier outcomes", ["tier", "result"])
+CASCADE_ESCALATIONS = Counter("model_cascade_escalations_total", "Cascade escalations by reason", ["tier", "reason"])
+SQL_REWRITES = Counter("sql_rewrites_total", "Agent SQL rewrites and rejections", ["action"])
+BQ_JOB_SECONDS = Histogram(
+    "bigquery_job_seconds", "BigQuery job wall time by execution mode", ["mode", "status"], buckets=LATENCY_BUCKETS
+)
+BQ_JOBS_DEDUPLICATED = Counter("bigquery_jobs_deduplicated_total", "Queries that joined an identical job in flight")
+BQ_JOBS_IN_FLIGHT = Gauge("bigquery_jobs_in_flight", "BigQuery jobs currently running", multiprocess_mode="livesum")
+BQ_SLOT_MILLIS = Counter("bigquery_slot_millis_total", "BigQuery slot time used", ["mode"])
+ROLLUP_REFRESHES = Counter("rollup_refreshes_total", "Rollup table rebuilds", ["rollup", "status"])
+ROLLUP_LAST_REFRESH = Gauge(
+    "rollup_last_refresh_timestamp_seconds", "When each rollup was last rebuilt", ["rollup"], multiprocess_mode="max"
+)
+
+
+class CacheDbCollector:
+    """Reports the size of cache.db at scrape time (shared by all workers)."""
+
+    def describe(self):
+        # Lets the registry check names without calling collect() during import
+        return [GaugeMetricFamily("cache_db_bytes", "Size of the SQLite cache database")]
+
+    def collect(self):
+        # Imported here because cache_manager itself reports to this module
+        from cache.cache_manager import DB_PATH
+        size = os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0
+        yield GaugeMetricFamily("cache_db_bytes", "Size of the SQLite cache database", value=size)
+
+
+if not MULTIPROC_DIR:
+    REGISTRY.register(CacheDbCollector())
+
+
+def metrics_payload():
+    """Return (body, content type) for the /metrics endpoint."""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(CacheDbCollector())
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead(pid: int):
+    """Call from the process manager when a worker exits (e.g. gunicorn's child_exit hook)."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def record_query(purpose: str, estimated_bytes, billed_bytes, status: str):
+    BQ_QUERIES.labels(purpose, status).inc()
+    BQ_BYTES.labels(purpose, "estimated").inc(estimated_bytes or 0)
+    BQ_QUERY_BYTES.labels(purpose).observe(estimated_bytes or 0)
+    if billed_bytes:
+        BQ_BYTES.labels(purpose, "billed").inc(billed_bytes)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Counts and times the agent's tool calls."""
+
+    def __init__(self):
+        self._started = {}
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._started[run_id] = ((serialized or {}).get("name", "tool"), time.time())
+
+    def _finish(self, run_id, status):
+        name, started = self._started.pop(run_id, ("tool", None))
+        if started is None:
+            return
+        TOOL_CALLS.labels(name, status).inc()
+        TOOL_CALL_SECONDS.labels(name).observe(time.time() - started)
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish(run_id, "ok")
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, "error")
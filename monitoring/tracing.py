@@ -0,0 +1,369 @@
+# tracing.py
+"""
+Span-based latency tracing for the /chat pipeline.
+
+Spans are recorded in-process (a trace per request, parent/child via a ContextVar)
+and exported when the request finishes:
+  - TRACE_EXPORT=off (default): nothing is recorded
+  - TRACE_EXPORT=json: one JSON line per request in TRACE_FILE, written by a background
+    thread and rotated at TRACE_FILE_MAX_BYTES (TRACE_FILE_BACKUPS old files are kept)
+  - TRACE_EXPORT=otlp: replayed into OpenTelemetry and sent to the OTLP collector
+    configured by the standard OTEL_EXPORTER_OTLP_* variables (needs opentelemetry-sdk)
+With TRACE_DEBUG=1 a per-request waterfall is printed to the console.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from langchain_core.callbacks import BaseCallbackHandler
+
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "off").lower()
+TRACE_FILE = os.environ.get("TRACE_FILE", os.path.join("traces", "traces.jsonl"))
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024))
+TRACE_FILE_BACKUPS = int(os.environ.get("TRACE_FILE_BACKUPS", 3))
+TRACE_QUEUE_SIZE = 1000  # Traces waiting for the writer thread; more are dropped
+TRACE_DEBUG = os.environ.get("TRACE_DEBUG", "0").lower() in ("1", "true", "yes")
+WATERFALL_WIDTH = 40
+
+current_trace = ContextVar("current_trace", default=None)
+current_span = ContextVar("current_span", default=None)
+
+_file_lock = threading.Lock()
+_file_logger = None
+_otel_tracer = None
+
+
+class Span:
+    """One timed operation. Times are time.time() seconds."""
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: str = None, attributes: dict = None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, error: BaseException = None):
+        if self.end is None:
+            self.end = time.time()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.time()) - self.start) * 1000
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round(self.duration_ms, 2),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    """All spans recorded for one request."""
+
+    def __init__(self, name: str, attributes: dict = None):
+        self.trace_id = uuid.uuid4().hex
+        self.root = Span(name, attributes=attributes)
+        self.spans = [self.root]
+
+    def add(self, span: Span):
+        self.spans.append(span)
+
+
+def tracing_enabled() -> bool:
+    return TRACE_EXPORT != "off"
+
+
+def begin_trace(name: str, **attributes):
+    """Start the trace for the current request and make its root span current."""
+    if not tracing_enabled():
+        return None
+    trace = Trace(name, attributes)
+    current_trace.set(trace)
+    current_span.set(trace.root)
+    return trace
+
+
+def end_trace(error: BaseException = None):
+    """Finish the current request's trace and export it."""
+    trace = current_trace.get()
+    if trace is None:
+        return None
+    current_trace.set(None)
+    current_span.set(None)
+    trace.root.finish(error)
+    try:
+        _export(trace)
+    except Exception as e:
+        print(f"[TRACE] Export failed: {e}")
+    if TRACE_DEBUG:
+        print(format_waterfall(trace))
+    return trace
+
+
+def get_trace_id():
+    trace = current_trace.get()
+    return trace.trace_id if trace else None
+
+
+def start_span(name: str, parent: Span = None, **attributes):
+    """Create and register a span without making it current (for callback-driven spans)."""
+    trace = current_trace.get()
+    if trace is None:
+        return None
+    parent = parent or current_span.get()
+    span = Span(name, parent.span_id if parent else None, attributes)
+    trace.add(span)
+    return span
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time a block as a child of the current span. Yields the Span (or None when
+    no trace is active, e.g. in background jobs), so callers must check before `set`.
+    """
+    child = start_span(name, **attributes)
+    if child is None:
+        yield None
+        return
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.finish(e)
+        raise
+    finally:
+        current_span.reset(token)
+        child.finish()
+
+
+def traced(name: str = None):
+    """Decorator form of `span`."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attributes):
+    """Add attributes (token counts, bytes scanned, cache hits...) to the current span."""
+    active = current_span.get()
+    if active is not None:
+        active.set(**attributes)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Turns LangChain callbacks into spans: the agent run, every LLM call (with token
+    usage) and every tool call. Tool spans are made current so work inside a tool
+    (BigQuery, FAISS, matplotlib) nests under it.
+    """
+
+    def __init__(self):
+        self._spans = {}
+        self._previous = {}
+
+    def _open(self, run_id, name, parent_run_id=None, make_current=False, **attributes):
+        parent = self._spans.get(parent_run_id)
+        opened = start_span(name, parent=parent, **attributes)
+        if opened is None:
+            return
+        self._spans[run_id] = opened
+        if make_current:
+            self._previous[run_id] = current_span.get()
+            current_span.set(opened)
+
+    def _close(self, run_id, error=None, **attributes):
+        closed = self._spans.pop(run_id, None)
+        if closed is None:
+            return
+        closed.set(**attributes)
+        closed.finish(error)
+        if run_id in self._previous:
+            current_span.set(self._previous.pop(run_id))
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        # Only the outermost chain (the AgentExecutor run) becomes a span
+        if parent_run_id is None:
+            self._open(run_id, "agent", make_current=True)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._close(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._close(run_id, error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        model = (kwargs.get("invocation_params") or {}).get("model") or (serialized or {}).get("name")
+        self._open(run_id, "llm", parent_run_id, model=model,
+                   prompt_messages=sum(len(batch) for batch in messages))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._open(run_id, "llm", parent_run_id, model=(serialized or {}).get("name"))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        input_tokens = output_tokens = cached_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                input_tokens += usage.get("input_tokens", 0)
+                output_tokens += usage.get("output_tokens", 0)
+                cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0)
+        self._close(run_id, input_tokens=input_tokens, output_tokens=output_tokens,
+                    cached_input_tokens=cached_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._close(run_id, error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        name = (serialized or {}).get("name", "tool")
+        self._open(run_id, f"tool:{name}", parent_run_id, make_current=True,
+                   input_chars=len(input_str or ""))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._close(run_id, output_chars=len(str(output)))
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._close(run_id, error)
+
+
+def format_waterfall(trace: Trace) -> str:
+    """Text waterfall of a finished trace, children indented under their parent."""
+    total_ms = max(trace.root.duration_ms, 0.001)
+    children = {}
+    for item in trace.spans[1:]:
+        children.setdefault(item.parent_id, []).append(item)
+
+    lines = [f"[TRACE] {trace.trace_id} {trace.root.name} {total_ms:.1f} ms"]
+
+    def walk(item, depth):
+        offset = int((item.start - trace.root.start) * 1000 / total_ms * WATERFALL_WIDTH)
+        width = max(1, int(item.duration_ms / total_ms * WATERFALL_WIDTH))
+        offset = min(offset, WATERFALL_WIDTH - 1)
+        bar = " " * offset + "#" * min(width, WATERFALL_WIDTH - offset)
+        label = ("  " * depth + item.name)[:38]
+        extras = " ".join(f"{k}={v}" for k, v in item.attributes.items() if v not in (None, ""))
+        if item.error:
+            extras += f" error={item.error}"
+        lines.append(f"  {label:<38} |{bar:<{WATERFALL_WIDTH}}| {item.duration_ms:9.1f} ms {extras}")
+        for child in sorted(children.get(item.span_id, []), key=lambda c: c.start):
+            walk(child, depth + 1)
+
+    walk(trace.root, 0)
+    return "\n".join(lines)
+
+
+def _export(trace: Trace):
+    if TRACE_EXPORT == "otlp" and _export_otlp(trace):
+        return
+    record = {
+        "trace_id": trace.trace_id,
+        "name": trace.root.name,
+        "duration_ms": round(trace.root.duration_ms, 2),
+        "spans": [item.to_dict() for item in trace.spans],
+    }
+    _get_file_logger().info(json.dumps(record, default=str))
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Hands records to the writer thread without ever blocking the request."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def _get_file_logger():
+    """Lazily start the rotating TRACE_FILE writer on a background thread."""
+    global _file_logger
+    if _file_logger is None:
+        with _file_lock:
+            if _file_logger is None:
+                directory = os.path.dirname(TRACE_FILE)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                file_handler = RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_FILE_MAX_BYTES,
+                                                   backupCount=TRACE_FILE_BACKUPS, encoding="utf-8")
+                records = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+                listener = QueueListener(records, file_handler)
+                listener.start()
+                atexit.register(listener.stop)
+                logger = logging.getLogger("trace_export")
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                logger.addHandler(_DroppingQueueHandler(records))
+                _file_logger = logger
+    return _file_logger
+
+
+def _get_otel_tracer():
+    """Lazily configure an OTLP exporter. Returns None if OpenTelemetry is not installed."""
+    global _otel_tracer
+    if _otel_tracer is None:
+        try:
+            from opentelemetry import trace as otel_trace
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            print("[TRACE] opentelemetry-sdk is not installed, writing traces to the JSON file instead")
+            _otel_tracer = False
+            return None
+        provider = TracerProvider(resource=Resource.create({"service.name": "agency-rag-chat"}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        _otel_tracer = provider.get_tracer("agency-rag-chat")
+    return _otel_tracer or None
+
+
+def _export_otlp(trace: Trace) -> bool:
+    tracer = _get_otel_tracer()
+    if tracer is None:
+        return False
+    from opentelemetry import trace as otel_trace
+    from opentelemetry.trace import Status, StatusCode
+
+    otel_spans = {}
+    # Parents start before their children, so replaying in start order keeps links valid
+    for item in sorted(trace.spans, key=lambda s: s.start):
+        parent = otel_spans.get(item.parent_id)
+        context = otel_trace.set_span_in_context(parent) if parent else None
+        attributes = {k: v if isinstance(v, (str, bool, int, float)) else str(v)
+                      for k, v in item.attributes.items() if v is not None}
+        otel_span = tracer.start_span(item.name, context=context, attributes=attributes,
+                                      start_time=int(item.start * 1e9))
+        if item.error:
+            otel_span.set_status(Status(StatusCode.ERROR, item.error))
+        otel_spans[item.span_id] = otel_span
+    for item in trace.spans:
+        otel_spans[item.span_id].end(end_time=int((item.end or time.time()) * 1e9))
+    return True
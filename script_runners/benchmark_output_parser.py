@@ -0,0 +1,123 @@
+# benchmark_output_parser.py
+# Compares the old regex chain from chat() with services/output_parser.py on a corpus of
+# agent answers: the built-in samples below (including the verify_regex_fix.py cases) plus
+# every cached agent answer found in cache.db.
+#
+# Run from the project root:
+#   python -m script_runners.benchmark_output_parser
+import json
+import os
+import re
+import sqlite3
+import timeit
+from cache.cache_manager import DB_PATH
+from services.output_parser import parse_visualization
+
+SAMPLES = {
+    # Cases from script_runners/verify_regex_fix.py
+    "simple_json": 'Here is your flowchart: {"visualization_type": "flowchart", "data": "graph TD; A-->B"}',
+    "mermaid_braces": 'Here is your flowchart: {"visualization_type": "flowchart", "data": "graph TD; A{Decision} --> B"}',
+    "fenced_block": 'Check this out:\n```json\n{"visualization_type": "flowchart", "data": "graph TD; A{Nested} --> B"}\n```',
+    "multiline_json": 'Here is your flowchart:\n{\n  "visualization_type": "flowchart",\n  "data": "graph TD; A-->B"\n}',
+    # Typical chart answers
+    "chart_query": 'Here is the comparison.\n```json\n{"visualization_type": "bar", "visualization_title": "Applications by Status", '
+                   '"data_query": "SELECT Status, COUNT(*) AS total FROM `hackathon_data.application_table` GROUP BY Status"}\n```',
+    "chart_inline_data": 'Monthly trend: {"visualization_type": "line", "visualization_title": "Enquiries", '
+                         '"data": [{"month": "2025-01", "total": 12}, {"month": "2025-02", "total": 19}]} Let me know if you need more.',
+    "sql_newlines": '{"visualization_type": "pie", "visualization_title": "Visits", "data_query": "SELECT visited_branch_name,\n'
+                    'COUNT(*) FROM `hackathon_data.office_visits_table`\nGROUP BY 1"}',
+    "mermaid_unescaped_quotes": '```json\n{"visualization_type": "flowchart", "data": "graph TD\n A["Start"] --> B{"Eligible?"}\n B --> C["Apply"]"}\n```',
+    "prose_braces_first": 'Use {branch} as a placeholder. {"visualization_type": "bar", "visualization_title": "Deals", "data_query": "SELECT 1, 2"}',
+    "no_visualization": "There are 42 open enquiries in Kathmandu this month.",
+    "markdown_table": "| Branch | Total |\n|---|---|\n| Kathmandu | 42 |\n| Pokhara | 17 |",
+}
+
+
+def legacy_parse(final_answer: str):
+    """The regex chain chat() used before services/output_parser.py (JSON part only)."""
+    if "{" not in final_answer and "```json" not in final_answer:
+        return None
+    try:
+        json_block_match = re.search(r'```json\s*(\{.*?\})\s*```', final_answer, re.DOTALL)
+        potential_json = None
+        if json_block_match:
+            potential_json = json_block_match.group(1)
+        else:
+            json_match = re.search(r'(\{[\s\S]*?"visualization_type"[\s\S]*?\})', final_answer)
+            if json_match:
+                potential_json = json_match.group(1)
+        if not potential_json:
+            return None
+        try:
+            parsed = json.loads(potential_json)
+        except json.JSONDecodeError:
+            if "flowchart" in potential_json.lower() or "mermaid" in potential_json.lower():
+                data_match = re.search(r'"data"\s*:\s*"(.*?)"\s*\}', potential_json, re.DOTALL)
+                if data_match:
+                    parsed = {"visualization_type": "flowchart", "data": data_match.group(1)}
+                else:
+                    parsed = json.loads(potential_json.replace('\n', ' ').replace('\r', ''))
+            else:
+                parsed = json.loads(potential_json.replace('\n', ' ').replace('\r', ''))
+        if "visualization_type" in parsed or "chart_type" in parsed:
+            return (parsed.get("visualization_type") or parsed.get("chart_type")).lower()
+    except Exception:
+        return None
+    return None
+
+
+def new_parse(final_answer: str):
+    visualization = parse_visualization(final_answer)
+    return visualization.type if visualization else None
+
+
+def load_cached_answers() -> dict:
+    """Final answers stored by CacheManager for previous agent runs."""
+    answers = {}
+    if not os.path.exists(DB_PATH):
+        return answers
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            for key, value in conn.execute("SELECT key, value FROM cache"):
+                try:
+                    output = json.loads(value).get("output")
+                except Exception:
+                    continue
+                if isinstance(output, str) and output:
+                    answers[f"cached_{key[:8]}"] = output
+    except sqlite3.Error as e:
+        print(f"No cached answers loaded: {e}")
+    return answers
+
+
+def long_answer(rows: int) -> str:
+    """A long markdown answer with many braces and no visualization (worst case for lazy scans)."""
+    lines = [f"| {{row {i}}} | value {i} | \"quoted\" |" for i in range(rows)]
+    return "Results:\n" + "\n".join(lines) + '\n{"note": "no chart here"'
+
+
+def time_call(func, text: str, number: int) -> float:
+    return timeit.timeit(lambda: func(text), number=number) / number * 1e6
+
+
+def main():
+    corpus = dict(SAMPLES)
+    corpus.update(load_cached_answers())
+    corpus["long_answer_2k_rows"] = long_answer(2000)
+
+    print(f"{'case':<28} {'legacy':>10} {'new':>10} {'legacy us':>11} {'new us':>9}")
+    total_legacy = total_new = 0.0
+    for name, text in corpus.items():
+        number = 20 if len(text) > 10000 else 500
+        legacy_result, new_result = legacy_parse(text), new_parse(text)
+        legacy_us, new_us = time_call(legacy_parse, text, number), time_call(new_parse, text, number)
+        total_legacy += legacy_us
+        total_new += new_us
+        marker = "" if legacy_result == new_result else "  <- differs"
+        print(f"{name:<28} {str(legacy_result):>10} {str(new_result):>10} {legacy_us:>11.1f} {new_us:>9.1f}{marker}")
+
+    print(f"\n{len(corpus)} answers, total per pass: legacy {total_legacy:.1f} us, new {total_new:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,219 @@
+# sqlite_to_chroma.py
+# Streams every table of local_hackathon.db into the `hackathon_data` Chroma collection.
+# Rows are read in chunks, rendered to "col: value | ..." text column-wise, and upserted in
+# batches with stable IDs, so re-runs are idempotent and an interrupted run resumes from
+# its last checkpoint. When db/bq_to_sqlite.py has re-copied a table whole (its rowids
+# start over), the table's checkpoint is reset and its old vectors are replaced. Incremental
+# copies keep the rowids of unchanged rows, so only new or changed rows are embedded again,
+# and log the rowids they delete (`_export_removed`), whose vectors are dropped here.
+#
+# Run from the project root:
+#   python -m script_runners.sqlite_to_chroma            # resume from checkpoints
+#   python -m script_runners.sqlite_to_chroma --reset    # re-ingest everything
+import argparse
+import hashlib
+import json
+import os
 import sqlite3
+import time
 import pandas as pd
 from langchain_community.vectorstores import Chroma
 from langchain_ollama import OllamaEmbeddings
-from langchain_core.documents import Document
+from db.catalog import branch_column
+
 SQLITE_FILE = "local_hackathon.db"
 VECTOR_DB_DIR = "chroma_db"
+COLLECTION_NAME = "hackathon_data"
+CHECKPOINT_FILE = os.path.join(VECTOR_DB_DIR, "ingest_checkpoint.json")
+CHUNK_ROWS = 2000  # Rows read from SQLite at a time
+EMBED_BATCH = 256  # Rows embedded and upserted per request
+MAX_RETRIES = 3
+
+
+def load_checkpoints() -> dict:
+    if os.path.exists(CHECKPOINT_FILE):
+        with open(CHECKPOINT_FILE) as f:
+            return json.load(f)
+    return {}
+
+
+def save_checkpoints(checkpoints: dict):
+    tmp_path = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoints, f)
+    os.replace(tmp_path, CHECKPOINT_FILE)
+
+
+def source_version(conn, table: str):
+    """When bq_to_sqlite last rebuilt the table (None if unknown); rowids restart on a rebuild."""
+    try:
+        row = conn.execute("SELECT full_at FROM _export_state WHERE table_name = ?", (table,)).fetchone()
+    except sqlite3.OperationalError:
+        return None  # Not written by bq_to_sqlite, or by a version without full_at
+    return row[0] if row else None
+
+
+def resume_rowid(conn, vector_db, table: str, checkpoints: dict) -> int:
+    """
+    The rowid to resume the table from.
+
+    A checkpoint from before the table was rebuilt (different source version, or past
+    the table's last rowid) is meaningless, so the table's vectors are dropped and it
+    is ingested from the start.
+    """
+    checkpoint = checkpoints.get(table)
+    if checkpoint is None:
+        return 0
+    if isinstance(checkpoint, int):
+        checkpoint = {"rowid": checkpoint, "source": None}  # Checkpoints written before versions were tracked
+    version = source_version(conn, table)
+    max_rowid = conn.execute(f'SELECT COALESCE(MAX(rowid), 0) FROM "{table}"').fetchone()[0]
+    if checkpoint.get("source") == version and checkpoint["rowid"] <= max_rowid:
+        return checkpoint["rowid"]
+    print(f"  {table} was rebuilt since the last run; re-ingesting it")
+    vector_db._collection.delete(where={"table": table})
+    checkpoints.pop(table, None)
+    save_checkpoints(checkpoints)
+    return 0
+
+
+def drop_removed_rows(conn, vector_db, table: str) -> int:
+    """Delete the vectors of rows an incremental copy removed, then clear the removal log."""
+    try:
+        rowids = [row[0] for row in conn.execute(
+            "SELECT row_id FROM _export_removed WHERE table_name = ?", (table,)
+        )]
+    except sqlite3.OperationalError:
+        return 0  # Not written by bq_to_sqlite, or by a version without the log
+    for start in range(0, len(rowids), EMBED_BATCH):
+        chunk = rowids[start:start + EMBED_BATCH]
+        vector_db._collection.delete(where={"$and": [{"table": table}, {"row_id": {"$in": chunk}}]})
+    with conn:
+        conn.execute("DELETE FROM _export_removed WHERE table_name = ?", (table,))
+    return len(rowids)
+
+
+def find_primary_key(conn, table: str):
+    """First `id`/`*_id` column whose values are unique, used for stable document IDs."""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+    for col in columns:
+        if col.lower() == "id" or col.lower().endswith("_id"):
+            distinct, total = conn.execute(
+                f'SELECT COUNT(DISTINCT "{col}"), COUNT(*) FROM "{table}"'
+            ).fetchone()
+            if distinct == total:
+                return col
+    return None
+
+
+def render_rows(df: pd.DataFrame) -> pd.Series:
+    """Vectorized 'col: value | col: value' rendering of every row."""
+    values = df.astype(str)
+    rendered = None
+    for col in df.columns:
+        part = f"{col}: " + values[col]
+        rendered = part if rendered is None else rendered + " | " + part
+    return rendered
+
+
+def upsert_batch(vector_db, texts, metadatas, ids):
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            vector_db.add_texts(texts, metadatas=metadatas, ids=ids)  # Chroma upserts by ID
+            return
+        except Exception as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"  Batch failed ({e}); retrying in {2 ** attempt}s")
+            time.sleep(2 ** attempt)
+
+
+def ingest_table(conn, vector_db, table: str, checkpoints: dict):
+    pk = find_primary_key(conn, table)
+    branch_col = branch_column(table)
+    last_rowid = resume_rowid(conn, vector_db, table, checkpoints)
+    removed = drop_removed_rows(conn, vector_db, table)
+    if removed:
+        print(f"  {table}: dropped vectors of {removed} rows removed upstream")
+    version = source_version(conn, table)
+    ingested = 0
+    started = time.time()
+
+    while True:
+        # Keyset pagination on rowid keeps memory bounded and makes checkpoints exact
+        df = pd.read_sql_query(
+            f'SELECT rowid AS __rowid, * FROM "{table}" WHERE rowid > ? ORDER BY rowid LIMIT ?',
+            conn, params=(last_rowid, CHUNK_ROWS)
+        )
+        if df.empty:
+            break
+
+        rowids = df.pop("__rowid")
+        texts = render_rows(df)
+        if pk:
+            ids = f"{table}:" + df[pk].astype(str)
+        else:
+            # The rowid keeps identical rows apart; Chroma rejects duplicate IDs in one upsert
+            ids = pd.Series(
+                [f"{table}:" + hashlib.sha1(f"{rowid}:{text}".encode()).hexdigest()
+                 for rowid, text in zip(rowids, texts)],
+                index=texts.index
+            )
+
+        metadatas = pd.DataFrame({"table": table, "row_id": rowids.astype(int)})
+        if pk:
+            metadatas["pk_column"] = pk
+            metadatas["pk"] = df[pk].astype(str)
+        if branch_col in df.columns:
+            metadatas["branch"] = df[branch_col].fillna("").astype(str)
+        metadatas = metadatas.to_dict(orient="records")
+
+        for start in range(0, len(df), EMBED_BATCH):
+            end = start + EMBED_BATCH
+            upsert_batch(vector_db, texts.iloc[start:end].tolist(), metadatas[start:end], ids.iloc[start:end].tolist())
+            last_rowid = int(rowids.iloc[min(end, len(df)) - 1])
+            checkpoints[table] = {"rowid": last_rowid, "source": version}
+            save_checkpoints(checkpoints)
+            ingested += min(end, len(df)) - start
+
+        print(f"  {table}: {ingested} rows ({ingested / max(time.time() - started, 1e-6):,.0f} rows/s)")
+
+    return ingested
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed local_hackathon.db rows into Chroma")
+    parser.add_argument("--reset", action="store_true", help="Drop each table's vectors and re-ingest every row")
+    args = parser.parse_args()
+
+    os.makedirs(VECTOR_DB_DIR, exist_ok=True)
+    checkpoints = {} if args.reset else load_checkpoints()
+
+    # Initialize Ollama embeddings
+    embeddings = OllamaEmbeddings(model="llama3.2")
+
+    # Initialize Chroma
+    vector_db = Chroma(
+        persist_directory=VECTOR_DB_DIR,
+        embedding_function=embeddings,
+        collection_name=COLLECTION_NAME
+    )
+
+    # Load SQLite tables (skip exporter bookkeeping and staging tables)
+    conn = sqlite3.connect(SQLITE_FILE)
+    tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
+    tables = [t[0] for t in tables if not t[0].startswith("_") and not t[0].endswith("__staging")]
+
+    total = 0
+    for table in tables:
+        print(f"Ingesting {table}")
+        if args.reset:
+            vector_db._collection.delete(where={"table": table})  # IDs of rows without a key change
+        total += ingest_table(conn, vector_db, table, checkpoints)
+
+    conn.close()
+    print(f"✅ Vector DB updated with {total} rows from hackathon_data")
+
 
-# Initialize Ollama embeddings
-embeddings = OllamaEmbeddings(model="llama3.2")
-
-# Initialize Chroma
-vector_db = Chroma(
-    persist_directory=VECTOR_DB_DIR,
-    embedding_function=embeddings,
-    collection_name="hackathon_data"
-)
-
-# Load SQLite tables
-conn = sqlite3.connect(SQLITE_FILE)
-cursor = conn.cursor()
-tables = cursor.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
-tables = [t[0] for t in tables]
-
-all_docs = []
-for table in tables:
-    df = pd.read_sql_query(f"SELECT * FROM {table}", conn)
-    for _, row in df.iterrows():
-        content = " | ".join([f"{col}: {row[col]}" for col in df.columns])
-        all_docs.append(Document(page_content=content, metadata={"table": table}))
-
-conn.close()
-
-# Add to Chroma
-vector_db.add_documents(all_docs)
-vector_db.persist()
-print("✅ Vector DB updated with all tables from hackathon_data")
+if __name__ == "__main__":
+    main()
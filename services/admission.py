@@ -0,0 +1,299 @@
+# admission.py
+"""
+Admission control and quota-aware backpressure for /chat.
+
+- Concurrency: at most CHAT_MAX_CONCURRENT chat requests run at once and each user may
+  have CHAT_MAX_PER_USER in flight. Extra requests wait in a bounded queue
+  (CHAT_QUEUE_SIZE) for up to CHAT_QUEUE_TIMEOUT seconds, then get a 503.
+- Quotas: token buckets pace Gemini calls (GEMINI_REQUESTS_PER_MINUTE) and BigQuery
+  jobs (BQ_QUERIES_PER_MINUTE). A rate-limit error from either service empties its
+  bucket for QUOTA_COOLDOWN_SECONDS, and new chat requests are turned away with a 429
+  until the cooldown ends.
+- Retries: rate-limit errors are retried with jittered exponential backoff
+  (QUOTA_RETRY_ATTEMPTS) instead of failing the whole agent run.
+
+Rejections carry a Retry-After value. The limits are per process, so with several
+Gunicorn workers the server-wide ceiling is workers x CHAT_MAX_CONCURRENT.
+"""
+import math
+import os
+import random
+import threading
+import time
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.exceptions import ModelRateLimitError
+from monitoring.metrics import (
+    ADMISSION_REJECTIONS, ADMISSION_WAIT_SECONDS, CHAT_IN_FLIGHT, QUOTA_WAIT_SECONDS, QUOTA_RETRIES
+)
+
+CHAT_MAX_CONCURRENT = int(os.environ.get("CHAT_MAX_CONCURRENT", 8))
+CHAT_MAX_PER_USER = int(os.environ.get("CHAT_MAX_PER_USER", 2))
+CHAT_QUEUE_SIZE = int(os.environ.get("CHAT_QUEUE_SIZE", 16))
+CHAT_QUEUE_TIMEOUT = float(os.environ.get("CHAT_QUEUE_TIMEOUT", 15))
+
+# 0 disables a bucket
+GEMINI_REQUESTS_PER_MINUTE = float(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", 1000))
+BQ_QUERIES_PER_MINUTE = float(os.environ.get("BQ_QUERIES_PER_MINUTE", 600))
+QUOTA_MAX_WAIT = float(os.environ.get("QUOTA_MAX_WAIT_SECONDS", 10))  # Longest a call waits for a token
+QUOTA_COOLDOWN_SECONDS = float(os.environ.get("QUOTA_COOLDOWN_SECONDS", 10))
+
+QUOTA_RETRY_ATTEMPTS = int(os.environ.get("QUOTA_RETRY_ATTEMPTS", 3))
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 8.0
+
+_QUOTA_MARKERS = ("429", "resource exhausted", "resource_exhausted", "quota", "rate limit", "ratelimitexceeded")
+
+
+class AdmissionRejected(Exception):
+    """A request (or call) was turned away; `retry_after` is in whole seconds."""
+
+    MESSAGES = {
+        "user_limit": "You already have questions in progress. Please wait for them to finish.",
+        "queue_full": "The assistant is busy right now. Please try again shortly.",
+        "queue_timeout": "The assistant is busy right now. Please try again shortly.",
+        "gemini_quota": "I am currently receiving too many requests. Please wait a moment and try again.",
+    }
+
+    def __init__(self, reason: str, retry_after: float, status: int = 429):
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.status = status
+        self.message = self.MESSAGES.get(reason, "Please try again shortly.")
+        super().__init__(f"{reason} (quota backpressure), retry after {self.retry_after}s")
+
+
+def is_quota_error(error: BaseException) -> bool:
+    """True for rate-limit / quota errors from Gemini or BigQuery (not our own rejections)."""
+    if isinstance(error, AdmissionRejected):
+        return False
+    if isinstance(error, ModelRateLimitError):
+        return True
+    try:
+        from google.api_core import exceptions as google_exceptions
+        if isinstance(error, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted)):
+            return True
+    except ImportError:
+        pass
+    text = str(error).lower()
+    return any(marker in text for marker in _QUOTA_MARKERS)
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `per_minute / 60` tokens per second."""
+
+    def __init__(self, service: str, per_minute: float, burst: float = None):
+        self.service = service
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1.0, per_minute / 4)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _wait_locked(self, now: float) -> float:
+        if now < self._cooldown_until:
+            return self._cooldown_until - now
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def cooldown_remaining(self) -> float:
+        return max(0.0, self._cooldown_until - time.monotonic())
+
+    def available(self) -> float:
+        """Tokens that could be taken right now (the full burst when the bucket is disabled)."""
+        if not self.enabled:
+            return self.capacity
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return 0.0 if now < self._cooldown_until else self._tokens
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available."""
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._wait_locked(now)
+
+    def acquire(self, timeout: float = QUOTA_MAX_WAIT) -> bool:
+        """Take a token, sleeping up to `timeout` seconds for one. Returns False if none came."""
+        if not self.enabled:
+            return True
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_locked(now)
+                if wait == 0:
+                    self._tokens -= 1
+                    QUOTA_WAIT_SECONDS.labels(self.service).observe(now - started)
+                    return True
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def penalize(self, cooldown: float = QUOTA_COOLDOWN_SECONDS):
+        """The provider said we are over quota: stop handing out tokens for a while."""
+        with self._lock:
+            self._tokens = 0.0
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + cooldown)
+
+
+gemini_bucket = TokenBucket("gemini", GEMINI_REQUESTS_PER_MINUTE)
+bigquery_bucket = TokenBucket("bigquery", BQ_QUERIES_PER_MINUTE)
+
+
+class AdmissionController:
+    """Global and per-user concurrency limits with a bounded, deadline-limited wait queue."""
+
+    def __init__(self, max_concurrent: int = CHAT_MAX_CONCURRENT, max_per_user: int = CHAT_MAX_PER_USER,
+                 queue_size: int = CHAT_QUEUE_SIZE, queue_timeout: float = CHAT_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._per_user = {}
+        self._avg_seconds = 5.0  # Moving average of request duration, used for Retry-After
+
+    def retry_after(self) -> float:
+        return self._avg_seconds
+
+    def load(self) -> int:
+        """Chat requests running or waiting for a slot in this process."""
+        with self._condition:
+            return self._in_flight + self._waiting
+
+    def _reject(self, reason: str, retry_after: float, status: int = 429):
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        print(f"[ADMISSION] Rejected ({reason}), retry after {retry_after:.1f}s")
+        raise AdmissionRejected(reason, retry_after, status)
+
+    def acquire(self, user_id: str):
+        """
+        Admit a request, waiting for a free slot if needed.
+
+        Returns:
+            A ticket to pass to `release` when the request finishes.
+
+        Raises:
+            AdmissionRejected: Over the user's limit, queue full or timed out, or in a quota cooldown.
+        """
+        cooldown = gemini_bucket.cooldown_remaining()
+        if cooldown:
+            self._reject("gemini_quota", cooldown)
+
+        started = time.monotonic()
+        with self._condition:
+            if self._per_user.get(user_id, 0) >= self.max_per_user:
+                self._reject("user_limit", self._avg_seconds)
+            if self._in_flight >= self.max_concurrent or self._waiting:
+                if self._waiting >= self.queue_size:
+                    self._reject("queue_full", self._avg_seconds, 503)
+                self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+                self._waiting += 1
+                deadline = started + self.queue_timeout
+                try:
+                    while self._in_flight >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or not self._condition.wait(remaining):
+                            if self._in_flight >= self.max_concurrent:
+                                self._release_user(user_id)
+                                self._reject("queue_timeout", self._avg_seconds, 503)
+                finally:
+                    self._waiting -= 1
+            else:
+                self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+            self._in_flight += 1
+
+        CHAT_IN_FLIGHT.inc()
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+        return user_id, time.monotonic()
+
+    def _release_user(self, user_id: str):
+        remaining = self._per_user.get(user_id, 1) - 1
+        if remaining > 0:
+            self._per_user[user_id] = remaining
+        else:
+            self._per_user.pop(user_id, None)
+
+    def release(self, ticket):
+        user_id, admitted_at = ticket
+        with self._condition:
+            self._in_flight -= 1
+            self._release_user(user_id)
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (time.monotonic() - admitted_at)
+            self._condition.notify()
+        CHAT_IN_FLIGHT.dec()
+
+
+admission = AdmissionController()
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for retry number `attempt` (0-based)."""
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+def retry_with_backoff(func, service: str, attempts: int = QUOTA_RETRY_ATTEMPTS):
+    """Call `func()`, retrying rate-limit errors with jittered backoff."""
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_quota_error(e):
+                raise
+            QUOTA_RETRIES.labels(service).inc()
+            delay = backoff_delay(attempt)
+            print(f"[QUOTA] {service} rate limited, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+
+def _retry_gemini(error: BaseException) -> bool:
+    if not is_quota_error(error):
+        return False
+    QUOTA_RETRIES.labels("gemini").inc()
+    return True
+
+
+def with_quota_retry(runnable):
+    """Retry one agent step (a single Gemini call) on rate-limit errors with jittered backoff."""
+    return runnable.with_retry(
+        retry_if_exception_type=_retry_gemini,
+        wait_exponential_jitter=True,
+        exponential_jitter_params={"initial": RETRY_BASE_SECONDS, "max": RETRY_MAX_SECONDS},
+        stop_after_attempt=QUOTA_RETRY_ATTEMPTS,
+    )
+
+
+class QuotaCallbackHandler(BaseCallbackHandler):
+    """Takes a Gemini token before every LLM call and starts a cooldown on rate-limit errors."""
+    raise_error = True  # A missing token must stop the call, not just be logged
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._take_token()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._take_token()
+
+    @staticmethod
+    def _take_token():
+        if not gemini_bucket.acquire(QUOTA_MAX_WAIT):
+            raise AdmissionRejected("gemini_quota", gemini_bucket.wait_time())
+
+    def on_llm_error(self, error, **kwargs):
+        if is_quota_error(error):
+            gemini_bucket.penalize()
@@ -0,0 +1,162 @@
+# agent_budget.py
+"""
+Per-request budget for the agent: iterations, wall time and prompt tokens.
+
+Without limits a confused agent keeps calling tools, and every tool observation
+(`list_tables` schemas, 50-row JSON dumps, base64 charts) is sent back to the model on
+every later iteration. For each /chat request:
+  - every tier stops after its `max_iterations` (AGENT_MAX_ITERATIONS for the full agent)
+  - all tiers together stop after AGENT_MAX_EXECUTION_SECONDS of wall time and
+    AGENT_MAX_PROMPT_TOKENS input tokens (`BudgetedAgentExecutor` checks the request's
+    `AgentBudget` before each iteration)
+  - base64 charts, and older observations longer than TOOL_OUTPUT_MAX_CHARS, are
+    shortened before they re-enter the scratchpad (`trim_observations`); the full
+    observation stays in `intermediate_steps` for the response
+  - a run that stops early answers with what its tools found so far (`partial_answer`)
+    instead of "Agent stopped due to iteration limit or time limit."
+"""
+import json
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_classic.agents import AgentExecutor
+
+from monitoring.metrics import AGENT_BUDGET_STOPS, TOOL_OUTPUT_TRIMMED_CHARS
+from services.output_parser import normalize_output
+
+AGENT_MAX_ITERATIONS = int(os.environ.get("AGENT_MAX_ITERATIONS", 8))
+AGENT_MAX_EXECUTION_SECONDS = float(os.environ.get("AGENT_MAX_EXECUTION_SECONDS", 60))
+AGENT_MAX_PROMPT_TOKENS = int(os.environ.get("AGENT_MAX_PROMPT_TOKENS", 200_000))  # 0 disables the token cap
+TOOL_OUTPUT_MAX_CHARS = int(os.environ.get("TOOL_OUTPUT_MAX_CHARS", 6000))  # 0 keeps observations whole
+PARTIAL_ANSWER_MAX_CHARS = 2000
+
+STOPPED_EARLY = "agent stopped due to"
+
+current_budget = ContextVar("agent_budget", default=None)
+
+
+class AgentBudget(BaseCallbackHandler):
+    """
+    Wall time and prompt tokens one request may spend across every agent run.
+    Pass it as a callback so it sees each LLM call's token usage.
+    """
+
+    def __init__(self, max_seconds: float = AGENT_MAX_EXECUTION_SECONDS,
+                 max_prompt_tokens: int = AGENT_MAX_PROMPT_TOKENS):
+        self.max_seconds = max_seconds
+        self.max_prompt_tokens = max_prompt_tokens
+        self.prompt_tokens = 0
+        self.started = time.time()
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                self.prompt_tokens += usage.get("input_tokens", 0)
+
+    def exhausted(self) -> Optional[str]:
+        """"time" or "tokens" once that part of the budget is spent, else None."""
+        if self.max_seconds and time.time() - self.started >= self.max_seconds:
+            return "time"
+        if self.max_prompt_tokens and self.prompt_tokens >= self.max_prompt_tokens:
+            return "tokens"
+        return None
+
+
+def start_budget(max_seconds: float = AGENT_MAX_EXECUTION_SECONDS) -> AgentBudget:
+    """Bind a fresh budget to the current request. Call before invoking the agent."""
+    budget = AgentBudget(max_seconds=max_seconds)
+    current_budget.set(budget)
+    return budget
+
+
+def budget_exhausted() -> Optional[str]:
+    budget = current_budget.get()
+    return budget.exhausted() if budget is not None else None
+
+
+class BudgetedAgentExecutor(AgentExecutor):
+    """AgentExecutor that also stops between iterations once the request's budget is spent."""
+
+    def _should_continue(self, iterations: int, time_elapsed: float) -> bool:
+        if not super()._should_continue(iterations, time_elapsed):
+            return False
+        return budget_exhausted() is None
+
+
+def _shorten(observation: str, limit: Optional[int]) -> str:
+    """Fit one observation into `limit` characters (None only drops images), keeping whole rows of a JSON result."""
+    try:
+        data = json.loads(observation)
+    except (TypeError, ValueError):
+        data = None
+    if isinstance(data, dict) and "image" in data:
+        # A base64 chart means nothing to the model
+        return json.dumps({**data, "image": "<image rendered for the user>"})
+    if limit is None:
+        return observation
+    if isinstance(data, list) and data:
+        kept, size = [], 2
+        for row in data:
+            size += len(json.dumps(row)) + 2
+            if size > limit:
+                break
+            kept.append(row)
+        return json.dumps(kept) + f"\n[{len(kept)} of {len(data)} rows shown; aggregate in SQL to see the rest]"
+    return observation[:limit] + f"\n[truncated {len(observation) - limit} characters]"
+
+
+def trim_observations(intermediate_steps: list) -> list:
+    """
+    `trim_intermediate_steps` hook: shorten large observations before they go back to the model.
+    The newest observation is kept whole (the model has not read it yet) unless it is an image.
+    """
+    if not TOOL_OUTPUT_MAX_CHARS:
+        return intermediate_steps
+    trimmed = []
+    for index, (action, observation) in enumerate(intermediate_steps):
+        limit = None if index == len(intermediate_steps) - 1 else TOOL_OUTPUT_MAX_CHARS
+        if isinstance(observation, str) and len(observation) > TOOL_OUTPUT_MAX_CHARS:
+            shortened = _shorten(observation, limit)
+            TOOL_OUTPUT_TRIMMED_CHARS.labels(action.tool).inc(len(observation) - len(shortened))
+            observation = shortened
+        trimmed.append((action, observation))
+    return trimmed
+
+
+def stopped_early(result: dict) -> bool:
+    return normalize_output(result.get("output", "")).strip().lower().startswith(STOPPED_EARLY)
+
+
+def partial_answer(result: dict) -> dict:
+    """
+    Replace the executor's stop message with the most useful tool output of the run.
+
+    Returns:
+        The result unchanged if the run finished, else a copy with a partial `output`
+        and `budget_stop` set to "iterations", "time" or "tokens".
+    """
+    if not stopped_early(result):
+        return result
+    reason = budget_exhausted() or "iterations"
+    AGENT_BUDGET_STOPS.labels(reason).inc()
+    print(f"[BUDGET] Agent stopped early ({reason}) after {len(result.get('intermediate_steps', []))} steps")
+
+    findings = None
+    for action, observation in reversed(result.get("intermediate_steps", [])):
+        tool = action.tool if hasattr(action, "tool") else action.get("tool")
+        text = observation if isinstance(observation, str) else str(observation)
+        if tool in ("execute_sql", "search_documents", "search_table_rows") \
+                and text.strip() not in ("", "[]") and not text.startswith("Error"):
+            findings = _shorten(text, PARTIAL_ANSWER_MAX_CHARS) if len(text) > PARTIAL_ANSWER_MAX_CHARS else text
+            break
+
+    output = "I could not finish this answer within the time and cost limits for a single request."
+    if findings:
+        output += f" Here is what I found so far:\n\n{findings}"
+    else:
+        output += " Please ask a narrower question, for example for one branch or a shorter date range."
+    return {**result, "output": output, "budget_stop": reason}
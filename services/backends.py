@@ -0,0 +1,66 @@
+# backends.py
+"""
+Factories for the external services the app talks to (Gemini, BigQuery, embeddings).
+
+With FAKE_BACKENDS=1 every factory returns the deterministic offline stand-in from
+benchmarks/fakes.py instead: a scripted tool-calling chat model, a DuckDB-backed
+BigQuery client with a synthetic `hackathon_data` dataset, and hash-based embeddings.
+This is what the benchmarks and the load generator run against.
+"""
+import json
+import os
+
+FAKE_BACKENDS = os.environ.get("FAKE_BACKENDS", "0") == "1"
+
+CHAT_MODEL = "gemini-2.5-flash"
+DOCUMENT_EMBEDDING_MODEL = "models/embedding-001"
+# Lets BigQuery answer short queries without creating a job (JOB_CREATION_REQUIRED turns it off)
+BQ_JOB_CREATION_MODE = os.environ.get("BQ_JOB_CREATION_MODE", "JOB_CREATION_OPTIONAL")
+
+
+def create_chat_model(model: str = CHAT_MODEL, **kwargs):
+    """Chat model used by the agent."""
+    if FAKE_BACKENDS:
+        from benchmarks.fakes import FakeAgentChatModel
+        return FakeAgentChatModel(model=model)
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model=model, **kwargs)
+
+
+def create_bq_client(project: str):
+    """Returns a BigQuery client, using environment variable JSON if available."""
+    if FAKE_BACKENDS:
+        from benchmarks.fakes import FakeBigQueryClient
+        return FakeBigQueryClient(project)
+
+    from google.cloud import bigquery
+    json_creds = os.environ.get('GCP_SERVICE_ACCOUNT_JSON')
+    if json_creds:
+        from google.oauth2 import service_account
+        try:
+            info = json.loads(json_creds)
+            credentials = service_account.Credentials.from_service_account_info(info)
+            return bigquery.Client(project=project, credentials=credentials,
+                                   default_job_creation_mode=BQ_JOB_CREATION_MODE)
+        except Exception as e:
+            print(f"Error loading GCP_SERVICE_ACCOUNT_JSON: {e}")
+    # Fallback to default (works locally if GOOGLE_APPLICATION_CREDENTIALS is set)
+    return bigquery.Client(project=project, default_job_creation_mode=BQ_JOB_CREATION_MODE)
+
+
+def create_document_embeddings():
+    """Embeddings for the PDF document index (FAISS)."""
+    if FAKE_BACKENDS:
+        from benchmarks.fakes import fake_embeddings
+        return fake_embeddings()
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    return GoogleGenerativeAIEmbeddings(model=DOCUMENT_EMBEDDING_MODEL)
+
+
+def create_row_embeddings(model: str):
+    """Embeddings for the table-row index (Chroma)."""
+    if FAKE_BACKENDS:
+        from benchmarks.fakes import fake_embeddings
+        return fake_embeddings()
+    from langchain_ollama import OllamaEmbeddings
+    return OllamaEmbeddings(model=model)
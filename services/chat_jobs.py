@@ -0,0 +1,350 @@
+# chat_jobs.py
+"""
+Background jobs for long /chat questions.
+
+Questions that take longer than the hosting platform's HTTP timeout are submitted as
+jobs instead: the client gets a job id straight away, then polls (optionally
+long-polling with `wait`) or subscribes to server-sent events, and fetches the answer
+when the job is done. The answer is the same JSON /chat would have returned.
+
+Job state lives in the `chat_jobs` table of cache.db, so every worker process sees
+every job and queued jobs survive a restart. Each process runs CHAT_JOB_WORKERS
+threads that claim queued jobs from the table (oldest first). A job runs under an
+agent budget of CHAT_JOB_MAX_SECONDS instead of the interactive one, and a user may
+have CHAT_JOB_MAX_PER_USER jobs queued or running. Finished jobs are deleted after
+CHAT_JOB_TTL_HOURS; jobs left running by a process that died are marked failed.
+
+A plain /chat request that carries a client `request_id` is recorded here too, as a
+running job owned by that request (track_inline / finish_inline). When the hosting
+platform cuts the request off with a 502/504, the browser polls that id instead of
+asking again, so the question is not answered (and added to the history) twice.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+from cache.cache_manager import DB_PATH
+from monitoring.metrics import CHAT_JOBS, CHAT_JOB_SECONDS
+from services.admission import AdmissionRejected
+
+CHAT_JOB_WORKERS = int(os.environ.get("CHAT_JOB_WORKERS", 2))  # Per process; 0 only queues jobs
+CHAT_JOB_MAX_SECONDS = float(os.environ.get("CHAT_JOB_MAX_SECONDS", 600))  # Agent wall-time budget per job
+CHAT_JOB_MAX_PER_USER = int(os.environ.get("CHAT_JOB_MAX_PER_USER", 3))
+CHAT_JOB_TTL_HOURS = int(os.environ.get("CHAT_JOB_TTL_HOURS", 24))
+CHAT_JOB_LONG_POLL_SECONDS = 25  # Longest a status request waits for the job to finish
+IDLE_POLL_SECONDS = 2.0  # How often idle workers look for jobs queued by other processes
+SWEEP_INTERVAL_SECONDS = 300
+
+FINISHED = ("done", "failed", "cancelled")
+INLINE_WORKER = "inline:"  # `worker` prefix of rows tracking a plain /chat request
+_REQUEST_ID = re.compile(r"^[0-9a-f]{32}$")
+
+_jobs_table_ready = False
+
+
+def _init_jobs_table():
+    global _jobs_table_ready
+    if _jobs_table_ready:
+        return
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_jobs (
+                job_id TEXT PRIMARY KEY,
+                user_email TEXT,
+                message TEXT,
+                session TEXT,
+                status TEXT,
+                result TEXT,
+                error TEXT,
+                worker TEXT,
+                created_at REAL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS chat_jobs_status ON chat_jobs (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS chat_jobs_user ON chat_jobs (user_email, created_at)")
+        conn.commit()
+    _jobs_table_ready = True
+
+
+def _iso(timestamp) -> Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="seconds")
+
+
+def _describe(row: sqlite3.Row, with_result: bool = True) -> dict:
+    job = {
+        "job_id": row["job_id"],
+        "status": row["status"],
+        "message": row["message"],
+        "created_at": _iso(row["created_at"]),
+        "started_at": _iso(row["started_at"]),
+        "finished_at": _iso(row["finished_at"]),
+    }
+    if row["status"] == "queued":
+        job["position"] = row["position"] if "position" in row.keys() else None
+    if row["error"]:
+        job["error"] = row["error"]
+    if with_result and row["result"]:
+        job["result"] = json.loads(row["result"])
+    return job
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _connect_immediate() -> sqlite3.Connection:
+    """Connection in autocommit mode, for read-then-write steps wrapped in BEGIN IMMEDIATE."""
+    conn = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class ChatJobQueue:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(ChatJobQueue, cls).__new__(cls)
+            cls._instance._workers = []
+            cls._instance._wakeup = threading.Event()
+            cls._instance._worker_id = f"{os.getpid()}"
+            cls._instance._last_sweep = 0.0
+            cls._instance._sweep_lock = threading.Lock()
+            _init_jobs_table()
+        return cls._instance
+
+    def submit(self, user_email: str, message: str, session_data: dict) -> dict:
+        """
+        Queue a question.
+
+        Args:
+            user_email: Owner of the job; only they can read it.
+            message: The chat message.
+            session_data: The session values /chat reads (email, primary branch, branches).
+
+        Returns:
+            The new job's description (status "queued").
+
+        Raises:
+            AdmissionRejected: If the user already has CHAT_JOB_MAX_PER_USER jobs pending.
+        """
+        self._maybe_sweep()
+        job_id = uuid.uuid4().hex
+        # Count and insert under one write lock so concurrent submits cannot both pass the limit
+        conn = _connect_immediate()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM chat_jobs WHERE user_email = ? AND status IN ('queued', 'running') "
+                "AND (worker IS NULL OR worker NOT LIKE ?)",
+                (user_email, INLINE_WORKER + "%")
+            ).fetchone()[0]
+            if pending < CHAT_JOB_MAX_PER_USER:
+                conn.execute(
+                    "INSERT INTO chat_jobs (job_id, user_email, message, session, status, created_at) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?)",
+                    (job_id, user_email, message, json.dumps(session_data), time.time())
+                )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if pending >= CHAT_JOB_MAX_PER_USER:
+            CHAT_JOBS.labels("rejected").inc()
+            raise AdmissionRejected("user_limit", retry_after=30)
+        CHAT_JOBS.labels("queued").inc()
+        self._wakeup.set()
+        return self.get(job_id, user_email)
+
+    def get(self, job_id: str, user_email: str, wait: float = 0) -> Optional[dict]:
+        """
+        A user's job, or None if it does not exist (or belongs to someone else).
+
+        Args:
+            wait: Seconds to wait for the job to finish before answering (long polling),
+                capped at CHAT_JOB_LONG_POLL_SECONDS.
+        """
+        deadline = time.time() + min(max(wait, 0), CHAT_JOB_LONG_POLL_SECONDS)
+        while True:
+            with _connect() as conn:
+                row = conn.execute(
+                    "SELECT *, (SELECT COUNT(*) FROM chat_jobs q WHERE q.status = 'queued' "
+                    "AND q.created_at <= j.created_at) AS position "
+                    "FROM chat_jobs j WHERE job_id = ? AND user_email = ?",
+                    (job_id, user_email)
+                ).fetchone()
+            if row is None or row["status"] in FINISHED or time.time() >= deadline:
+                return _describe(row) if row else None
+            time.sleep(0.25)
+
+    def list(self, user_email: str, limit: int = 20) -> list:
+        """The user's most recent jobs, newest first, without their results."""
+        self._maybe_sweep()
+        with _connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM chat_jobs WHERE user_email = ? ORDER BY created_at DESC LIMIT ?",
+                (user_email, limit)
+            ).fetchall()
+        return [_describe(row, with_result=False) for row in rows]
+
+    def cancel(self, job_id: str, user_email: str) -> bool:
+        """Cancel a job that has not started yet. Returns False if it is running or finished."""
+        with _connect() as conn:
+            cursor = conn.execute(
+                "UPDATE chat_jobs SET status = 'cancelled', finished_at = ? "
+                "WHERE job_id = ? AND user_email = ? AND status = 'queued'",
+                (time.time(), job_id, user_email)
+            )
+            conn.commit()
+        if cursor.rowcount:
+            CHAT_JOBS.labels("cancelled").inc()
+        return bool(cursor.rowcount)
+
+    def track_inline(self, request_id: str, user_email: str, message: str) -> bool:
+        """
+        Record a /chat request being answered in this process, so the client can poll
+        GET /chat/jobs/<request_id> if its connection is cut off.
+
+        Args:
+            request_id: Client-generated id (32 lowercase hex characters).
+            user_email: The requesting user.
+            message: The chat message.
+
+        Returns:
+            True if the request is tracked, False if the id is malformed or already used.
+        """
+        if not request_id or not _REQUEST_ID.match(request_id):
+            return False
+        with _connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO chat_jobs (job_id, user_email, message, status, worker, created_at, started_at) "
+                "VALUES (?, ?, ?, 'running', ?, ?, ?)",
+                (request_id, user_email, message, f"{INLINE_WORKER}{self._worker_id}", time.time(), time.time())
+            )
+            conn.commit()
+        return bool(cursor.rowcount)
+
+    def finish_inline(self, request_id: str, result: dict, status_code: int):
+        """Store the response of a tracked /chat request."""
+        failed = status_code >= 400
+        error = (result or {}).get("response") if failed else None
+        self._finish(request_id, "failed" if failed else "done", result, error)
+
+    def start(self, runner):
+        """
+        Start this process's worker threads.
+
+        Args:
+            runner: `runner(job)` answers one job, where job has `job_id`, `message` and
+                `session`, and returns (response JSON, HTTP status).
+        """
+        if self._workers or CHAT_JOB_WORKERS <= 0:
+            return
+        for index in range(CHAT_JOB_WORKERS):
+            worker = threading.Thread(target=self._work, args=(runner,), name=f"chat-job-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _claim(self) -> Optional[dict]:
+        """Atomically move the oldest queued job to running; other processes may be claiming too."""
+        conn = _connect_immediate()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT job_id, message, session, created_at FROM chat_jobs "
+                "WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE chat_jobs SET status = 'running', started_at = ?, worker = ? WHERE job_id = ?",
+                    (time.time(), self._worker_id, row["job_id"])
+                )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return {"job_id": row["job_id"], "message": row["message"],
+                "session": json.loads(row["session"]), "created_at": row["created_at"]}
+
+    def _finish(self, job_id: str, status: str, result: dict = None, error: str = None):
+        with _connect() as conn:
+            conn.execute(
+                "UPDATE chat_jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+            )
+            conn.commit()
+
+    def _sweep(self):
+        """Delete expired jobs and fail jobs whose process died while running them."""
+        now = time.time()
+        with _connect() as conn:
+            conn.execute(
+                "DELETE FROM chat_jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+                (now - CHAT_JOB_TTL_HOURS * 3600,)
+            )
+            conn.execute(
+                "UPDATE chat_jobs SET status = 'failed', error = 'interrupted', finished_at = ? "
+                "WHERE status = 'running' AND started_at < ?",
+                (now, now - CHAT_JOB_MAX_SECONDS * 2)
+            )
+            conn.commit()
+
+    def _maybe_sweep(self):
+        """
+        Sweep at most every SWEEP_INTERVAL_SECONDS per process. Called by the workers and
+        by submit/list, so expired jobs are deleted even with CHAT_JOB_WORKERS=0.
+        """
+        if time.time() - self._last_sweep <= SWEEP_INTERVAL_SECONDS:
+            return
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep = time.time()
+            self._sweep()
+        except sqlite3.Error as e:
+            print(f"[CHAT JOB] Sweep failed: {e}")
+        finally:
+            self._sweep_lock.release()
+
+    def _work(self, runner):
+        while True:
+            try:
+                self._maybe_sweep()
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"[CHAT JOB] Queue error: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(IDLE_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+
+            started = time.time()
+            CHAT_JOB_SECONDS.labels("queued").observe(started - job["created_at"])
+            print(f"[CHAT JOB] Running {job['job_id']}")
+            try:
+                result, status_code = runner(job)
+                if status_code >= 400:
+                    self._finish(job["job_id"], "failed", result, (result or {}).get("response"))
+                    status = "failed"
+                else:
+                    self._finish(job["job_id"], "done", result)
+                    status = "done"
+            except Exception as e:
+                print(f"[CHAT JOB] {job['job_id']} failed: {e}")
+                self._finish(job["job_id"], "failed", error=str(e))
+                status = "failed"
+            CHAT_JOBS.labels(status).inc()
+            CHAT_JOB_SECONDS.labels("running").observe(time.time() - started)
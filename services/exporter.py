@@ -0,0 +1,254 @@
+# exporter.py
+"""
+Streaming table exports (xlsx, csv, parquet).
+
+Rows are consumed one at a time from any iterable (a BigQuery RowIterator pages
+lazily), so memory stays bounded by the writer's buffer rather than the result size.
+Queries behind a chat answer are registered under a short reference so the browser
+can ask the server to re-run and export them instead of posting the data back.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+from cache.cache_manager import DB_PATH
+
+CHUNK_BYTES = 64 * 1024
+CSV_FLUSH_ROWS = 500
+PARQUET_BATCH_ROWS = 10000
+EXPORT_ROW_LIMIT = int(os.environ.get("EXPORT_ROW_LIMIT", 100000))
+EXPORT_REF_TTL_HOURS = int(os.environ.get("EXPORT_REF_TTL_HOURS", 24))
+
+FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+_refs_table_ready = False
+
+
+def _cell(value):
+    """Convert a value into something every writer accepts."""
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        # openpyxl rejects timezone-aware datetimes
+        return value.replace(tzinfo=None)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    return value
+
+
+def split_rows(rows):
+    """
+    Return (header, iterator of value lists) for BigQuery rows, dict rows or
+    a list of lists whose first entry is the header.
+    """
+    schema = getattr(rows, "schema", None)
+    iterator = iter(rows)
+    first = next(iterator, None)
+
+    if first is None:
+        header = [field.name for field in schema] if schema else []
+        return header, iter(())
+    if hasattr(first, "keys"):
+        header = list(first.keys())
+
+        def values():
+            yield [_cell(v) for v in first.values()]
+            for row in iterator:
+                yield [_cell(v) for v in row.values()]
+        return header, values()
+
+    # Plain lists: the first row is the header
+    return [str(c) for c in first], ([_cell(v) for v in row] for row in iterator)
+
+
+class _TempFileChunks:
+    """
+    Chunks of a finished temporary export file. The file is deleted by close(), not when
+    iteration ends, so a response that is never read (client gone) does not leak it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+
+    def close(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _temp_path(suffix: str) -> str:
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=suffix)
+    os.close(fd)
+    return path
+
+
+def stream_xlsx(header, rows, sheet_name="Export"):
+    """
+    Write rows with openpyxl's write-only workbook (constant memory) to a temporary
+    file, then stream that file. xlsx is a zip archive, so it has to be finished
+    before the first byte can be sent.
+    """
+    from openpyxl import Workbook
+
+    path = _temp_path(".xlsx")
+    try:
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(title=sheet_name)
+        sheet.append(header)
+        for row in rows:
+            sheet.append(row)
+        workbook.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return _TempFileChunks(path)
+
+
+def stream_csv(header, rows):
+    """Yield CSV bytes every CSV_FLUSH_ROWS rows; nothing is written to disk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM so Excel opens UTF-8 CSVs correctly
+    buffer.write("\ufeff")
+    writer.writerow(header)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % CSV_FLUSH_ROWS == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def stream_parquet(header, rows):
+    """Write row groups of PARQUET_BATCH_ROWS to a temporary parquet file, then stream it."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Parquet export requires pyarrow to be installed")
+
+    def to_table(batch, schema=None):
+        columns = list(zip(*batch)) if batch else [[] for _ in header]
+        if schema is None:
+            arrays = []
+            for column in columns:
+                array = pa.array(column, from_pandas=True)
+                # All-null columns in the first batch would fix the type to null
+                arrays.append(array.cast(pa.string()) if pa.types.is_null(array.type) else array)
+            return pa.Table.from_arrays(arrays, names=header)
+        arrays = []
+        for column, field in zip(columns, schema):
+            if pa.types.is_string(field.type):
+                column = [None if v is None else str(v) for v in column]
+            arrays.append(pa.array(column, type=field.type, from_pandas=True))
+        return pa.Table.from_arrays(arrays, schema=schema)
+
+    path = _temp_path(".parquet")
+    writer = None
+    try:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= PARQUET_BATCH_ROWS:
+                table = to_table(batch, writer.schema if writer else None)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                batch = []
+        if batch or writer is None:
+            table = to_table(batch, writer.schema if writer else None)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+        writer.close()
+    except Exception:
+        if writer is not None:
+            writer.close()
+        os.remove(path)
+        raise
+    return _TempFileChunks(path)
+
+
+def stream_export(rows, fmt: str):
+    """
+    Return an iterable of byte chunks for `rows` in the requested format. Call its
+    close() once the response is finished to release temporary files.
+
+    Args:
+        rows: BigQuery rows, dict rows, or a list of lists with a header first
+        fmt: One of 'xlsx', 'csv', 'parquet'
+    """
+    header, values = split_rows(rows)
+    if fmt == "xlsx":
+        return stream_xlsx(header, values)
+    if fmt == "csv":
+        return stream_csv(header, values)
+    if fmt == "parquet":
+        return stream_parquet(header, values)
+    raise ValueError(f"Unsupported export format '{fmt}'. Use one of: {', '.join(FORMATS)}")
+
+
+def export_filename(fmt: str, title: str = None) -> str:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", title or "").strip("_").lower()[:50]
+    return f"{slug or 'export'}_{timestamp}.{fmt}"
+
+
+def _init_refs_table():
+    global _refs_table_ready
+    if _refs_table_ready:
+        return
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS export_refs (
+                ref TEXT PRIMARY KEY,
+                user_email TEXT,
+                query TEXT,
+                title TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+    _refs_table_ready = True
+
+
+def register_export(user_email: str, query: str, title: str = None) -> str:
+    """Remember a query behind a chat answer and return its export reference."""
+    _init_refs_table()
+    ref = hashlib.sha256(f"{user_email}:{query}".encode()).hexdigest()[:16]
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO export_refs (ref, user_email, query, title) VALUES (?, ?, ?, ?)",
+            (ref, user_email, query, title or ""),
+        )
+        conn.commit()
+    return ref
+
+
+def resolve_export(ref: str, user_email: str):
+    """Return (query, title) for a reference owned by `user_email`, or None if unknown or expired."""
+    _init_refs_table()
+    cutoff = (datetime.utcnow() - timedelta(hours=EXPORT_REF_TTL_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    with sqlite3.connect(DB_PATH) as conn:
+        row = conn.execute(
+            "SELECT query, title FROM export_refs WHERE ref = ? AND user_email = ? AND created_at >= ?",
+            (ref, user_email, cutoff),
+        ).fetchone()
+    return row
@@ -0,0 +1,456 @@
+# intent_router.py
+"""
+Pre-agent router for predictable questions.
+
+Messages are classified locally (token cosine similarity against a small library of
+intent examples). Confident matches are answered with parameterized SQL templates that
+already encode the branch/date/status columns and status mappings from the system
+prompt; everything else returns None and goes to the LLM agent. Template results are
+grouped by branch and shared by all users, then sliced to each user's branches.
+
+Every table intent answered here is counted in the `intent_usage` table of cache.db
+per branch set, so the login prefetch (services/prefetch.py) knows which questions
+each branch set asks most.
+"""
+import math
+import os
+import re
+import sqlite3
+from collections import Counter
+from datetime import date, timedelta
+from google.cloud import bigquery
+from db.catalog import branch_column, date_column, status_column
+from tools import agent_tools
+from tools.query_guard import run_guarded_query
+from cache.cache_manager import DB_PATH
+from cache.shared_results import SharedQuery, BRANCH_KEY, fetch_shared, shared_result_cached
+
+ROUTER_ENABLED = os.environ.get("INTENT_ROUTER_ENABLED", "1") == "1"
+MATCH_THRESHOLD = 0.75
+
+# Terms the user may use for each table (longest phrases are matched first)
+TABLE_TERMS = {
+    "office visits": "office_visits_table",
+    "office visit": "office_visits_table",
+    "branch visits": "office_visits_table",
+    "visits": "office_visits_table",
+    "applications": "application_table",
+    "application": "application_table",
+    "applicants": "application_table",
+    "enquiries": "enquiry_table",
+    "enquiry": "enquiry_table",
+    "inquiries": "enquiry_table",
+    "deals": "deals_applications_table",
+    "deal": "deals_applications_table",
+}
+
+TABLE_LABELS = {
+    "office_visits_table": "office visits",
+    "application_table": "applications",
+    "enquiry_table": "enquiries",
+    "deals_applications_table": "deals",
+}
+
+# Canonical enquiry statuses (status mappings in the system prompt); other tables store canonical values already
+ENQUIRY_STATUS_MAP = {
+    "new": "Open", "contacted": "Open", "evaluating": "Open",
+    "converted": "Converted",
+    "assessing": "Qualified", "future lead": "Qualified", "engage immediately": "Qualified", "accessing": "Qualified",
+    "financial limitations": "Disqualified", "service unavailable": "Disqualified",
+    "personal circumstances": "Disqualified", "not a fit": "Disqualified", "incorrect information": "Disqualified",
+    "interest withdrawn": "Lost", "changed decision": "Lost", "unresponsive": "Lost", "competitor selected": "Lost",
+    "archived": "Archived",
+}
+
+INTENTS = {
+    "my_branches": [
+        "what are my branches", "which branches do i have access to", "my assigned branches",
+        "my branches", "what is my primary branch", "my primary and secondary branches",
+    ],
+    "list_tables": [
+        "list tables", "what tables are there", "which tables exist", "list all tables in the dataset",
+        "tables available",
+    ],
+    "count": ["how many", "total number", "count", "number", "total", "how many are there"],
+    "by_status": ["by status", "status breakdown", "count by status", "status wise", "per status",
+                  "status distribution", "how many per status"],
+    "by_branch": ["by branch", "per branch", "branch wise", "breakdown by branch", "count per branch",
+                  "how many per branch"],
+    "by_month": ["by month", "per month", "monthly", "month wise", "monthly trend", "trend over month"],
+}
+TABLE_INTENTS = {"count", "by_status", "by_branch", "by_month"}
+
+_FILLER = {
+    "show", "me", "please", "give", "can", "you", "could", "would", "the", "of", "a", "an", "all",
+    "in", "for", "get", "tell", "i", "want", "to", "see", "what", "are", "is", "there", "our",
+    "we", "have", "do", "does", "list", "us", "chart", "graph", "plot",
+}
+# Words that signal filters or comparisons the templates do not cover
+_BLOCKERS = {
+    "compare", "comparison", "vs", "versus", "top", "where", "who", "except", "not",
+    "without", "between", "average", "avg", "percentage", "rate", "conversion", "client", "named",
+}
+_PERIOD_PATTERNS = [
+    (re.compile(r"\btoday\b"), "today"),
+    (re.compile(r"\byesterday\b"), "yesterday"),
+    (re.compile(r"\bthis week\b"), "this week"),
+    (re.compile(r"\b(this|current) month\b"), "this month"),
+    (re.compile(r"\b(last|previous) month\b"), "last month"),
+    (re.compile(r"\b(this|current) year\b"), "this year"),
+    (re.compile(r"\b(last|previous) year\b"), "last year"),
+    (re.compile(r"\blast (\d{1,3}) days\b"), "last n days"),
+]
+_WORD = re.compile(r"[a-z0-9]+")
+
+_usage_table_ready = False
+
+
+def _stem(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ches", "shes", "xes", "sses")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us")):
+        return word[:-1]
+    return word
+
+
+def _tokens(text: str) -> list:
+    return [_stem(w) for w in _WORD.findall(text.lower()) if w not in _FILLER]
+
+
+def _build_index():
+    examples = [(name, Counter(_tokens(ex))) for name, exs in INTENTS.items() for ex in exs]
+    doc_freq = Counter(tok for _, vec in examples for tok in vec)
+    idf = {tok: math.log((1 + len(examples)) / (1 + df)) + 1 for tok, df in doc_freq.items()}
+    return examples, idf
+
+
+_EXAMPLES, _IDF = _build_index()
+_UNKNOWN_IDF = max(_IDF.values()) + 1
+
+
+def _cosine(a: Counter, b: Counter) -> float:
+    weight = lambda tok: _IDF.get(tok, _UNKNOWN_IDF)
+    dot = sum(a[t] * b[t] * weight(t) ** 2 for t in a if t in b)
+    norm_a = math.sqrt(sum((c * weight(t)) ** 2 for t, c in a.items()))
+    norm_b = math.sqrt(sum((c * weight(t)) ** 2 for t, c in b.items()))
+    return dot / (norm_a * norm_b) if norm_a and norm_b else 0.0
+
+
+def _resolve_period(text: str, today: date):
+    """Return (label, start, end) for the first period phrase in the text, or None for all time."""
+    for pattern, label in _PERIOD_PATTERNS:
+        match = pattern.search(text)
+        if not match:
+            continue
+        if label == "today":
+            return label, today, today + timedelta(days=1)
+        if label == "yesterday":
+            return label, today - timedelta(days=1), today
+        if label == "this week":
+            start = today - timedelta(days=today.weekday())
+            return label, start, start + timedelta(days=7)
+        if label == "this month":
+            start = today.replace(day=1)
+            return label, start, (start + timedelta(days=32)).replace(day=1)
+        if label == "last month":
+            end = today.replace(day=1)
+            return label, (end - timedelta(days=1)).replace(day=1), end
+        if label == "this year":
+            return label, date(today.year, 1, 1), date(today.year + 1, 1, 1)
+        if label == "last year":
+            return label, date(today.year - 1, 1, 1), date(today.year, 1, 1)
+        days = int(match.group(1))
+        return f"last {days} days", today - timedelta(days=days - 1), today + timedelta(days=1)
+    return None
+
+
+def classify(message: str, branches=None, today: date = None):
+    """
+    Classify a message against the intent library.
+
+    Returns:
+        dict with `intent`, `score`, `table` and `period`, or None when no intent is confident.
+    """
+    text = " " + message.lower().strip() + " "
+    today = today or date.today()
+
+    period = _resolve_period(text, today)
+    for pattern, _ in _PERIOD_PATTERNS:
+        text = pattern.sub(" ", text)
+
+    table = None
+    for term in sorted(TABLE_TERMS, key=len, reverse=True):
+        if re.search(rf"\b{term}\b", text):
+            if table and table != TABLE_TERMS[term]:
+                return None  # Questions spanning several tables need the agent
+            table = TABLE_TERMS[term]
+            text = re.sub(rf"\b{term}\b", " ", text)
+
+    words = set(_WORD.findall(text))
+    if words & _BLOCKERS or any(w.isdigit() for w in words):
+        return None
+    # A specific branch in the question narrows the filter beyond the user's branch set
+    if branches and any(re.search(rf"\b{re.escape(b.lower())}\b", text) for b in branches):
+        return None
+
+    vector = Counter(_tokens(text))
+    if not vector:
+        return None
+    # Templates group by a single dimension
+    dimensions = {"status", "branch"} & set(vector)
+    if {"month", "monthly"} & set(vector):
+        dimensions.add("month")
+    if len(dimensions) > 1:
+        return None
+    best_name, best_score = None, 0.0
+    for name, example in _EXAMPLES:
+        score = _cosine(vector, example)
+        if score > best_score:
+            best_name, best_score = name, score
+
+    if best_score < MATCH_THRESHOLD:
+        return None
+    if (best_name in TABLE_INTENTS) != (table is not None):
+        return None
+    if best_name == "by_status" and not status_column(table):
+        return None
+    if best_name == "by_month" and not date_column(table):
+        return None
+    return {"intent": best_name, "score": best_score, "table": table, "period": period}
+
+
+def _status_expression(table: str) -> str:
+    column = status_column(table)
+    if table != "enquiry_table":
+        return column
+    cases = " ".join(f"WHEN '{raw}' THEN '{canonical}'" for raw, canonical in ENQUIRY_STATUS_MAP.items())
+    return f"CASE LOWER(TRIM({column})) {cases} ELSE {column} END"
+
+
+def build_query(intent: str, table: str, period, branches) -> SharedQuery:
+    """
+    Branch-agnostic SQL for a table intent, grouped by branch, plus how to slice it for
+    the user's branches. Every user asking the same question shares one result.
+    """
+    branch_col = branch_column(table)
+    date_col = date_column(table)
+    params = []
+    where = ""
+    if period and date_col:
+        _, start, end = period
+        where = f"WHERE CAST({date_col} AS DATE) >= @start_date AND CAST({date_col} AS DATE) < @end_date"
+        params.append(bigquery.ScalarQueryParameter("start_date", "DATE", start))
+        params.append(bigquery.ScalarQueryParameter("end_date", "DATE", end))
+
+    if intent == "count":
+        sql = f"SELECT {branch_col} AS {BRANCH_KEY}, COUNT(*) AS count FROM `hackathon_data.{table}` {where} GROUP BY 1"
+        return SharedQuery(sql, branches, ["count"], [], {"count": "count"}, params=params)
+
+    label, expression, order = {
+        "by_status": ("Status", _status_expression(table), ("count", True)),
+        "by_branch": ("Branch", branch_col, ("count", True)),
+        "by_month": ("Month", f"FORMAT_DATE('%Y-%m', CAST({date_col} AS DATE))", ("Month", False)),
+    }[intent]
+    sql = (
+        f"SELECT {branch_col} AS {BRANCH_KEY}, {expression} AS {label}, COUNT(*) AS count "
+        f"FROM `hackathon_data.{table}` {where} GROUP BY 1, 2"
+    )
+    return SharedQuery(sql, branches, [label, "count"], [label], {"count": "count"}, [order], params=params)
+
+
+def _scope_text(period, branches) -> str:
+    when = f" {period[0]}" if period else ""
+    where = " across all branches" if branches is None else " across your branches"
+    return when + where
+
+
+def _answer_branches(primary_branch, branches) -> dict:
+    if branches is None:
+        text = "You have access to **all branches**."
+        if primary_branch:
+            text = f"Your primary branch is **{primary_branch}**, and you have access to **all branches**."
+    else:
+        secondary = [b for b in branches if b.lower() != (primary_branch or "").lower()]
+        text = f"Your primary branch is **{primary_branch or 'None'}**."
+        text += f" Your secondary branches are: {', '.join(secondary)}." if secondary else " You have no secondary branches."
+    return {"response": text + "\n\nIs there anything you would like to know about these branches?",
+            "visualization_type": "none", "visualization_title": "", "data": []}
+
+
+def _answer_tables() -> dict:
+    schema = agent_tools.list_tables.invoke({})
+    names = [line.split(".", 1)[1] for line in schema.splitlines() if line.startswith("Table: ")]
+    if not names:
+        return None
+    text = "The dataset contains these tables:\n\n" + "\n".join(f"- {n}" for n in names)
+    return {"response": text, "visualization_type": "none", "visualization_title": "", "data": []}
+
+
+def _run_shared(purpose: str):
+    """`fetch_shared` runner that executes the shared query through the cost guard."""
+    return lambda sql, params, limit: run_guarded_query(
+        agent_tools.bq_client, sql, purpose=purpose, row_limit=limit, query_parameters=params
+    )
+
+
+def _answer_table_intent(match, branches) -> dict:
+    intent, table, period = match["intent"], match["table"], match["period"]
+    plan = build_query(intent, table, period, branches)
+    rows = fetch_shared(plan, _run_shared(f"intent:{intent}"))
+    if rows is None:
+        raise ValueError("result too large to share")
+    label = plan.keys[0] if plan.keys else None
+    noun = TABLE_LABELS[table]
+    scope = _scope_text(period, branches)
+
+    if intent == "count":
+        total = rows[0]["count"]
+        return {"response": f"There are **{total}** {noun}{scope}.",
+                "visualization_type": "none", "visualization_title": "", "data": []}
+
+    data = [{label: str(row[label]) if row[label] is not None else "Unknown", "count": int(row["count"])}
+            for row in rows]
+    if not data:
+        return {"response": f"No {noun} found{scope}.",
+                "visualization_type": "none", "visualization_title": "", "data": []}
+
+    title = f"{noun.capitalize()} by {label.lower()}{' (' + period[0] + ')' if period else ''}"
+    table_md = f"| {label} | Count |\n|---|---|\n" + "\n".join(f"| {d[label]} | {d['count']} |" for d in data)
+    total = sum(d["count"] for d in data)
+    return {
+        "response": f"Here are the {noun} by {label.lower()}{scope} ({total} in total):\n\n{table_md}",
+        "visualization_type": "line" if intent == "by_month" else "bar",
+        "visualization_title": title,
+        "data": data,
+    }
+
+
+def branch_set_key(branches) -> str:
+    """Usage log key of a branch set: "all", or the sorted branch names."""
+    return "all" if branches is None else ",".join(sorted(branches))
+
+
+def _init_usage_table():
+    global _usage_table_ready
+    if _usage_table_ready:
+        return
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS intent_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                branch_set TEXT,
+                intent TEXT,
+                table_name TEXT,
+                period TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS intent_usage_branch_set ON intent_usage (branch_set, created_at)")
+        conn.commit()
+    _usage_table_ready = True
+
+
+def record_intent_usage(match: dict, branches):
+    """Count a table intent answered for this branch set."""
+    try:
+        _init_usage_table()
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.execute(
+                "INSERT INTO intent_usage (branch_set, intent, table_name, period) VALUES (?, ?, ?, ?)",
+                (branch_set_key(branches), match["intent"], match["table"],
+                 match["period"][0] if match["period"] else "")
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"Intent usage log error: {e}")
+
+
+def top_intents(branches, limit: int, days: int, min_uses: int = 1) -> list:
+    """
+    The table intents asked most often in the last `days` days.
+
+    Intents of the given branch set come first; when it has fewer than `limit`, the most
+    asked intents of all branch sets fill the rest (shared results serve every branch set).
+
+    Returns:
+        Up to `limit` dicts with `intent`, `table` and `period` (a period label, "" for all time).
+    """
+    _init_usage_table()
+    query = (
+        "SELECT intent, table_name, period, COUNT(*) AS uses FROM intent_usage "
+        "WHERE created_at >= datetime('now', ?) {scope}"
+        "GROUP BY intent, table_name, period HAVING uses >= ? ORDER BY uses DESC LIMIT ?"
+    )
+    since = f"-{int(days)} days"
+    with sqlite3.connect(DB_PATH) as conn:
+        rows = conn.execute(query.format(scope="AND branch_set = ? "),
+                            (since, branch_set_key(branches), min_uses, limit)).fetchall()
+        if len(rows) < limit:
+            rows += conn.execute(query.format(scope=""), (since, min_uses, limit)).fetchall()
+
+    intents = []
+    for intent, table, period, _ in rows:
+        entry = {"intent": intent, "table": table, "period": period}
+        if entry not in intents:
+            intents.append(entry)
+    return intents[:limit]
+
+
+def warm_intent(intent: str, table: str, period: str, branches) -> bool:
+    """
+    Run a table intent's shared query so the next user asking it gets a cache hit.
+
+    Args:
+        intent: A table intent ("count", "by_status", "by_branch" or "by_month").
+        table: The table it is asked about.
+        period: Period label as logged ("this month", "last 30 days", "" for all time),
+            resolved against today's date.
+        branches: The branch set it is warmed for, or None for all branches.
+
+    Returns:
+        False if the result was already cached, True if the query ran.
+    """
+    resolved = _resolve_period(f" {period} ", date.today()) if period else None
+    plan = build_query(intent, table, resolved, branches)
+    if shared_result_cached(plan):
+        return False
+    fetch_shared(plan, _run_shared(f"prefetch:{intent}"))
+    return True
+
+
+def route_message(message: str, primary_branch, branches):
+    """
+    Answer the message on a deterministic fast path if it matches a known intent.
+
+    Args:
+        message: The user's chat message.
+        primary_branch: The user's primary branch.
+        branches: Allowed branch names, or None for all branches.
+
+    Returns:
+        A /chat response payload, or None to fall back to the agent.
+    """
+    if not ROUTER_ENABLED:
+        return None
+    match = classify(message, branches)
+    if match is None:
+        return None
+
+    try:
+        if match["intent"] == "my_branches":
+            payload = _answer_branches(primary_branch, branches)
+        elif match["intent"] == "list_tables":
+            payload = _answer_tables()
+        else:
+            payload = _answer_table_intent(match, branches)
+            if payload is not None:
+                record_intent_usage(match, branches)
+    except Exception as e:
+        print(f"[ROUTER] {match['intent']} fast path failed, falling back to agent: {e}")
+        return None
+
+    if payload is not None:
+        print(f"[ROUTER] Fast path '{match['intent']}' (score {match['score']:.2f})")
+    return payload
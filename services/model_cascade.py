@@ -0,0 +1,168 @@
+# model_cascade.py
+"""
+Tiered model routing for /chat.
+
+Tier 0 is the intent router (templated SQL, no model; see intent_router.py). Questions
+it does not match go to the light agent (LIGHT_MODEL, fewer iterations). Its result is
+validated and the question is escalated to the full agent when:
+  - the last SQL query failed or was rejected, or a tool returned an error
+  - the last SQL query came back empty but the answer still reports data
+  - a chart's data could not be fetched
+  - the answer contains visualization JSON that does not parse
+  - the run hit its iteration limit, returned nothing or raised
+A tier is not escalated once the request's budget is spent (services/agent_budget.py);
+a run that stopped early answers with what it found so far.
+Per-tier latency, token cost and accept/escalate counts are exported to Prometheus, so
+the escalation rate and the cost saved can be compared on the dashboard.
+"""
+import os
+import re
+import time
+from typing import Optional
+from monitoring.metrics import (
+    MODEL_TIER_SECONDS, MODEL_TIER_TOKENS, MODEL_TIER_COST, CASCADE_RESULTS, CASCADE_ESCALATIONS
+)
+from monitoring.tracing import span, annotate
+from services.admission import AdmissionRejected
+from services.agent_budget import AGENT_MAX_ITERATIONS, budget_exhausted, partial_answer, stopped_early
+from services.backends import CHAT_MODEL
+from services.output_parser import normalize_output, parse_visualization
+from services.prompt_builder import PromptUsageTracker
+from tools.chart_tools import begin_chart_requests, collect_charts
+
+CASCADE_ENABLED = os.environ.get("MODEL_CASCADE_ENABLED", "1") == "1"
+LIGHT_MODEL = os.environ.get("LIGHT_MODEL", "gemini-2.5-flash-lite")
+LIGHT_MAX_ITERATIONS = int(os.environ.get("LIGHT_MAX_ITERATIONS", 4))
+FULL_MAX_ITERATIONS = AGENT_MAX_ITERATIONS
+
+# USD per million tokens (input, output), for the estimated cost metric
+MODEL_PRICES = {
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-flash": (0.30, 2.50),
+}
+
+
+# An answer that reports "no rows" agrees with an empty SQL result
+_NO_DATA = re.compile(
+    r"\b(no|none|zero|nothing|not any|0|(?:could ?n[o']?t|did ?n[o']?t|do ?n[o']?t|unable to) find|not found)\b",
+    re.IGNORECASE
+)
+
+
+def _tool_and_observation(step):
+    action, observation = step
+    tool = action.tool if hasattr(action, "tool") else action.get("tool")
+    return tool, observation if isinstance(observation, str) else str(observation)
+
+
+def escalation_reason(result: dict, charts: list) -> Optional[str]:
+    """
+    Check a tier's result.
+
+    Returns:
+        Why the question should go to the next tier, or None if the result is acceptable.
+    """
+    output = normalize_output(result.get("output", "")).strip()
+    if not output:
+        return "empty_answer"
+    if stopped_early(result):
+        return "iteration_limit"
+
+    steps = [_tool_and_observation(step) for step in result.get("intermediate_steps", [])]
+    sql_results = [observation for tool, observation in steps if tool == "execute_sql"]
+    if sql_results:
+        last = sql_results[-1].strip()
+        if last.startswith("Error"):
+            return "sql_error"
+        if last == "[]" and not _NO_DATA.search(output):
+            return "empty_result"  # The answer reports data the query did not return
+    if steps:
+        tool, observation = steps[-1]
+        if tool != "execute_sql" and observation.startswith(("Error", "Invalid chart arguments")):
+            return "tool_error"
+
+    if any("error" in chart for chart in charts):
+        return "chart_error"
+    if not charts and "visualization_type" in output and parse_visualization(output) is None:
+        return "malformed_visualization"
+    return None
+
+
+def _record_usage(tier: str, model: str, usage: PromptUsageTracker):
+    MODEL_TIER_TOKENS.labels(tier, "input").inc(usage.input_tokens)
+    MODEL_TIER_TOKENS.labels(tier, "output").inc(usage.output_tokens)
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    MODEL_TIER_COST.labels(tier).inc((usage.input_tokens * input_price + usage.output_tokens * output_price) / 1e6)
+
+
+def record_router(routed: bool, seconds: float):
+    """Count tier 0 (the intent router) so its hit rate shows next to the model tiers."""
+    MODEL_TIER_SECONDS.labels("router").observe(seconds)
+    CASCADE_RESULTS.labels("router", "accepted" if routed else "escalated").inc()
+
+
+class ModelTier:
+    """One agent in the cascade."""
+
+    def __init__(self, name: str, model: str, executor):
+        self.name = name
+        self.model = model
+        self.executor = executor
+
+
+class ModelCascade:
+    """Runs the tiers in order until one produces a result that passes validation."""
+
+    def __init__(self, tiers: list):
+        self.tiers = tiers
+
+    def invoke(self, inputs: dict, callbacks: list):
+        """
+        Answer with the cheapest tier that passes validation.
+
+        Args:
+            inputs: AgentExecutor inputs (input, chat_history, session_context).
+            callbacks: Callback handlers shared by every tier.
+
+        Returns:
+            (result, charts, tier name). The last tier's result is returned as is, except that a run
+            that stopped early gets a partial answer.
+
+        Raises:
+            Whatever the last tier raises, and AdmissionRejected from any tier.
+        """
+        for index, tier in enumerate(self.tiers):
+            last = index == len(self.tiers) - 1
+            usage = PromptUsageTracker()
+            # Charts requested by an escalated tier are discarded with its answer
+            begin_chart_requests()
+            started = time.time()
+            with span(f"tier:{tier.name}", model=tier.model):
+                try:
+                    result = tier.executor.invoke(inputs, config={"callbacks": callbacks + [usage]})
+                except AdmissionRejected:
+                    raise
+                except Exception as e:
+                    if last:
+                        raise
+                    result, reason = None, "exception"
+                    print(f"[CASCADE] {tier.name} failed: {e}")
+                with span("chart.collect"):
+                    charts = collect_charts()
+                if result is not None:
+                    reason = None if last else escalation_reason(result, charts)
+                    exhausted = budget_exhausted()
+                    if reason is not None and exhausted:
+                        # Nothing left for the next tier to spend; answer with this tier's findings
+                        annotate(budget_exhausted=exhausted)
+                        reason = None
+                annotate(escalated=reason)
+
+            MODEL_TIER_SECONDS.labels(tier.name).observe(time.time() - started)
+            _record_usage(tier.name, tier.model, usage)
+            if reason is None:
+                CASCADE_RESULTS.labels(tier.name, "accepted").inc()
+                return partial_answer(result), charts, tier.name
+            CASCADE_RESULTS.labels(tier.name, "escalated").inc()
+            CASCADE_ESCALATIONS.labels(tier.name, reason).inc()
+            print(f"[CASCADE] Escalating from {tier.name} ({reason})")
@@ -0,0 +1,193 @@
+# output_parser.py
+"""
+Extracts visualizations from the agent's final answer.
+
+The answer is scanned once, left to right, for balanced top-level `{...}` objects
+(braces inside JSON strings, such as Mermaid `A{Decision}` nodes, are ignored).
+The first object carrying a `visualization_type` / `chart_type` key wins, with
+```json fenced blocks taking priority over inline JSON.
+"""
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+
+_VIS_KEYS = ('"visualization_type"', '"chart_type"')
+_STRUCTURAL = re.compile(r'[{}"]')
+_JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_FENCE_OPEN = re.compile(r"```json\s*$")
+_FENCE_CLOSE = re.compile(r"\s*```")
+# Mermaid answers often contain unescaped quotes/newlines that break json.loads
+_MERMAID_DATA = re.compile(r'"data"\s*:\s*"(.*)"\s*\}\s*$', re.DOTALL)
+_KV_VISUALIZATION = re.compile(
+    r'create_visualization\s+query="(?P<query>.*?)"\s+chart_type="(?P<type>.*?)"\s+title="(?P<title>.*?)"',
+    re.DOTALL
+)
+
+
+@dataclass
+class Visualization:
+    """A visualization recovered from the answer text."""
+    type: str
+    title: str = ""
+    data: Any = None
+    data_query: Optional[str] = None
+    # Region of the answer to strip once the visualization has been rendered
+    span: Optional[Tuple[int, int]] = field(default=None, repr=False)
+
+    def remove_from(self, text: str) -> str:
+        if not self.span:
+            return text
+        start, end = self.span
+        return (text[:start] + text[end:]).strip()
+
+
+def normalize_output(output) -> str:
+    """
+    Flatten the agent output to text. Newer LangChain / Google GenAI versions can return
+    a list of content parts (dicts or objects with `text`) instead of a string.
+    """
+    if isinstance(output, str):
+        return output
+    if isinstance(output, list):
+        parts = []
+        for item in output:
+            if isinstance(item, dict):
+                # Ignore other keys like 'extras', 'index', 'safety_ratings'
+                if "text" in item:
+                    parts.append(item["text"])
+            elif hasattr(item, "text"):
+                parts.append(item.text)
+            elif isinstance(item, str):
+                parts.append(item)
+            elif isinstance(item, (int, float)):
+                parts.append(str(item))
+        return "".join(parts)
+    return str(output)
+
+
+def scan_objects(text: str) -> List[Tuple[int, int, bool]]:
+    """
+    Single pass over `text` returning (start, end, closed) for every top-level
+    brace-delimited object. Quotes only delimit strings inside an object, so prose
+    apostrophes and quotes around it do not matter. An object left open at the end
+    of the text is returned with closed=False.
+    """
+    spans = []
+    depth = 0
+    start = 0
+    pos = 0
+
+    while True:
+        match = _STRUCTURAL.search(text, pos)
+        if not match:
+            break
+        i = match.start()
+        ch = match.group()
+        pos = i + 1
+        if ch == '"':
+            if depth:
+                string = _JSON_STRING.match(text, i)
+                if not string:
+                    # Unterminated string: the object never closes
+                    break
+                pos = string.end()
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif depth:
+            depth -= 1
+            if depth == 0:
+                spans.append((start, i + 1, True))
+
+    if depth:
+        spans.append((start, len(text), False))
+    return spans
+
+
+def _loads(candidate: str) -> Optional[dict]:
+    """json.loads with the recoveries the LLM output usually needs."""
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        pass
+
+    lowered = candidate.lower()
+    if "flowchart" in lowered or "mermaid" in lowered:
+        # Keep the Mermaid text exactly as written; only the data field is needed
+        match = _MERMAID_DATA.search(candidate)
+        if match:
+            return {"visualization_type": "flowchart", "data": match.group(1)}
+
+    # Raw newlines inside strings (usually SQL or metadata) are safe to flatten
+    try:
+        return json.loads(candidate.replace("\n", " ").replace("\r", ""))
+    except json.JSONDecodeError:
+        return None
+
+
+def _fenced_span(text: str, start: int, end: int) -> Optional[Tuple[int, int]]:
+    """Widen (start, end) to include surrounding ```json ... ``` fences, if present."""
+    opener = _FENCE_OPEN.search(text, max(0, start - 64), start)
+    if not opener:
+        return None
+    closer = _FENCE_CLOSE.match(text, end)
+    return (opener.start(), closer.end() if closer else end)
+
+
+def parse_visualization(text: str) -> Optional[Visualization]:
+    """
+    Return the visualization JSON embedded in an answer, or None.
+
+    Args:
+        text: The agent's final answer.
+    """
+    if not text or "{" not in text:
+        return None
+
+    fenced, inline = [], []
+    for start, end, closed in scan_objects(text):
+        if not closed:
+            # Unbalanced (e.g. unescaped quotes in Mermaid labels): extend to the last brace
+            end = text.rfind("}") + 1
+            if end <= start:
+                continue
+        candidate = text[start:end]
+        if not any(key in candidate for key in _VIS_KEYS):
+            continue
+        fence = _fenced_span(text, start, end)
+        (fenced if fence else inline).append((candidate, fence or (start, end)))
+
+    for candidate, span in fenced + inline:
+        parsed = _loads(candidate)
+        if not isinstance(parsed, dict):
+            continue
+        if "visualization_type" not in parsed and "chart_type" not in parsed:
+            continue
+        return Visualization(
+            type=(parsed.get("visualization_type") or parsed.get("chart_type") or "none").lower(),
+            title=parsed.get("visualization_title") or parsed.get("title") or "",
+            data=parsed.get("data"),
+            data_query=parsed.get("data_query"),
+            span=span,
+        )
+    return None
+
+
+def parse_kv_visualization(text: str) -> Optional[Visualization]:
+    """
+    Recover the legacy `create_visualization query="..." chart_type="..." title="..."`
+    text form. The caller still has to run `data_query` to render it.
+    """
+    if not text or "create_visualization" not in text:
+        return None
+    match = _KV_VISUALIZATION.search(text)
+    if not match:
+        return None
+    return Visualization(
+        type=match.group("type"),
+        title=match.group("title"),
+        data_query=match.group("query"),
+        span=match.span(),
+    )
@@ -0,0 +1,131 @@
+# prefetch.py
+"""
+Speculative prefetch of dashboard questions at login.
+
+Right after logging in, users mostly ask the same dashboard-style questions for their
+branches ("enquiries by status this month", "how many applications this year"). Those
+are answered by the intent router from shared results, so a first question only costs
+a BigQuery round trip when the shared result is cold.
+
+On login the user's branch set is queued here. A single low-priority worker thread
+looks up the PREFETCH_TOP_N table intents that branch set asked most in the last
+PREFETCH_LOOKBACK_DAYS days (the `intent_usage` log, topped up with the most asked
+intents overall) and runs each one's shared query unless its result is already cached.
+
+Prefetching never competes with interactive requests:
+  - one query at a time, and only while fewer than PREFETCH_MAX_CHAT_LOAD chat requests
+    are running or queued and at least half the BigQuery rate burst is unused
+  - everything still waiting PREFETCH_BUDGET_SECONDS after the login is dropped
+  - a branch set is prefetched at most once per SHARED_RESULT_TTL_SECONDS
+"""
+import os
+import queue
+import threading
+import time
+
+from cache.shared_results import SHARED_RESULT_TTL_SECONDS
+from monitoring.metrics import PREFETCH_INTENTS
+from services.admission import admission, bigquery_bucket, CHAT_MAX_CONCURRENT
+from services.intent_router import ROUTER_ENABLED, branch_set_key, top_intents, warm_intent
+from tools.request_context import set_request_user
+
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_TOP_N = int(os.environ.get("PREFETCH_TOP_N", 3))
+PREFETCH_LOOKBACK_DAYS = int(os.environ.get("PREFETCH_LOOKBACK_DAYS", 14))
+PREFETCH_MIN_USES = int(os.environ.get("PREFETCH_MIN_USES", 2))  # Intents asked fewer times are not guessed
+PREFETCH_BUDGET_SECONDS = float(os.environ.get("PREFETCH_BUDGET_SECONDS", 30))
+PREFETCH_MAX_CHAT_LOAD = int(os.environ.get("PREFETCH_MAX_CHAT_LOAD", max(1, CHAT_MAX_CONCURRENT // 2)))
+PREFETCH_QUEUE_SIZE = 32
+IDLE_CHECK_SECONDS = 0.5
+
+
+def _has_headroom() -> bool:
+    """True while interactive chat and the BigQuery rate budget can spare a prefetch query."""
+    if admission.load() >= PREFETCH_MAX_CHAT_LOAD:
+        return False
+    return bigquery_bucket.available() >= bigquery_bucket.capacity / 2
+
+
+class LoginPrefetcher:
+    """Warms the shared results of each logged-in branch set's most asked intents on a daemon thread."""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+        self._scheduled = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, user_email: str, branches) -> bool:
+        """
+        Queue a prefetch for a user who just logged in. Returns immediately.
+
+        Args:
+            user_email: The user, for the query cost log.
+            branches: The user's branch names, or None for all branches.
+
+        Returns:
+            True if a prefetch was queued, False if disabled, recently done for this
+            branch set, or the queue is full.
+        """
+        if not PREFETCH_ENABLED or not ROUTER_ENABLED or PREFETCH_TOP_N <= 0:
+            return False
+        key = branch_set_key(branches)
+        now = time.time()
+        with self._lock:
+            if now - self._scheduled.get(key, 0) < SHARED_RESULT_TTL_SECONDS:
+                return False
+            self._scheduled = {k: t for k, t in self._scheduled.items() if now - t < SHARED_RESULT_TTL_SECONDS}
+            self._scheduled[key] = now
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((user_email, branches, now + PREFETCH_BUDGET_SECONDS))
+        except queue.Full:
+            PREFETCH_INTENTS.labels("dropped").inc()
+            return False
+        return True
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="login-prefetch", daemon=True)
+                self._thread.start()
+
+    @staticmethod
+    def _wait_for_headroom(deadline: float) -> bool:
+        while time.time() < deadline:
+            if _has_headroom():
+                return True
+            time.sleep(IDLE_CHECK_SECONDS)
+        return False
+
+    def _prefetch(self, user_email: str, branches, deadline: float):
+        intents = top_intents(branches, PREFETCH_TOP_N, PREFETCH_LOOKBACK_DAYS, PREFETCH_MIN_USES)
+        set_request_user(user_email)
+        for index, entry in enumerate(intents):
+            if not self._wait_for_headroom(deadline):
+                PREFETCH_INTENTS.labels("deferred").inc(len(intents) - index)
+                print(f"[PREFETCH] Budget spent, skipped {len(intents) - index} intents for {user_email}")
+                return
+            try:
+                warmed = warm_intent(entry["intent"], entry["table"], entry["period"], branches)
+            except Exception as e:
+                print(f"[PREFETCH] {entry['intent']} on {entry['table']} failed: {e}")
+                PREFETCH_INTENTS.labels("failed").inc()
+                continue
+            PREFETCH_INTENTS.labels("warmed" if warmed else "cached").inc()
+            if warmed:
+                print(f"[PREFETCH] Warmed {entry['intent']} on {entry['table']} "
+                      f"({entry['period'] or 'all time'}) for {user_email}")
+
+    def _run(self):
+        while True:
+            user_email, branches, deadline = self._queue.get()
+            try:
+                self._prefetch(user_email, branches, deadline)
+            except Exception as e:
+                print(f"[PREFETCH] Prefetch for {user_email} failed: {e}")
+
+
+prefetcher = LoginPrefetcher()
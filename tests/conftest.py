@@ -0,0 +1,8 @@
+# conftest.py
+# Modules that build clients at import time use the in-process fakes (benchmarks/fakes.py),
+# so the tests need no credentials or network; the document index they build goes to a temp dir.
+import os
+import tempfile
+
+os.environ.setdefault("FAKE_BACKENDS", "1")
+os.environ.setdefault("DOCUMENT_VECTORS_PATH", os.path.join(tempfile.mkdtemp(), "document_vectors"))
@@ -0,0 +1,135 @@
+# test_admission.py
+# Run from the project root: python -m pytest tests
+import threading
+import time
+
+import pytest
+
+from services import admission
+from services.admission import AdmissionController, AdmissionRejected, TokenBucket, is_quota_error
+
+
+class Clock:
+    """Stand-in for time.monotonic that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_starts_full_and_refills_at_rate(clock):
+    bucket = TokenBucket("test", per_minute=60, burst=2)
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+    assert bucket.wait_time() == pytest.approx(1.0)
+
+    clock.now += 0.5
+    assert bucket.available() == pytest.approx(0.5)
+    clock.now += 10
+    assert bucket.available() == 2  # Never above the burst
+
+
+def test_bucket_acquire_gives_up_when_the_wait_passes_the_timeout(clock):
+    bucket = TokenBucket("test", per_minute=6, burst=1)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=5)  # The next token is 10s away
+
+
+def test_penalize_empties_the_bucket_for_the_cooldown(clock):
+    bucket = TokenBucket("test", per_minute=600, burst=10)
+    bucket.penalize(cooldown=30)
+    assert bucket.available() == 0
+    assert bucket.cooldown_remaining() == pytest.approx(30)
+    assert bucket.wait_time() == pytest.approx(30)
+
+    clock.now += 31
+    assert bucket.cooldown_remaining() == 0
+    assert bucket.acquire(timeout=0)
+
+
+def test_disabled_bucket_never_waits():
+    bucket = TokenBucket("test", per_minute=0)
+    assert not bucket.enabled
+    assert all(bucket.acquire(timeout=0) for _ in range(100))
+    assert bucket.wait_time() == 0
+
+
+def test_quota_errors_are_recognised():
+    assert is_quota_error(Exception("429 Resource exhausted"))
+    assert is_quota_error(Exception("rateLimitExceeded: too many queries"))
+    assert not is_quota_error(Exception("Syntax error at [1:8]"))
+    assert not is_quota_error(AdmissionRejected("gemini_quota", 5))
+
+
+def test_per_user_limit():
+    controller = AdmissionController(max_concurrent=4, max_per_user=1, queue_size=4, queue_timeout=1)
+    ticket = controller.acquire("alice")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("alice")
+    assert rejected.value.reason == "user_limit" and rejected.value.status == 429
+    controller.release(controller.acquire("bob"))
+
+    controller.release(ticket)
+    controller.release(controller.acquire("alice"))
+    assert controller.load() == 0
+
+
+def test_waiter_gets_the_slot_when_one_is_released():
+    controller = AdmissionController(max_concurrent=1, max_per_user=2, queue_size=2, queue_timeout=5)
+    first = controller.acquire("alice")
+    admitted = threading.Event()
+
+    def wait_for_slot():
+        controller.release(controller.acquire("bob"))
+        admitted.set()
+
+    waiter = threading.Thread(target=wait_for_slot)
+    waiter.start()
+    while controller.load() < 2:
+        time.sleep(0.01)
+    assert not admitted.is_set()
+
+    controller.release(first)
+    waiter.join(timeout=5)
+    assert admitted.is_set()
+    assert controller.load() == 0
+
+
+def test_waiter_times_out_and_frees_its_user_slot():
+    controller = AdmissionController(max_concurrent=1, max_per_user=1, queue_size=2, queue_timeout=0.1)
+    ticket = controller.acquire("alice")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("bob")
+    assert rejected.value.reason == "queue_timeout" and rejected.value.status == 503
+    assert controller.load() == 1
+
+    controller.release(ticket)
+    controller.release(controller.acquire("bob"))  # bob's timed-out wait no longer counts against him
+
+
+def test_full_queue_is_rejected():
+    controller = AdmissionController(max_concurrent=1, max_per_user=2, queue_size=0, queue_timeout=5)
+    ticket = controller.acquire("alice")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("bob")
+    assert rejected.value.reason == "queue_full" and rejected.value.status == 503
+    controller.release(ticket)
+
+
+def test_gemini_cooldown_turns_new_requests_away(monkeypatch):
+    monkeypatch.setattr(admission, "gemini_bucket", TokenBucket("gemini", per_minute=60))
+    admission.gemini_bucket.penalize(cooldown=3)
+    with pytest.raises(AdmissionRejected) as rejected:
+        AdmissionController().acquire("alice")
+    assert rejected.value.reason == "gemini_quota"
+    assert rejected.value.retry_after == 3
@@ -0,0 +1,108 @@
+# test_chat_jobs.py
+# Run from the project root: python -m pytest tests
+import sqlite3
+import time
+
+import pytest
+
+from services import chat_jobs
+from services.admission import AdmissionRejected
+from services.chat_jobs import ChatJobQueue
+
+SESSION = {"user_email": "alice@example.com", "branches": ["Pokhara"]}
+REQUEST_ID = "0123456789abcdef0123456789abcdef"
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    """A queue over an empty chat_jobs table in a temporary database."""
+    monkeypatch.setattr(chat_jobs, "DB_PATH", str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(chat_jobs, "_jobs_table_ready", False)
+    monkeypatch.setattr(ChatJobQueue, "_instance", None)
+    return ChatJobQueue()
+
+
+def backdate(job_id: str, **columns):
+    with sqlite3.connect(chat_jobs.DB_PATH) as conn:
+        for column, value in columns.items():
+            conn.execute(f"UPDATE chat_jobs SET {column} = ? WHERE job_id = ?", (value, job_id))
+
+
+def test_job_runs_from_queued_to_done(queue):
+    job = queue.submit("alice", "How many enquiries today?", SESSION)
+    assert job["status"] == "queued" and job["position"] == 1
+
+    claimed = queue._claim()
+    assert claimed["job_id"] == job["job_id"] and claimed["session"] == SESSION
+    assert queue.get(job["job_id"], "alice")["status"] == "running"
+    assert queue._claim() is None
+
+    queue._finish(job["job_id"], "done", {"response": "12"})
+    done = queue.get(job["job_id"], "alice", wait=5)
+    assert done["status"] == "done" and done["result"] == {"response": "12"}
+    assert queue.get(job["job_id"], "bob") is None
+
+
+def test_jobs_are_claimed_oldest_first(queue):
+    first = queue.submit("alice", "first", SESSION)
+    second = queue.submit("bob", "second", SESSION)
+    assert queue.get(second["job_id"], "bob")["position"] == 2
+    assert queue._claim()["job_id"] == first["job_id"]
+    assert queue._claim()["job_id"] == second["job_id"]
+
+
+def test_per_user_limit_counts_pending_jobs_only(queue, monkeypatch):
+    monkeypatch.setattr(chat_jobs, "CHAT_JOB_MAX_PER_USER", 2)
+    first = queue.submit("alice", "one", SESSION)
+    queue.submit("alice", "two", SESSION)
+    assert queue.track_inline(REQUEST_ID, "alice", "inline")  # Plain /chat requests do not count
+    with pytest.raises(AdmissionRejected):
+        queue.submit("alice", "three", SESSION)
+    queue.submit("bob", "one", SESSION)
+
+    queue._finish(first["job_id"], "done", {"response": "ok"})
+    queue.submit("alice", "three", SESSION)
+
+
+def test_only_queued_jobs_can_be_cancelled(queue):
+    job = queue.submit("alice", "one", SESSION)
+    assert not queue.cancel(job["job_id"], "bob")
+    assert queue.cancel(job["job_id"], "alice")
+    assert queue.get(job["job_id"], "alice")["status"] == "cancelled"
+    assert queue._claim() is None
+
+    running = queue.submit("alice", "two", SESSION)
+    queue._claim()
+    assert not queue.cancel(running["job_id"], "alice")
+
+
+def test_inline_request_is_tracked_once_and_stores_its_response(queue):
+    assert not queue.track_inline("not-a-hex-id", "alice", "hi")
+    assert queue.track_inline(REQUEST_ID, "alice", "hi")
+    assert not queue.track_inline(REQUEST_ID, "alice", "hi again")
+    assert queue.get(REQUEST_ID, "alice")["status"] == "running"
+    assert queue._claim() is None  # Answered by the request itself, never by a worker
+
+    queue.finish_inline(REQUEST_ID, {"response": "Branch is busy"}, 503)
+    failed = queue.get(REQUEST_ID, "alice")
+    assert failed["status"] == "failed" and failed["error"] == "Branch is busy"
+
+
+def test_sweep_deletes_expired_jobs_and_fails_abandoned_ones(queue):
+    now = time.time()
+    expired = queue.submit("alice", "old", SESSION)
+    queue._finish(expired["job_id"], "done", {"response": "ok"})
+    backdate(expired["job_id"], finished_at=now - chat_jobs.CHAT_JOB_TTL_HOURS * 3600 - 1)
+    recent = queue.submit("alice", "recent", SESSION)
+    queue._finish(recent["job_id"], "done", {"response": "ok"})
+    abandoned = queue.submit("alice", "abandoned", SESSION)
+    queue._claim()
+    backdate(abandoned["job_id"], started_at=now - chat_jobs.CHAT_JOB_MAX_SECONDS * 2 - 1)
+    queue.track_inline(REQUEST_ID, "alice", "still running")
+
+    queue._sweep()
+    assert queue.get(expired["job_id"], "alice") is None
+    assert queue.get(recent["job_id"], "alice")["status"] == "done"
+    interrupted = queue.get(abandoned["job_id"], "alice")
+    assert interrupted["status"] == "failed" and interrupted["error"] == "interrupted"
+    assert queue.get(REQUEST_ID, "alice")["status"] == "running"
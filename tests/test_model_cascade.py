@@ -0,0 +1,35 @@
+# test_model_cascade.py
+# Run from the project root: python -m pytest tests
+import pytest
+
+from services.model_cascade import escalation_reason
+
+
+def sql_step(observation: str):
+    return ({"tool": "execute_sql", "tool_input": {"query": "SELECT 1"}}, observation)
+
+
+@pytest.mark.parametrize("output", [
+    "There were no applications from Pokhara this week.",
+    "I couldn't find any enquiries for that client.",
+    "The count is 0.",
+    "None of the deals match.",
+])
+def test_empty_result_with_matching_answer_is_accepted(output):
+    result = {"output": output, "intermediate_steps": [sql_step("[]")]}
+    assert escalation_reason(result, []) is None
+
+
+def test_empty_result_contradicted_by_answer_escalates():
+    result = {"output": "Pokhara had 42 applications this week.", "intermediate_steps": [sql_step("[]")]}
+    assert escalation_reason(result, []) == "empty_result"
+
+
+def test_sql_error_escalates():
+    result = {"output": "Done.", "intermediate_steps": [sql_step("Error: Unrecognized name")]}
+    assert escalation_reason(result, []) == "sql_error"
+
+
+def test_non_empty_result_is_accepted():
+    result = {"output": "Pokhara had 42 applications.", "intermediate_steps": [sql_step('[{"n": 42}]')]}
+    assert escalation_reason(result, []) is None
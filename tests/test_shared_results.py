@@ -0,0 +1,119 @@
+# test_shared_results.py
+# Run from the project root: python -m pytest tests
+import threading
+
+import pytest
+
+from cache import shared_results
+from cache.shared_results import BRANCH_KEY, SharedQuery, plan_shared_query, slice_rows
+
+
+def test_plan_drops_the_branch_filter_and_groups_by_branch():
+    plan = plan_shared_query(
+        "SELECT Status, COUNT(*) AS n, MAX(Added_Date) FROM hackathon_data.application_table "
+        "WHERE LOWER(branch) IN ('pokhara', 'Butwal') AND Status = 'open' "
+        "GROUP BY Status ORDER BY n DESC LIMIT 5"
+    )
+    assert plan.sql == (
+        "SELECT branch AS _branch, Status AS Status, COUNT(*) AS n, MAX(Added_Date) AS f0_ "
+        "FROM hackathon_data.application_table WHERE Status = 'open' GROUP BY branch, Status"
+    )
+    assert plan.branches == {"pokhara", "butwal"}
+    assert plan.columns == ["Status", "n", "f0_"]
+    assert plan.keys == ["Status"]
+    assert plan.measures == {"n": "count", "f0_": "max"}
+    assert plan.order == [("n", True)]
+    assert plan.limit == 5
+
+
+@pytest.mark.parametrize("query", [
+    # No branch filter, or more than one
+    "SELECT COUNT(*) FROM hackathon_data.application_table",
+    "SELECT COUNT(*) FROM hackathon_data.application_table WHERE Status = 'open'",
+    "SELECT COUNT(*) FROM hackathon_data.application_table WHERE branch = 'Pokhara' AND branch = 'Butwal'",
+    "SELECT COUNT(*) FROM hackathon_data.application_table WHERE branch = 'Pokhara' OR Status = 'open'",
+    # Shapes whose rows cannot be re-aggregated across branches
+    "SELECT AVG(amount) FROM hackathon_data.application_table WHERE branch = 'Pokhara'",
+    "SELECT COUNT(DISTINCT Status) FROM hackathon_data.application_table WHERE branch = 'Pokhara'",
+    "SELECT ROUND(SUM(amount)) FROM hackathon_data.application_table WHERE branch = 'Pokhara'",
+    "SELECT DISTINCT Status FROM hackathon_data.application_table WHERE branch = 'Pokhara'",
+    "SELECT Status, COUNT(*) FROM hackathon_data.application_table WHERE branch = 'Pokhara' "
+    "GROUP BY Status HAVING COUNT(*) > 1",
+    "SELECT Status, Added_Date, COUNT(*) FROM hackathon_data.application_table WHERE branch = 'Pokhara' "
+    "GROUP BY Status",
+    "SELECT * FROM hackathon_data.application_table WHERE branch = 'Pokhara'",
+    "SELECT COUNT(*) FROM hackathon_data.application_table WHERE branch = 'Pokhara' LIMIT 5 OFFSET 5",
+    "SELECT Status, COUNT(*) OVER () FROM hackathon_data.application_table WHERE branch = 'Pokhara'",
+    # Several tables
+    "SELECT COUNT(*) FROM hackathon_data.application_table a JOIN hackathon_data.enquiry_table e "
+    "ON a.id = e.id WHERE a.branch = 'Pokhara'",
+    "SELECT COUNT(*) FROM (SELECT * FROM hackathon_data.application_table) WHERE branch = 'Pokhara'",
+    "SELECT COUNT(*) FROM hackathon_data.application_table WHERE branch = 'Pokhara' "
+    "AND id IN (SELECT id FROM hackathon_data.enquiry_table)",
+    # A table without a branch column
+    "SELECT COUNT(*) FROM hackathon_data.feedback_questions_table WHERE branch = 'Pokhara'",
+])
+def test_unshareable_queries_are_not_planned(query):
+    assert plan_shared_query(query) is None
+
+
+def make_plan(branches=None, keys=("status",), measures=None, order=None, limit=None):
+    measures = measures or {"n": "count", "total": "sum", "low": "min", "high": "max"}
+    return SharedQuery("", branches, list(keys) + list(measures), list(keys), measures, order, limit)
+
+
+def row(branch, status, n, total, low, high):
+    return {BRANCH_KEY: branch, "status": status, "n": n, "total": total, "low": low, "high": high}
+
+
+def test_slice_keeps_the_users_branches_and_merges_measures():
+    rows = [
+        row("Pokhara", "open", 2, 10, 1, 7),
+        row("Butwal", "open", 3, 5, 0, 4),
+        row("Kathmandu", "open", 100, 100, -5, 50),
+        row("pokhara", "closed", 1, None, None, None),
+    ]
+    sliced = slice_rows(make_plan(branches=["POKHARA", "Butwal"]), rows)
+    assert sorted(sliced, key=lambda r: r["status"]) == [
+        {"status": "closed", "n": 1, "total": None, "low": None, "high": None},
+        {"status": "open", "n": 5, "total": 15, "low": 0, "high": 7},
+    ]
+
+
+def test_slice_ignores_nulls_when_merging():
+    rows = [row("A", "open", 1, None, None, None), row("B", "open", 1, 4, 2, 2)]
+    assert slice_rows(make_plan(), rows) == [{"status": "open", "n": 2, "total": 4, "low": 2, "high": 2}]
+
+
+def test_slice_orders_nulls_like_bigquery_and_applies_the_limit():
+    rows = [row("A", status, 1, total, 0, 0) for status, total in [("a", 3), ("b", None), ("c", 1), ("d", 2)]]
+    ascending = slice_rows(make_plan(order=[("total", False)]), rows)
+    assert [r["total"] for r in ascending] == [None, 1, 2, 3]
+    descending = slice_rows(make_plan(order=[("total", True)], limit=3), rows)
+    assert [r["total"] for r in descending] == [3, 2, 1]
+
+
+def test_ungrouped_aggregate_with_no_rows_for_the_user_returns_one_row():
+    rows = [{BRANCH_KEY: "Kathmandu", "n": 4, "high": 9}]
+    plan = make_plan(branches=["Pokhara"], keys=(), measures={"n": "count", "high": "max"})
+    assert slice_rows(plan, rows) == [{"n": 0, "high": None}]
+    grouped = make_plan(branches=["Pokhara"])
+    assert slice_rows(grouped, [row("Kathmandu", "open", 1, 1, 1, 1)]) == []
+
+
+def test_single_flight_runs_callers_one_at_a_time_and_forgets_the_key():
+    active, overlaps = [], []
+
+    def call():
+        with shared_results._single_flight("key"):
+            active.append(1)
+            overlaps.append(len(active))
+            active.pop()
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [1] * 8
+    assert shared_results._inflight == {}
@@ -0,0 +1,119 @@
+# test_sql_rewriter.py
+# Run from the project root: python -m pytest tests
+import pytest
+
+from tools.query_guard import QueryRejected
+from tools.sql_rewriter import rewrite_query
+
+BRANCHES = ["Kathmandu", "Pokhara"]
+SCOPE = "LOWER(branch) IN ('kathmandu', 'pokhara')"
+
+
+def where_of(sql: str) -> str:
+    return sql.split(" WHERE ", 1)[1]
+
+
+@pytest.mark.parametrize("condition, expected", [
+    ("DATE(Added_Date) >= '2024-01-01'", "Added_Date >= '2024-01-01'"),
+    ("DATE(Added_Date) > '2024-01-01'", "Added_Date >= '2024-01-02'"),
+    ("DATE(Added_Date) < '2024-01-01'", "Added_Date < '2024-01-01'"),
+    ("DATE(Added_Date) <= '2024-01-31'", "Added_Date < '2024-02-01'"),
+    ("DATE(Added_Date) = '2024-03-05'", "Added_Date >= '2024-03-05' AND Added_Date < '2024-03-06'"),
+    ("DATE(Added_Date) BETWEEN '2024-01-01' AND '2024-01-31'",
+     "Added_Date >= '2024-01-01' AND Added_Date < '2024-02-01'"),
+    ("CAST(Added_Date AS DATE) = '2024-03-05'", "Added_Date >= '2024-03-05' AND Added_Date < '2024-03-06'"),
+    ("PARSE_DATE('%Y-%m-%d', Added_Date) >= '2024-01-01'", "Added_Date >= '2024-01-01'"),
+    ("EXTRACT(YEAR FROM Added_Date) = 2024", "Added_Date >= '2024-01-01' AND Added_Date < '2025-01-01'"),
+    ("EXTRACT(YEAR FROM Added_Date) = 2024 AND EXTRACT(MONTH FROM Added_Date) = 12",
+     "Added_Date >= '2024-12-01' AND Added_Date < '2025-01-01'"),
+])
+def test_wrapped_dates_become_ranges(condition, expected):
+    sql = rewrite_query(f"SELECT COUNT(*) FROM hackathon_data.application_table WHERE {condition}", None)
+    assert where_of(sql) == expected
+
+
+@pytest.mark.parametrize("condition", [
+    "DATE(Added_Date, 'Asia/Kathmandu') = '2024-03-05'",
+    "PARSE_DATE('%d/%m/%Y', Added_Date) = '2024-03-05'",
+    "EXTRACT(MONTH FROM Added_Date) = 12",
+])
+def test_other_date_expressions_are_left_alone(condition):
+    query = f"SELECT COUNT(*) FROM hackathon_data.application_table WHERE {condition}"
+    assert rewrite_query(query, None) == query
+
+
+def test_branch_predicate_is_case_insensitive():
+    sql = rewrite_query("SELECT COUNT(*) FROM hackathon_data.application_table", BRANCHES)
+    assert where_of(sql) == SCOPE
+
+
+def test_requested_branch_is_intersected_with_allowed_branches():
+    query = "SELECT COUNT(*) FROM hackathon_data.application_table WHERE branch = 'POKHARA'"
+    assert where_of(rewrite_query(query, BRANCHES)) == "LOWER(branch) IN ('pokhara')"
+    query = "SELECT COUNT(*) FROM hackathon_data.application_table WHERE branch = 'Butwal'"
+    assert where_of(rewrite_query(query, BRANCHES)) == "FALSE"
+
+
+def test_joined_tables_are_scoped_in_on_clause():
+    sql = rewrite_query(
+        "SELECT COUNT(*) FROM hackathon_data.enquiry_table e "
+        "JOIN hackathon_data.application_table a ON a.client_name = e.client_name", BRANCHES
+    )
+    assert "ON a.client_name = e.client_name AND LOWER(a.branch) IN ('kathmandu', 'pokhara')" in sql
+    assert where_of(sql) == "LOWER(e.branch) IN ('kathmandu', 'pokhara')"
+
+
+def test_all_branches_get_no_predicate():
+    query = "SELECT COUNT(*) FROM hackathon_data.application_table"
+    assert rewrite_query(query, None) == query
+
+
+def test_right_joined_table_is_filtered_before_the_join():
+    sql = rewrite_query(
+        "SELECT a.* FROM hackathon_data.base_branch_table b "
+        "RIGHT JOIN hackathon_data.application_table a ON b.branch_name = a.branch", ["Pokhara"]
+    )
+    assert "RIGHT JOIN (SELECT * FROM hackathon_data.application_table " \
+           "WHERE LOWER(branch) IN ('pokhara')) AS a ON b.branch_name = a.branch" in sql
+    assert " WHERE LOWER(a.branch)" not in sql
+
+
+def test_full_join_filters_both_sides_before_the_join():
+    sql = rewrite_query(
+        "SELECT COUNT(*) FROM hackathon_data.enquiry_table e "
+        "FULL JOIN hackathon_data.application_table a ON a.client_name = e.client_name", BRANCHES
+    )
+    assert sql == (
+        "SELECT COUNT(*) FROM (SELECT * FROM hackathon_data.enquiry_table WHERE " + SCOPE + ") AS e "
+        "FULL JOIN (SELECT * FROM hackathon_data.application_table WHERE " + SCOPE + ") AS a "
+        "ON a.client_name = e.client_name"
+    )
+
+
+def test_table_names_are_matched_case_insensitively():
+    sql = rewrite_query("SELECT COUNT(*) FROM HACKATHON_DATA.Application_Table", BRANCHES)
+    assert where_of(sql) == SCOPE
+
+
+@pytest.mark.parametrize("table", [
+    "hackathon_data.base_contact_table",
+    "hackathon_data.enquiry_deals_applications_table",
+    "hackathon_data.INFORMATION_SCHEMA.TABLES",
+    "crm_users",
+])
+def test_unscoped_tables_are_rejected_for_limited_users(table):
+    with pytest.raises(QueryRejected) as rejected:
+        rewrite_query(f"SELECT * FROM {table}", BRANCHES)
+    assert rejected.value.feedback["reason"] == "table_not_branch_scoped"
+
+
+def test_shared_tables_and_ctes_are_readable():
+    query = "SELECT branch_name FROM hackathon_data.base_branch_table"
+    assert rewrite_query(query, BRANCHES) == query
+    sql = rewrite_query("WITH a AS (SELECT * FROM hackathon_data.application_table) SELECT COUNT(*) FROM a", BRANCHES)
+    assert sql.endswith(f"WHERE {SCOPE}) SELECT COUNT(*) FROM a")
+
+
+def test_unscoped_tables_are_readable_with_all_branches():
+    query = "SELECT * FROM hackathon_data.base_contact_table"
+    assert rewrite_query(query, None) == query
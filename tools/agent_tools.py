@@ -11,27 +11,70 @@ from google.cloud import bigquery
 import os
 from tools.document_rag import search_documents
 from cache.cache_manager import cached
+from tools.query_guard import run_guarded_query
+from tools.sql_rewriter import rewrite_query
+from tools.request_context import get_request_branches
+from services.backends import create_bq_client
+from monitoring.tracing import span, annotate, traced
+from monitoring.metrics import CHART_RENDER_SECONDS
+from db.replica import replica_enabled, replica_only, query_replica, describe_replica, UnsupportedQuery
+from db.rollups import describe_rollups, serves_locally
+from cache.shared_results import plan_shared_query, fetch_shared
 
 # Configuration
 PROJECT_ID = 'expert-hackathon-2026'
 DATASET_ID = 'hackathon_data'
+SQL_ROW_LIMIT = 50  # Rows returned to the agent
+CHART_ROW_LIMIT = 500  # Data points plotted per chart
 
-# Initialize Client
-def get_bq_client(project):
-    json_creds = os.environ.get('GCP_SERVICE_ACCOUNT_JSON')
-    if json_creds:
-        from google.oauth2 import service_account
-        from google.cloud import bigquery
+# Initialize Client (a DuckDB-backed fake when FAKE_BACKENDS=1)
+bq_client = create_bq_client(PROJECT_ID)
+
+def _fetch_rows(query: str, purpose: str, row_limit: int = None, query_parameters: list = None,
+                stream: bool = False):
+    if not query_parameters and (replica_enabled() or serves_locally(query)):
         try:
-            info = json.loads(json_creds)
-            credentials = service_account.Credentials.from_service_account_info(info)
-            return bigquery.Client(project=project, credentials=credentials)
-        except Exception as e:
-            print(f"Error loading GCP_SERVICE_ACCOUNT_JSON in tools: {e}")
-    from google.cloud import bigquery
-    return bigquery.Client(project=project)
+            rows = query_replica(query, row_limit=row_limit)
+            annotate(source="replica", rows=len(rows))
+            return rows
+        except UnsupportedQuery as e:
+            if replica_only():
+                raise
+            print(f"[REPLICA MISS] {e} - falling back to BigQuery")
+    annotate(source="bigquery")
+    return run_guarded_query(bq_client, query, purpose=purpose, row_limit=row_limit,
+                             query_parameters=query_parameters, stream=stream)
+
+def fetch_rows(query: str, purpose: str, row_limit: int = None, stream: bool = False):
+    """
+    Rewrite agent SQL for the user's branches and prunable date filters (tools/sql_rewriter.py),
+    then run it on the local replica when enabled (or when it only reads local rollups),
+    otherwise (or on unsupported syntax) through the guarded BigQuery path.
+    Branch-filtered aggregates are answered from a result shared by all users (cache/shared_results.py).
+    Returns an iterable of mapping-like rows; with `stream`, BigQuery rows are paged lazily.
+    """
+    with span("sql.fetch", purpose=purpose):
+        query = rewrite_query(query, get_request_branches())
+        plan = plan_shared_query(query)
+        if plan is not None:
+            rows = fetch_shared(plan, lambda sql, params, limit: _fetch_rows(sql, purpose, limit, params))
+            if rows is not None:
+                annotate(source="shared", rows=len(rows))
+                return rows[:row_limit] if row_limit else rows
+        return _fetch_rows(query, purpose, row_limit, stream=stream)
 
-bq_client = get_bq_client(PROJECT_ID)
+def serialize_rows(rows) -> list:
+    """Convert result rows to JSON-safe dicts (dates as ISO strings, everything else as text)."""
+    valid_rows = []
+    for row in rows:
+        d = {}
+        for key, value in row.items():
+             if hasattr(value, 'isoformat'):
+                  d[key] = value.isoformat()
+             else:
+                  d[key] = str(value)
+        valid_rows.append(d)
+    return valid_rows
 
 @tool
 def list_tables() -> str:
@@ -40,6 +83,9 @@ def list_tables() -> str:
     Use this to understand the database structure before writing queries.
     """
     try:
+        if replica_enabled():
+            return describe_replica() + describe_rollups(bq_client)
+
         tables = list(bq_client.list_tables(DATASET_ID))
         schema_text = []
         
@@ -50,7 +96,7 @@ def list_tables() -> str:
             schema_text.extend(columns)
             schema_text.append("") 
             
-        return "\n".join(schema_text)
+        return "\n".join(schema_text) + describe_rollups(bq_client)
     except Exception as e:
         return f"Error fetching schema: {e}"
 
@@ -59,40 +105,32 @@ def execute_sql(query: str) -> str:
     """
     Execute a Standard SQL query in BigQuery and return the results as a string.
     Always query against `expert-hackathon-2026.hackathon_data`.
+    If the query is rejected for cost or time, rewrite it using the feedback in the error.
     """
     try:
-        query_job = bq_client.query(query)
-        rows = list(query_job.result())
+        rows = list(fetch_rows(query, purpose="execute_sql", row_limit=SQL_ROW_LIMIT))
         
         if not rows:
             return "[]" # Return empty JSON array
             
         # Serialize to formatted string for the Agent to read
-        # Limit to 50 rows to prevent context overflow
-        valid_rows = []
-        for row in rows[:50]:
-            # Convert row to dict and handle datetimes
-            d = {}
-            for key, value in row.items():
-                 if hasattr(value, 'isoformat'):
-                      d[key] = value.isoformat()
-                 else:
-                      d[key] = str(value)
-            valid_rows.append(d)
-
-        return json.dumps(valid_rows)
+        # Limit rows to prevent context overflow
+        return json.dumps(serialize_rows(rows[:SQL_ROW_LIMIT]))
         
     except Exception as e:
         return f"Error executing SQL: {e}"
 
+@traced("chart.render_image")
+@CHART_RENDER_SECONDS.labels("image").time()
 def generate_plot_image(data_query: str, chart_type: str, title: str) -> dict:
     """
     Helper function to generate plot and return dict with base64 image.
     """
     try:
         # 1. Get Data
-        query_job = bq_client.query(data_query)
-        df = query_job.to_dataframe()
+        rows = fetch_rows(data_query, purpose="visualization", row_limit=CHART_ROW_LIMIT)
+        # Replica and shared rows are dicts, BigQuery rows are Row objects; both have items()
+        df = pd.DataFrame([dict(row.items()) for row in rows])
         
         if df.empty:
             return {"error": "No data returned for visualization"}
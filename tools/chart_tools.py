@@ -0,0 +1,119 @@
+# chart_tools.py
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextvars import ContextVar, copy_context
+from typing import Literal, Optional
+from pydantic import BaseModel, Field, model_validator
+from langchain.tools import tool
+from tools.agent_tools import fetch_rows, serialize_rows, CHART_ROW_LIMIT
+from monitoring.metrics import CHART_RENDER_SECONDS
+
+CHART_FETCH_WORKERS = int(os.environ.get("CHART_FETCH_WORKERS", 4))
+CHART_FETCH_TIMEOUT = float(os.environ.get("CHART_FETCH_TIMEOUT", 45))
+
+# Chart data is fetched here while the agent is still writing its answer
+chart_executor = ThreadPoolExecutor(max_workers=CHART_FETCH_WORKERS, thread_name_prefix="chart-fetch")
+
+# Charts requested during the current /chat turn (a list set by begin_chart_requests)
+pending_charts = ContextVar("pending_charts", default=None)
+
+
+class ChartSpec(BaseModel):
+    """Arguments of `render_chart`."""
+    chart_type: Literal["bar", "line", "pie", "doughnut", "scatter", "flowchart"] = Field(
+        description="Chart type. Use 'flowchart' for processes and workflows (Mermaid syntax in `data`)."
+    )
+    title: str = Field(description="A clear, human readable chart title.")
+    data_query: Optional[str] = Field(
+        default=None,
+        description="BigQuery SQL for the chart data. Return the CATEGORY/LABEL as the first column "
+                    "and the VALUE/COUNT as the second column."
+    )
+    data: Optional[str] = Field(
+        default=None,
+        description="Mermaid syntax for flowcharts, or a JSON array of row objects when the data is "
+                    "already known. Leave empty when `data_query` is given."
+    )
+
+    @model_validator(mode="after")
+    def check_source(self):
+        if self.chart_type == "flowchart":
+            if not self.data:
+                raise ValueError("flowchart requires Mermaid syntax in `data`")
+        elif bool(self.data_query) == bool(self.data):
+            raise ValueError("provide exactly one of `data_query` or `data`")
+        if self.data and self.chart_type != "flowchart":
+            try:
+                rows = json.loads(self.data)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"`data` must be a JSON array of row objects: {e}")
+            if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+                raise ValueError("`data` must be a JSON array of row objects")
+        return self
+
+
+@CHART_RENDER_SECONDS.labels("interactive").time()
+def _fetch_chart_data(data_query: str) -> list:
+    rows = fetch_rows(data_query, purpose="visualization", row_limit=CHART_ROW_LIMIT)
+    return serialize_rows(rows)
+
+
+def begin_chart_requests():
+    """Start collecting charts for the current request. Call before invoking the agent."""
+    pending_charts.set([])
+
+
+def collect_charts(timeout: float = CHART_FETCH_TIMEOUT) -> list:
+    """
+    Wait for the charts requested in this turn and return their payloads in request order.
+    Each payload has `visualization_type`, `visualization_title`, `data`, `data_query`
+    and, if the data could not be fetched, `error`.
+    """
+    payloads = []
+    for spec, future in pending_charts.get() or []:
+        payload = {
+            "visualization_type": spec.chart_type,
+            "visualization_title": spec.title,
+            "data": None,
+            "data_query": spec.data_query,
+        }
+        if future is None:
+            payload["data"] = spec.data if spec.chart_type == "flowchart" else json.loads(spec.data)
+        else:
+            try:
+                payload["data"] = future.result(timeout=timeout)
+            except FutureTimeout:
+                payload["error"] = f"Chart data was not ready after {timeout:.0f}s"
+            except Exception as e:
+                payload["error"] = str(e)
+        payloads.append(payload)
+    return payloads
+
+
+@tool(args_schema=ChartSpec)
+def render_chart(chart_type: str, title: str, data_query: str = None, data: str = None) -> str:
+    """
+    Render an interactive chart or flowchart in the chat window, below your answer.
+    Use this for every chart, graph, comparison or trend request and for process flowcharts,
+    instead of writing JSON, markdown tables or ASCII charts in your answer.
+    The chart data is fetched while you write your answer, so you will not see the values;
+    use `execute_sql` first if you need to describe specific numbers.
+    """
+    spec = ChartSpec(chart_type=chart_type, title=title, data_query=data_query, data=data)
+    charts = pending_charts.get()
+    if charts is None:
+        # Outside a /chat request nobody would collect the chart
+        return "Charts can only be rendered during a chat request."
+
+    future = None
+    if spec.data_query:
+        # Copy the request context so the query is attributed to (and scoped for) this user
+        future = chart_executor.submit(copy_context().run, _fetch_chart_data, spec.data_query)
+    charts.append((spec, future))
+    return (f"Chart '{spec.title}' will be rendered below your answer. "
+            "Do not repeat it as JSON or a table; briefly describe what it shows.")
+
+
+# Let the agent see schema errors and retry instead of aborting the turn
+render_chart.handle_validation_error = lambda e: f"Invalid chart arguments: {e}. Fix them and call render_chart again."
@@ -3,23 +3,29 @@ import os
 from typing import List
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain.tools import tool
 import json
 from dotenv import load_dotenv
 from cache.cache_manager import cached
+from monitoring.tracing import span, annotate
+from monitoring.metrics import FAISS_SEARCH_SECONDS
+from services.backends import create_document_embeddings
+from tools.search_batcher import SearchBatcher
 
 # Load environment variables
 load_dotenv()
 
 # Configuration
 PUBLIC_FOLDER = "public"
-VECTOR_STORE_PATH = "document_vectors"
+VECTOR_STORE_PATH = os.environ.get("DOCUMENT_VECTORS_PATH", "document_vectors")
 
 # Global vector store instance
 vector_store = None
 
+# Concurrent searches share one embedding request and one FAISS search
+search_batcher = SearchBatcher(lambda: vector_store)
+
 def initialize_document_store(force_rebuild: bool = False):
     """
     Initialize the document vector store by processing all PDFs in the public folder.
@@ -33,7 +39,7 @@ def initialize_document_store(force_rebuild: bool = False):
         # Check if vector store already exists and we're not forcing rebuild
         if not force_rebuild and os.path.exists(VECTOR_STORE_PATH):
             print(f"Loading existing vector store from {VECTOR_STORE_PATH}")
-            embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+            embeddings = create_document_embeddings()
             vector_store = FAISS.load_local(
                 VECTOR_STORE_PATH, 
                 embeddings,
@@ -90,7 +96,7 @@ def initialize_document_store(force_rebuild: bool = False):
         
         # Create embeddings and vector store
         print("Generating embeddings...")
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+        embeddings = create_document_embeddings()
         vector_store = FAISS.from_documents(chunks, embeddings)
         
         # Save vector store
@@ -122,7 +128,9 @@ def search_documents_rag(query: str, k: int = 4) -> str:
     
     try:
         # Perform similarity search
-        results = vector_store.similarity_search(query, k=k)
+        with span("faiss.search", k=k), FAISS_SEARCH_SECONDS.time():
+            results = search_batcher.search(query, k=k)
+            annotate(results=len(results))
         
         if not results:
             return json.dumps({
@@ -0,0 +1,206 @@
+# query_guard.py
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from google.cloud import bigquery
+from cache.cache_manager import DB_PATH
+from db.job_engine import JobEngine
+from tools.request_context import get_request_user
+from monitoring.tracing import annotate
+from monitoring.metrics import record_query
+from services.admission import bigquery_bucket, retry_with_backoff, is_quota_error
+
+# Guardrail configuration (override via environment)
+MAX_BYTES_BILLED = int(os.environ.get("BQ_MAX_BYTES_BILLED", 1024 ** 3))  # 1 GiB
+JOB_TIMEOUT_SECONDS = float(os.environ.get("BQ_JOB_TIMEOUT_SECONDS", 30))  # 0 disables it (and allows short queries)
+
+# A query already ending in LIMIT n [OFFSET m] is left alone
+_TRAILING_LIMIT = re.compile(r"\blimit\s+\d+(\s+offset\s+\d+)?\s*$", re.IGNORECASE)
+
+_log_table_ready = False
+
+
+class QueryRejected(Exception):
+    """
+    Raised when the guardrail refuses to run a query.
+    The message carries structured feedback so the agent can rewrite the query.
+    """
+
+    def __init__(self, reason: str, **details):
+        self.feedback = {"status": "rejected", "reason": reason, **details}
+        super().__init__(f"Query rejected by cost guardrail: {json.dumps(self.feedback)}")
+
+
+def _init_log_table():
+    global _log_table_ready
+    if _log_table_ready:
+        return
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_cost_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                purpose TEXT,
+                query_hash TEXT,
+                estimated_bytes INTEGER,
+                billed_bytes INTEGER,
+                status TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+    _log_table_ready = True
+
+
+def _format_bytes(num_bytes) -> str:
+    size = float(num_bytes or 0)
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def log_query_cost(purpose: str, query: str, estimated_bytes: int, billed_bytes, status: str):
+    """Record the estimate (and actual billing, if the job ran) for the current user."""
+    user_id = get_request_user()
+    annotate(bq_estimated_bytes=estimated_bytes, bq_billed_bytes=billed_bytes, bq_status=status)
+    record_query(purpose, estimated_bytes, billed_bytes, status)
+    print(f"[QUERY GUARD] user={user_id} purpose={purpose} "
+          f"estimated={_format_bytes(estimated_bytes)} status={status}")
+    try:
+        _init_log_table()
+        query_hash = hashlib.sha256(query.encode()).hexdigest()
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.execute(
+                "INSERT INTO query_cost_log (user_id, purpose, query_hash, estimated_bytes, billed_bytes, status) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, purpose, query_hash, estimated_bytes, billed_bytes, status)
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"Query cost log error: {e}")
+
+
+def _pruning_hints(client, dry_job) -> list:
+    """Describe partition/cluster columns of the referenced tables so the agent can narrow its scan."""
+    hints = []
+    for ref in dry_job.referenced_tables or []:
+        try:
+            table = client.get_table(ref)
+        except Exception:
+            continue
+        hint = {"table": f"{ref.dataset_id}.{ref.table_id}"}
+        if table.time_partitioning:
+            hint["partition_column"] = table.time_partitioning.field or "_PARTITIONTIME"
+        if table.clustering_fields:
+            hint["cluster_columns"] = list(table.clustering_fields)
+        hints.append(hint)
+    return hints
+
+
+def apply_row_limit(query: str, row_limit: int) -> str:
+    """Append a LIMIT to a read query that does not already end with one."""
+    if not row_limit or _TRAILING_LIMIT.search(query):
+        return query
+    # Newline first so a trailing line comment cannot swallow the LIMIT
+    return f"{query}\nLIMIT {int(row_limit)}"
+
+
+def run_guarded_query(client, query: str, purpose: str = "execute_sql",
+                      row_limit: int = None, query_parameters: list = None, stream: bool = False):
+    """
+    Dry-run a query, enforce the byte and time budget, then execute it.
+
+    Args:
+        client: BigQuery client to run the query with.
+        query: The SQL generated by the agent.
+        purpose: Label used in the per-user cost log.
+        row_limit: If set, a LIMIT is appended when the query has none.
+        query_parameters: Optional BigQuery query parameters.
+        stream: Return the unread RowIterator so the caller pages through it lazily.
+
+    Returns:
+        The rows of the finished job as a list, or its RowIterator with `stream`.
+
+    Raises:
+        QueryRejected: If the query is not read-only, would scan too much, is over the
+            BigQuery rate budget, or times out.
+    """
+    query = query.strip().rstrip(";").strip()
+    params = query_parameters or []
+
+    dry_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False, query_parameters=params)
+    dry_job = client.query(query, job_config=dry_config)
+    estimated_bytes = dry_job.total_bytes_processed or 0
+
+    if dry_job.statement_type and dry_job.statement_type != "SELECT":
+        log_query_cost(purpose, query, estimated_bytes, None, "rejected_statement")
+        raise QueryRejected(
+            "read_only",
+            statement_type=dry_job.statement_type,
+            suggestion="Only SELECT queries are allowed. Rewrite the request as a SELECT."
+        )
+
+    if estimated_bytes > MAX_BYTES_BILLED:
+        log_query_cost(purpose, query, estimated_bytes, None, "rejected_bytes")
+        raise QueryRejected(
+            "too_many_bytes",
+            estimated_bytes=estimated_bytes,
+            limit_bytes=MAX_BYTES_BILLED,
+            tables=_pruning_hints(client, dry_job),
+            suggestion="Select only the columns you need, filter on the date or partition column, "
+                       "and aggregate in SQL instead of fetching raw rows."
+        )
+
+    # Pace jobs to the BigQuery quota; dry runs above are not counted
+    if not bigquery_bucket.acquire():
+        log_query_cost(purpose, query, estimated_bytes, None, "rejected_rate")
+        raise QueryRejected(
+            "rate_limited",
+            retry_after_seconds=round(bigquery_bucket.wait_time(), 1),
+            suggestion="BigQuery is busy. Answer from the results you already have, or ask the user to retry shortly."
+        )
+
+    query = apply_row_limit(query, row_limit)
+    config = bigquery.QueryJobConfig(maximum_bytes_billed=MAX_BYTES_BILLED, query_parameters=params)
+
+    def run_job():
+        # The engine polls the job without holding this thread and shares identical queries in flight
+        return JobEngine().run(client, query, config, timeout=JOB_TIMEOUT_SECONDS or None,
+                               estimated_bytes=estimated_bytes, stream=stream)
+
+    try:
+        result = retry_with_backoff(run_job, "bigquery")
+    except concurrent.futures.TimeoutError:
+        # The engine has already cancelled the job
+        log_query_cost(purpose, query, estimated_bytes, None, "timeout")
+        raise QueryRejected(
+            "timeout",
+            timeout_seconds=JOB_TIMEOUT_SECONDS,
+            estimated_bytes=estimated_bytes,
+            suggestion="Narrow the date range or aggregate the data so the query finishes faster."
+        )
+    except Exception as e:
+        if "bytes billed" in str(e).lower():
+            log_query_cost(purpose, query, estimated_bytes, None, "rejected_billing")
+            raise QueryRejected(
+                "too_many_bytes",
+                estimated_bytes=estimated_bytes,
+                limit_bytes=MAX_BYTES_BILLED,
+                suggestion="Select fewer columns or filter on the date column."
+            )
+        if is_quota_error(e):
+            bigquery_bucket.penalize()
+        raise
+
+    stats = result.stats
+    annotate(bq_mode=stats["mode"], bq_job_id=stats.get("job_id"), bq_shared=result.shared,
+             bq_slot_millis=stats.get("slot_millis"), bq_cache_hit=stats.get("cache_hit"))
+    # A joined job was paid for by the request that started it; jobless answers only report bytes processed
+    billed_bytes = None if result.shared else (stats.get("bytes_billed") or stats.get("bytes_processed"))
+    log_query_cost(purpose, query, estimated_bytes, billed_bytes, "shared" if result.shared else "ok")
+    return result.rows
@@ -0,0 +1,39 @@
+# request_context.py
+from contextvars import ContextVar
+
+# Per-request values that tools need but cannot receive as LLM-visible arguments.
+# Set once at the start of a /chat request; LangChain copies the context into tool runs.
+current_user = ContextVar("current_user", default="default_user")
+# Branch names the user may see; None means unrestricted ("All branches")
+current_branches = ContextVar("current_branches", default=())
+
+
+def set_request_user(user_id: str):
+    """Bind the user making the current request so tools can attribute their work."""
+    return current_user.set(user_id or "default_user")
+
+
+def get_request_user() -> str:
+    return current_user.get()
+
+
+def set_request_branches(branches):
+    """Bind the branches the current user may access (None for all branches)."""
+    return current_branches.set(None if branches is None else tuple(branches))
+
+
+def get_request_branches():
+    return current_branches.get()
+
+
+def resolve_allowed_branches(primary_branch, allowed_branches_raw):
+    """
+    Parse the comma separated `branches` value from crm_users into a list of branch names.
+    Returns None when the user has access to all branches.
+    """
+    branches = [b.strip() for b in (allowed_branches_raw or "").split(',') if b.strip()]
+    if primary_branch and primary_branch not in branches:
+        branches.insert(0, primary_branch)
+    if any(b.lower() == "all branches" for b in branches):
+        return None
+    return branches
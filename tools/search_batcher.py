@@ -0,0 +1,140 @@
+# search_batcher.py
+"""
+Micro-batched document retrieval.
+
+Every document search used to embed its query with its own embedding request and then
+run its own FAISS search. Under concurrent load that is many tiny HTTP calls. Here
+searches are queued; a worker thread collects those arriving within
+DOC_SEARCH_BATCH_WINDOW_MS of the first (up to DOC_SEARCH_MAX_BATCH), embeds the
+distinct query texts in one `embed_documents` request, runs one `index.search` over the
+stacked query matrix and hands each caller its own top-k documents.
+
+A lone search waits at most one window. `DOC_SEARCH_BATCHING=0` restores one
+`similarity_search` per call.
+"""
+import concurrent.futures
+import inspect
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from monitoring.metrics import DOC_SEARCH_BATCH_SIZE, EMBEDDING_REQUESTS
+
+DOC_SEARCH_BATCHING = os.environ.get("DOC_SEARCH_BATCHING", "1") == "1"
+DOC_SEARCH_BATCH_WINDOW_MS = float(os.environ.get("DOC_SEARCH_BATCH_WINDOW_MS", 5))
+DOC_SEARCH_MAX_BATCH = int(os.environ.get("DOC_SEARCH_MAX_BATCH", 32))
+
+
+def _embed_queries(embeddings, texts: list) -> list:
+    """One embedding request for all texts, embedded as queries rather than documents."""
+    EMBEDDING_REQUESTS.labels("batched").inc()
+    if len(texts) == 1:
+        return [embeddings.embed_query(texts[0])]
+    # Gemini embeds documents and queries differently; other providers take no task type
+    if "task_type" in inspect.signature(embeddings.embed_documents).parameters:
+        return embeddings.embed_documents(texts, task_type="RETRIEVAL_QUERY")
+    return embeddings.embed_documents(texts)
+
+
+def search_batch(store, requests: list) -> list:
+    """
+    Top-k documents for several queries with one embedding call and one FAISS search.
+
+    Args:
+        store: A LangChain FAISS vector store.
+        requests: (query, k) pairs.
+
+    Returns:
+        One list of Documents per request, in order, the same as `store.similarity_search`.
+    """
+    texts = list(dict.fromkeys(query for query, _ in requests))
+    vectors = np.array(_embed_queries(store.embedding_function, texts), dtype=np.float32)
+    if store._normalize_L2:
+        import faiss
+        faiss.normalize_L2(vectors)
+    k = max(k for _, k in requests)
+    _, indices = store.index.search(vectors, k)
+
+    row_of = {text: row for row, text in enumerate(texts)}
+    results = []
+    for query, query_k in requests:
+        docs = []
+        for i in indices[row_of[query]][:query_k]:
+            if i == -1:
+                continue  # Fewer than k chunks in the index
+            docs.append(store.docstore.search(store.index_to_docstore_id[i]))
+        results.append(docs)
+    return results
+
+
+class SearchBatcher:
+    """Queues document searches and answers them in micro-batches on a daemon thread."""
+
+    def __init__(self, get_store, window_ms: float = DOC_SEARCH_BATCH_WINDOW_MS,
+                 max_batch: int = DOC_SEARCH_MAX_BATCH):
+        """
+        Args:
+            get_store: Returns the current FAISS store, read when each batch runs so a
+                rebuilt index is picked up.
+            window_ms: How long the first search of a batch waits for company.
+            max_batch: Searches per embedding request.
+        """
+        self._get_store = get_store
+        self._window = window_ms / 1000
+        self._max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def search(self, query: str, k: int = 4, timeout: float = 30) -> list:
+        """
+        Top-k documents for the query, embedded and searched together with concurrent callers.
+
+        Raises:
+            Whatever the embedding request or FAISS search raised for the batch.
+        """
+        if not DOC_SEARCH_BATCHING:
+            EMBEDDING_REQUESTS.labels("unbatched").inc()
+            return self._get_store().similarity_search(query, k=k)
+        self._ensure_worker()
+        future = concurrent.futures.Future()
+        self._queue.put((query, k, future))
+        return future.result(timeout=timeout)
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="doc-search-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self._window
+        while len(batch) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            DOC_SEARCH_BATCH_SIZE.observe(len(batch))
+            try:
+                results = search_batch(self._get_store(), [(query, k) for query, k, _ in batch])
+            except Exception as e:
+                print(f"[DOC SEARCH] Batch of {len(batch)} failed: {e}")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), docs in zip(batch, results):
+                future.set_result(docs)
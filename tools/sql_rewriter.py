@@ -0,0 +1,377 @@
+# sql_rewriter.py
+"""
+AST rewriting of agent SQL before it runs (execute_sql, chart data, exports).
+
+- Safety: only a single read-only query over `hackathon_data` and the rollup dataset
+  is accepted; anything else is rejected with feedback for the agent.
+- Branch access control: every branch-scoped table (the activity tables and their
+  rollups) is restricted to the user's branches, in the WHERE clause for the FROM
+  table and in the ON clause for joined tables. A table on the preserved side of a
+  RIGHT or FULL join is replaced by a branch-filtered subquery instead, as an ON
+  predicate would not drop its rows. Branch names are compared case-insensitively
+  (`LOWER(col) IN (...)`), as stored casing varies, and so are table names (the DuckDB
+  replica resolves them that way). A branch filter the agent already wrote is
+  intersected with the allowed branches, so asking about one branch still works and
+  asking about another branch returns nothing. For users limited to some branches,
+  any other table in the dataset (contacts, users, feedback, INFORMATION_SCHEMA) is
+  rejected unless it is a shared reference table (catalog.SHARED_TABLES).
+- Pruning: date filters wrapped in functions (`DATE(col)`, `CAST(col AS DATE)`,
+  `PARSE_DATE('%Y-%m-%d', col)`, `EXTRACT(YEAR/MONTH FROM col)`) become half-open
+  ranges on the raw column, so BigQuery can prune partitions and use clustering.
+"""
+import os
+import re
+from datetime import date, timedelta
+
+import sqlglot
+from sqlglot import exp
+
+from db.catalog import TABLE_COLUMNS, SHARED_TABLES
+from db.rollups import ROLLUPS, ROLLUP_DATASET
+from db.replica import PROJECT_ID, DATASET_ID
+from monitoring.metrics import SQL_REWRITES
+from tools.query_guard import QueryRejected
+
+SQL_REWRITE_ENABLED = os.environ.get("SQL_REWRITE_ENABLED", "1") == "1"
+
+# Activity tables carry the branch column used for access control (base_branch_table names branches differently)
+SCOPED_TABLES = {table: columns for table, columns in TABLE_COLUMNS.items() if columns["branch"] and columns["date"]}
+ALLOWED_DATASETS = {DATASET_ID.lower(), ROLLUP_DATASET.lower()}
+
+_UNSAFE_NODES = tuple(getattr(exp, name) for name in (
+    "Insert", "Update", "Delete", "Merge", "Create", "Drop", "Alter", "Command", "TruncateTable", "Grant"
+) if hasattr(exp, name))
+_CASE_FOLDS = (exp.Lower, exp.Upper, exp.Trim)
+_DATE_WRAPPERS = (exp.Date, exp.Cast, exp.StrToDate, exp.TsOrDsToDate)
+_ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def branch_keys(branches) -> list:
+    """Allowed branch names, lowercased for the case-insensitive branch predicate."""
+    return sorted({b.lower() for b in branches})
+
+
+def _conjuncts(condition) -> list:
+    if isinstance(condition, exp.And):
+        return _conjuncts(condition.left) + _conjuncts(condition.right)
+    return [condition]
+
+
+def _check_safe(tree):
+    if not isinstance(tree, exp.Query):
+        raise QueryRejected("read_only", statement_type=tree.key.upper(),
+                            suggestion="Only SELECT queries are allowed. Rewrite the request as a SELECT.")
+    unsafe = tree.find(*_UNSAFE_NODES) if _UNSAFE_NODES else None
+    if unsafe is not None:
+        raise QueryRejected("read_only", statement_type=unsafe.key.upper(),
+                            suggestion="Only SELECT queries are allowed. Rewrite the request as a SELECT.")
+    for table in tree.find_all(exp.Table):
+        project, dataset = table.catalog, table.db
+        if not dataset:
+            continue  # CTE names and UNNEST aliases
+        if dataset.lower() not in ALLOWED_DATASETS or (project and project.lower() != PROJECT_ID.lower()):
+            raise QueryRejected(
+                "dataset_not_allowed", table=table.sql(dialect="bigquery"),
+                suggestion=f"Only query tables in `{PROJECT_ID}.{DATASET_ID}` (and `{ROLLUP_DATASET}` rollups)."
+            )
+
+
+def _scope_column(table: exp.Table):
+    """Branch column of a scoped table, or None."""
+    name = table.name.lower()
+    if table.db and table.db.lower() == ROLLUP_DATASET.lower():
+        return "branch" if name in ROLLUPS else None
+    if table.db and table.db.lower() != DATASET_ID.lower():
+        return None
+    return SCOPED_TABLES.get(name, {}).get("branch")
+
+
+def _check_classified(tree):
+    """
+    Reject tables a branch-limited user may not read: anything in the datasets that is
+    neither branch-scoped nor a shared reference table. Names without a dataset that are
+    not CTEs count as dataset tables, so nothing unclassified slips through.
+    """
+    ctes = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    for table in tree.find_all(exp.Table):
+        if not table.db and table.name.lower() in ctes:
+            continue
+        if not table.name or isinstance(table.this, exp.Unnest) or _scope_column(table):
+            continue
+        is_rollup = table.db and table.db.lower() == ROLLUP_DATASET.lower()
+        if not is_rollup and table.name.lower() in SHARED_TABLES:
+            continue
+        raise QueryRejected(
+            "table_not_branch_scoped", table=table.sql(dialect="bigquery"),
+            suggestion="This table cannot be limited to your branches. Answer from the branch-scoped tables "
+                       f"({', '.join(SCOPED_TABLES)}) or the rollups instead."
+        )
+
+
+def _matches_column(node, column: str, qualifier) -> bool:
+    return (
+        isinstance(node, exp.Column) and node.name.lower() == column.lower()
+        and (not node.table or qualifier is None or node.table == qualifier)
+    )
+
+
+def _existing_branch_filter(condition, column: str, qualifier):
+    """Values of a literal `[LOWER(]col[)] IN (...)` / `= '...'` filter, else None."""
+    if isinstance(condition, exp.In) and not condition.args.get("query") and not condition.args.get("unnest"):
+        target, values = condition.this, condition.expressions
+    elif isinstance(condition, exp.EQ):
+        target, values = condition.this, [condition.expression]
+    else:
+        return None
+    if isinstance(target, _CASE_FOLDS):
+        target = target.this
+    if not _matches_column(target, column, qualifier):
+        return None
+    if not values or not all(isinstance(v, exp.Literal) and v.is_string for v in values):
+        return None
+    return [v.this for v in values]
+
+
+def _branch_predicate(column: str, qualifier, values: list):
+    if not values:
+        return exp.false()
+    return exp.Lower(this=exp.column(column, table=qualifier)).isin(*[exp.Literal.string(v) for v in values])
+
+
+def _scoped_subquery(table: exp.Table, column: str, values: list) -> exp.Subquery:
+    """`(SELECT * FROM table WHERE <branch predicate>) AS alias`, filtering rows before any join."""
+    source = table.copy()
+    source.set("alias", None)
+    inner = exp.select("*").from_(source).where(_branch_predicate(column, None, values))
+    return inner.subquery(table.alias_or_name)
+
+
+def _preserves_right(join: exp.Join) -> bool:
+    """True if rows of the joined table survive without a match (RIGHT or FULL join)."""
+    return (join.side or "").upper() in ("RIGHT", "FULL")
+
+
+def _scope_select(select: exp.Select, branches, notes: list):
+    """Add the branch predicate for each scoped table read directly by this SELECT."""
+    from_ = select.args.get("from_") or select.args.get("from")
+    joins = select.args.get("joins") or []
+    allowed = branch_keys(branches)
+    single_source = not joins
+
+    if from_ is not None and isinstance(from_.this, exp.Table):
+        table = from_.this
+        column = _scope_column(table)
+        if column and any((join.side or "").upper() == "FULL" for join in joins):
+            # The FROM table is preserved by a FULL join, so WHERE on it would also drop the other side's rows
+            table.replace(_scoped_subquery(table, column, allowed))
+            notes.append(("branch_filter", f"branch filter on {table.name}"))
+        elif column:
+            qualifier = None if single_source else table.alias_or_name
+            where = select.args.get("where")
+            conditions = _conjuncts(where.this) if where is not None else []
+            requested, kept_conditions = None, []
+            for condition in conditions:
+                existing = _existing_branch_filter(condition, column, qualifier)
+                if existing is None:
+                    kept_conditions.append(condition)
+                    continue
+                matches = set(allowed) & {v.lower() for v in existing}
+                requested = matches if requested is None else requested & matches
+            values = allowed if requested is None else sorted(requested)
+            predicate = _branch_predicate(column, qualifier, values)
+            select.set("where", exp.Where(this=exp.and_(*[c.copy() for c in kept_conditions], predicate)))
+            notes.append(("branch_filter", f"branch filter on {table.name}"))
+
+    for join in joins:
+        table = join.this
+        if not isinstance(table, exp.Table):
+            continue
+        column = _scope_column(table)
+        if not column:
+            continue
+        predicate = _branch_predicate(column, table.alias_or_name, allowed)
+        if _preserves_right(join):
+            # An ON predicate keeps unmatched rows of a preserved table, so filter them before the join
+            table.replace(_scoped_subquery(table, column, allowed))
+        elif join.args.get("on") is not None:
+            join.set("on", exp.and_(join.args["on"], predicate))
+        else:
+            # USING or comma joins: filter in WHERE instead
+            select.where(predicate, copy=False)
+        notes.append(("branch_filter", f"branch filter on {table.name}"))
+
+
+def _date_columns(select: exp.Select) -> set:
+    from_ = select.args.get("from_") or select.args.get("from")
+    tables = [from_.this] if from_ is not None else []
+    tables += [join.this for join in select.args.get("joins") or []]
+    return {
+        SCOPED_TABLES[t.name.lower()]["date"].lower()
+        for t in tables if isinstance(t, exp.Table) and t.name.lower() in SCOPED_TABLES
+    }
+
+
+def _unwrap_date(node, date_columns: set):
+    """The raw column inside DATE(col) / CAST(col AS DATE) / PARSE_DATE('%Y-%m-%d', col), else None."""
+    if not isinstance(node, _DATE_WRAPPERS):
+        return None
+    if isinstance(node, exp.Cast) and not node.to.is_type("date"):
+        return None
+    if isinstance(node, (exp.Date, exp.TsOrDsToDate)) and any(v for k, v in node.args.items() if k != "this"):
+        return None  # DATE(ts, 'zone') shifts days, so it is not a plain range
+    if isinstance(node, exp.StrToDate):
+        fmt = node.args.get("format")
+        if not (isinstance(fmt, exp.Literal) and fmt.this in ("%Y-%m-%d", "%F")):
+            return None
+    column = node.this
+    if isinstance(column, exp.Column) and column.name.lower() in date_columns:
+        return column
+    return None
+
+
+def _literal_date(node):
+    if isinstance(node, exp.Cast) and node.to.is_type("date"):
+        node = node.this
+    if isinstance(node, exp.Literal) and node.is_string and _ISO_DATE.match(node.this):
+        try:
+            return date.fromisoformat(node.this)
+        except ValueError:
+            return None
+    return None
+
+
+def _range(column, start: date = None, end: date = None) -> list:
+    """`column >= start AND column < end` with ISO string literals (coerced to the column's type)."""
+    conditions = []
+    if start is not None:
+        conditions.append(exp.GTE(this=column.copy(), expression=exp.Literal.string(start.isoformat())))
+    if end is not None:
+        conditions.append(exp.LT(this=column.copy(), expression=exp.Literal.string(end.isoformat())))
+    return conditions
+
+
+def _date_range(condition, date_columns: set):
+    """Prunable replacement conditions for one wrapped date comparison, else None."""
+    day = timedelta(days=1)
+    if isinstance(condition, exp.Between):
+        column = _unwrap_date(condition.this, date_columns)
+        low, high = _literal_date(condition.args.get("low")), _literal_date(condition.args.get("high"))
+        if column is not None and low and high:
+            return _range(column, low, high + day)
+        return None
+    if not isinstance(condition, (exp.GTE, exp.GT, exp.LT, exp.LTE, exp.EQ)):
+        return None
+    column, value = _unwrap_date(condition.this, date_columns), _literal_date(condition.expression)
+    if column is None or value is None:
+        return None
+    if isinstance(condition, exp.GTE):
+        return _range(column, start=value)
+    if isinstance(condition, exp.GT):
+        return _range(column, start=value + day)
+    if isinstance(condition, exp.LT):
+        return _range(column, end=value)
+    if isinstance(condition, exp.LTE):
+        return _range(column, end=value + day)
+    return _range(column, value, value + day)
+
+
+def _extract_part(condition, date_columns: set):
+    """(part, column, value) for `EXTRACT(YEAR|MONTH FROM col) = n`, else None."""
+    if not isinstance(condition, exp.EQ) or not isinstance(condition.this, exp.Extract):
+        return None
+    part = condition.this.this.name.upper()
+    column, value = condition.this.expression, condition.expression
+    if part not in ("YEAR", "MONTH") or not isinstance(value, exp.Literal) or value.is_string:
+        return None
+    if not isinstance(column, exp.Column) or column.name.lower() not in date_columns:
+        return None
+    return part, column, int(value.this)
+
+
+def _normalize_dates(select: exp.Select, notes: list):
+    where = select.args.get("where")
+    date_columns = _date_columns(select)
+    if where is None or not date_columns:
+        return
+    conditions, changed = [], 0
+    extracts = {}
+    for condition in _conjuncts(where.this):
+        replacement = _date_range(condition, date_columns)
+        if replacement:
+            conditions.extend(replacement)
+            changed += 1
+            continue
+        part = _extract_part(condition, date_columns)
+        if part:
+            extracts.setdefault(part[1].sql(), {})[part[0]] = (part[2], condition, part[1])
+        conditions.append(condition)
+
+    for parts in extracts.values():
+        if "YEAR" not in parts:
+            continue  # A month without a year spans every year
+        year, year_condition, column = parts["YEAR"]
+        if "MONTH" in parts and 1 <= parts["MONTH"][0] <= 12:
+            month, month_condition, _ = parts["MONTH"]
+            start = date(year, month, 1)
+            end = date(year + month // 12, month % 12 + 1, 1)
+            conditions.remove(month_condition)
+        else:
+            start, end = date(year, 1, 1), date(year + 1, 1, 1)
+        index = conditions.index(year_condition)
+        conditions[index:index + 1] = _range(column, start, end)
+        changed += 1
+
+    if changed:
+        select.set("where", exp.Where(this=exp.and_(*[c.copy() for c in conditions])))
+        notes.append(("date_range", f"{changed} date filter(s) as ranges"))
+
+
+def rewrite_query(query: str, branches) -> str:
+    """
+    Validate agent SQL and rewrite it for access control and pruning.
+
+    Args:
+        query: BigQuery SQL written by the agent.
+        branches: The user's branch names, or None for all branches.
+
+    Returns:
+        The rewritten query (unchanged text if nothing needed rewriting).
+
+    Raises:
+        QueryRejected: If the query cannot be parsed, is not a single SELECT, reads
+            tables outside the allowed datasets, or (for branch-limited users) reads a
+            table that cannot be limited to their branches.
+    """
+    if not SQL_REWRITE_ENABLED:
+        return query
+    try:
+        statements = [s for s in sqlglot.parse(query.strip().rstrip(";"), read="bigquery") if s is not None]
+    except sqlglot.errors.SqlglotError as e:
+        SQL_REWRITES.labels("rejected").inc()
+        raise QueryRejected("unparseable", error=str(e).splitlines()[0],
+                            suggestion="Fix the SQL syntax (BigQuery Standard SQL).")
+    if len(statements) != 1:
+        SQL_REWRITES.labels("rejected").inc()
+        raise QueryRejected("multiple_statements", suggestion="Send one SELECT query per call.")
+    tree = statements[0]
+    try:
+        _check_safe(tree)
+        if branches is not None:
+            _check_classified(tree)
+    except QueryRejected:
+        SQL_REWRITES.labels("rejected").inc()
+        raise
+
+    notes = []
+    for select in list(tree.find_all(exp.Select)):
+        # Dates first: scoping may swap a table for a subquery the date columns are looked up on
+        _normalize_dates(select, notes)
+        if branches is not None:
+            _scope_select(select, branches, notes)
+    if not notes:
+        return query
+
+    for action, _ in notes:
+        SQL_REWRITES.labels(action).inc()
+    print(f"[SQL REWRITE] {'; '.join(text for _, text in notes)}")
+    return tree.sql(dialect="bigquery")
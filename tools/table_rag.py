@@ -0,0 +1,166 @@
+# table_rag.py
+import os
+import re
+from langchain.tools import tool
+from db.catalog import TABLE_COLUMNS
+from tools.request_context import get_request_branches
+from monitoring.tracing import traced
+from services.backends import create_row_embeddings
+
+# Must match script_runners/sqlite_to_chroma.py, which builds the collection
+VECTOR_DB_DIR = "chroma_db"
+COLLECTION_NAME = "hackathon_data"
+EMBEDDING_MODEL = "llama3.2"
+MAX_CONTENT_CHARS = 400
+
+# Rows of these tables carry `branch` metadata (see sqlite_to_chroma.py); other tables have none
+BRANCH_SCOPED_TABLES = sorted(table for table, columns in TABLE_COLUMNS.items() if columns["branch"])
+
+_STOPWORDS = {
+    "the", "and", "for", "with", "from", "named", "called", "like", "something", "someone",
+    "client", "clients", "customer", "user", "who", "what", "which", "where", "find", "show",
+    "about", "that", "this", "are", "was", "has", "have", "any", "all", "details", "record",
+}
+_TOKEN = re.compile(r"[A-Za-z0-9@._-]{3,}")
+
+# Global row store instance, loaded on first use
+row_store = None
+
+
+def _get_row_store():
+    global row_store
+    if row_store is None:
+        try:
+            from langchain_community.vectorstores import Chroma
+            row_store = Chroma(
+                persist_directory=VECTOR_DB_DIR,
+                embedding_function=create_row_embeddings(EMBEDDING_MODEL),
+                collection_name=COLLECTION_NAME
+            )
+        except Exception as e:
+            print(f"Error loading table row index: {e}")
+            return None
+    return row_store
+
+
+def table_index_available() -> bool:
+    """True if sqlite_to_chroma.py has built a non-empty row index."""
+    if not os.path.isdir(VECTOR_DB_DIR):
+        return False
+    store = _get_row_store()
+    try:
+        return store is not None and store._collection.count() > 0
+    except Exception as e:
+        print(f"Error reading table row index: {e}")
+        return False
+
+
+# Checked once at startup: the agent only gets `search_table_rows` when there is an index to search
+TABLE_INDEX_AVAILABLE = table_index_available()
+
+
+def _branch_filter(branches):
+    """
+    Chroma `where` clause limiting rows of branch-scoped tables to the user's branches
+    (None means unrestricted). Rows of tables without a branch column (e.g. contacts)
+    are not filtered, as with execute_sql on those tables.
+    """
+    if branches is None:
+        return None
+    # Metadata matching is case-sensitive, so accept common casings of each branch name
+    variants = sorted({v for b in branches for v in (b, b.lower(), b.title())})
+    if not variants:
+        variants = ["__no_access__"]
+    return {"$or": [{"branch": {"$in": variants}}, {"table": {"$nin": BRANCH_SCOPED_TABLES}}]}
+
+
+def _row_key(metadata: dict) -> str:
+    """Identity of an indexed row, the same for keyword and vector hits."""
+    return f"{metadata.get('table')}:{metadata.get('pk', metadata.get('row_id'))}"
+
+
+def _combine(*clauses):
+    clauses = [c for c in clauses if c]
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def _keywords(query: str) -> list:
+    return [t for t in _TOKEN.findall(query) if t.lower() not in _STOPWORDS]
+
+
+@traced("chroma.search")
+def search_table_rows_raw(query: str, table: str = None, k: int = 5) -> list:
+    """
+    Hybrid keyword + vector lookup over embedded table rows, restricted to the
+    current user's branches. Returns hit dicts ordered by relevance.
+    """
+    store = _get_row_store()
+    if store is None:
+        return []
+
+    where = _combine({"table": table} if table else None, _branch_filter(get_request_branches()))
+    hits = {}
+
+    # 1. Keyword pass: exact substring matches on names, cities, emails, ids
+    keywords = _keywords(query)
+    if keywords:
+        variants = sorted({v for kw in keywords for v in (kw, kw.lower(), kw.title())})
+        contains = [{"$contains": v} for v in variants]
+        where_document = contains[0] if len(contains) == 1 else {"$or": contains}
+        found = store._collection.get(
+            where=where, where_document=where_document, limit=k * 4, include=["documents", "metadatas"]
+        )
+        for content, metadata in zip(found["documents"], found["metadatas"]):
+            lowered = content.lower()
+            matched = sum(1 for kw in keywords if kw.lower() in lowered)
+            hits[_row_key(metadata)] = {"score": matched, "content": content, "metadata": metadata}
+
+    # 2. Vector pass: fuzzy / misspelled lookups (keyword hits still count if the embedder is down)
+    try:
+        similar = store.similarity_search_with_score(query, k=k, filter=where)
+    except Exception as e:
+        print(f"Table row vector search failed, returning keyword hits only: {e}")
+        similar = []
+    for doc, distance in similar:
+        doc_id = _row_key(doc.metadata)
+        if doc_id not in hits:
+            # Keyword hits always outrank pure vector hits
+            hits[doc_id] = {"score": 1.0 / (1.0 + distance) - 1.0, "content": doc.page_content,
+                            "metadata": doc.metadata}
+
+    ranked = sorted(hits.values(), key=lambda h: h["score"], reverse=True)
+    return ranked[:k]
+
+
+@tool
+def search_table_rows(query: str, table: str = "") -> str:
+    """
+    Fuzzy lookup of individual records (clients, applications, enquiries, visits) by name,
+    city, email or other free text, e.g. "client named something like Rajesh in Pokhara".
+    Use this BEFORE exploratory SQL when you only know part of a name or value.
+    Returns matching rows with their table and primary key; then use `execute_sql`
+    with the primary key to fetch exact data.
+
+    Args:
+        query: Free-text description of the record(s) to find
+        table: Optional table name to restrict the search (e.g. 'base_contact_table')
+    """
+    try:
+        hits = search_table_rows_raw(query, table or None)
+    except Exception as e:
+        return f"Error searching table rows: {e}"
+
+    if not hits:
+        return "No matching rows found in the table index. Fall back to `execute_sql`."
+
+    lines = [f"Found {len(hits)} candidate rows:"]
+    for hit in hits:
+        meta = hit["metadata"]
+        key = f"{meta.get('pk_column')} = {meta.get('pk')}" if meta.get("pk_column") else f"rowid {meta.get('row_id')}"
+        content = hit["content"]
+        if len(content) > MAX_CONTENT_CHARS:
+            content = content[:MAX_CONTENT_CHARS] + "..."
+        lines.append(f"--- hackathon_data.{meta.get('table')} ({key}) ---\n{content}")
+    return "\n".join(lines)